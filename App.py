@@ -1,59 +1,845 @@
-from flask import Flask, render_template, request, redirect, url_for, g, flash, session, make_response
+from flask import Flask, Response, render_template, request, redirect, url_for, g, flash, session, make_response, send_file, send_from_directory, stream_with_context
+from flask import before_render_template, template_rendered
+import click
+import jinja2
 import os
+import sys
 import sqlite3
+import base64
 import csv
 import io
+import json
+import random
+import re
+import secrets
+import tempfile
+import threading
+import hashlib
+import zipfile
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, time as unix_time
 
 app = Flask(__name__)
-app.secret_key = "new_secret_key_force_logout"
+app.secret_key = os.environ.get("SECRET_KEY", "new_secret_key_force_logout")
 
 # Database setup
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(BASE_DIR, "Timetable.db")
 os.makedirs(DB_DIR, exist_ok=True)
-DB_PATH = os.path.join(DB_DIR, "timetable.db")
+DB_PATH = os.environ.get("TIMETABLE_DB", os.path.join(DB_DIR, "timetable.db"))
+
+app.config.update(
+    DATABASE=DB_PATH,
+    # Production settings, switched on by configure_app(): reuse one connection
+    # per worker thread, and run the database in WAL mode so readers are not
+    # blocked by a writer
+    DB_POOL=False,
+    DB_WAL=False,
+    # Opt-in instrumentation served on /metrics; PROFILER additionally lets a
+    # logged-in user add ?profile=1 to a page to get a sampling profile of it
+    METRICS=os.environ.get("TIMETABLE_METRICS", "False").lower() == "true",
+    PROFILER=os.environ.get("TIMETABLE_PROFILER", "False").lower() == "true",
+    # Background job worker threads per web process, and how long finished
+    # job results are kept, in seconds. By default web workers only queue
+    # jobs and a separate `flask run-jobs` process runs them
+    JOB_WORKERS=int(os.environ.get("TIMETABLE_JOB_WORKERS", 0)),
+    JOB_RESULT_TTL=3600,
+    # Seconds a live-update stream stays open waiting for changes. 0 sends
+    # what is pending and ends, so streams never tie up sync worker threads;
+    # raise it only with an async worker class (e.g. gunicorn -k gevent)
+    CHANGE_STREAM_SECONDS=int(os.environ.get("TIMETABLE_CHANGE_STREAM_SECONDS", 0)),
+    # Let the read-only timetable API (class and staff grids, free slots) be
+    # used without logging in, e.g. by student portals
+    PUBLIC_API=os.environ.get("TIMETABLE_PUBLIC_API", "False").lower() == "true",
+    # Soft limits of the workload report (see build_workload_report); None
+    # or a missing key turns a limit off. Per-day limits count every day over.
+    WORKLOAD_LIMITS={
+        "staff": {"periods_per_day": 5, "periods_per_week": 25, "gaps_per_day": 2, "streak": 4, "first_periods": 3, "last_periods": 3},
+        "class": {"periods_per_day": 7, "gaps_per_day": 1, "streak": 5},
+    },
+)
+
+# Applied to every new connection
+DB_PRAGMAS = [
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -20000",    # 20 MB page cache
+    "PRAGMA mmap_size = 268435456",  # memory-map up to 256 MB of the file
+]
+
+# Instrumentation: per-route histograms kept in process memory and rendered
+# in the Prometheus text format. Everything here is skipped unless METRICS is on.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """Histograms keyed by metric name and label values."""
+
+    # name: (help text, buckets)
+    DEFINITIONS = {
+        "timetable_request_duration_seconds": ("Request latency by route, method and status.", LATENCY_BUCKETS),
+        "timetable_request_sql_statements": ("SQL statements executed per request.", COUNT_BUCKETS),
+        "timetable_request_sql_seconds": ("Time spent executing SQL per request (to the first row of each statement).", LATENCY_BUCKETS),
+        "timetable_render_seconds": ("Jinja template render time.", LATENCY_BUCKETS),
+        "timetable_export_seconds": ("Excel / PDF / ZIP export generation time, cache misses only.", LATENCY_BUCKETS),
+        "timetable_job_seconds": ("Background job run time by kind and outcome.", LATENCY_BUCKETS),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {name: {} for name in self.DEFINITIONS}
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.DEFINITIONS[name][1])
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """All series in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            for name, (help_text, buckets) in self.DEFINITIONS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(self._series[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {histogram.total}")
+                    lines.append(f"{name}_count{self._labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that counts the statements run through it and the time they take.
+
+    Only execute() / executemany() are timed, up to the first row; rows
+    fetched later are not. Used in place of sqlite3.Connection when METRICS is on.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.statements += 1
+            self.sql_seconds += perf_counter() - started
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.statements += 1
+            self.sql_seconds += perf_counter() - started
+
+class SamplingProfiler:
+    """Samples the stack of one thread every ``interval`` seconds from a helper thread."""
+
+    # The switch interval is process-wide and requests can be profiled
+    # concurrently: the first profiler to start saves it, each one lowers it to
+    # suit the finest interval still running and the last one out restores it
+    _switch_lock = threading.Lock()
+    _running_intervals = []
+    _saved_switch_interval = None
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.lines = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # The sampler only runs when it gets the GIL, which the profiled thread
+        # otherwise keeps for 5 ms at a time
+        cls = SamplingProfiler
+        with cls._switch_lock:
+            if not cls._running_intervals:
+                cls._saved_switch_interval = sys.getswitchinterval()
+            cls._running_intervals.append(self.interval)
+            sys.setswitchinterval(min(cls._running_intervals) / 2)
+        self._started = perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        cls = SamplingProfiler
+        with cls._switch_lock:
+            cls._running_intervals.remove(self.interval)
+            if cls._running_intervals:
+                sys.setswitchinterval(min(cls._running_intervals) / 2)
+            else:
+                sys.setswitchinterval(cls._saved_switch_interval)
+        self.elapsed = perf_counter() - self._started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            leaf = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.lines[leaf] = self.lines.get(leaf, 0) + 1
+            self.samples += 1
+
+    def report(self, top=30):
+        """Busiest lines, then every stack in the collapsed format flamegraph tools read."""
+        out = [f"{self.samples} samples every {self.interval * 1000:g} ms over {self.elapsed * 1000:.1f} ms", "", "Busiest lines:"]
+        for line, count in sorted(self.lines.items(), key=lambda item: -item[1])[:top]:
+            out.append(f"{count:6d} {100.0 * count / max(self.samples, 1):5.1f}%  {line}")
+        out += ["", "Collapsed stacks:"]
+        out += [f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])]
+        return "\n".join(out) + "\n"
+
+def connect_db(path=None):
+    factory = InstrumentedConnection if app.config["METRICS"] else sqlite3.Connection
+    conn = sqlite3.connect(path or app.config["DATABASE"], factory=factory)
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    if app.config["DB_WAL"]:
+        # Safe with WAL: a power loss can only lose the last commits, never corrupt
+        conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+_pool = threading.local()
 
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        if app.config["DB_POOL"]:
+            conn = getattr(_pool, "conn", None)
+            # A connection opened before a worker was forked must not be shared with it
+            if conn is None or _pool.pid != os.getpid():
+                conn = _pool.conn = connect_db()
+                _pool.pid = os.getpid()
+            g.db = conn
+        else:
+            g.db = connect_db()
+        if isinstance(g.db, InstrumentedConnection):
+            # A pooled connection has served earlier requests; count from here
+            g.sql_baseline = (g.db.statements, g.db.sql_seconds)
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop("db", None)
-    if db is not None:
+    if db is None:
+        return
+    if app.config["DB_POOL"]:
+        # Keep the pooled connection, but never carry a transaction into the next request
+        if db.in_transaction:
+            db.rollback()
+    else:
         db.close()
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def _table_columns(cursor, table):
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+def _has_table(cursor, name):
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have run, so each one executes exactly once per database.
+def _migrate_base_table(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS timetable (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             staff_name TEXT NOT NULL,
             department TEXT NOT NULL,
-            year TEXT NOT NULL,
             semester TEXT NOT NULL,
             subject TEXT NOT NULL,
             day TEXT NOT NULL,
             time TEXT NOT NULL
         )
     ''')
-    # Attempt to add the 'year' column if it doesn't exist (for existing databases)
-    try:
+
+def _migrate_year_column(cursor):
+    # Older databases were created before the 'year' column existed
+    if "year" not in _table_columns(cursor, "timetable"):
         cursor.execute("ALTER TABLE timetable ADD COLUMN year TEXT DEFAULT ''")
-    except sqlite3.OperationalError:
-        pass
-    # Attempt to add the 'room' column if it doesn't exist
-    try:
+
+def _migrate_room_column(cursor):
+    if "room" not in _table_columns(cursor, "timetable"):
         cursor.execute("ALTER TABLE timetable ADD COLUMN room TEXT DEFAULT ''")
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
-    conn.close()
 
-# Time slots and days
+def _migrate_slot_indexes(cursor):
+    # Cover the staff / class / room conflict probes and grid lookups
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timetable_staff_slot ON timetable (staff_name, day, time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timetable_class_slot ON timetable (department, year, semester, day, time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timetable_room_slot ON timetable (room, day, time)")
+
+# Let the database itself reject double bookings. Blank staff, class and room
+# values are placeholders, not bookings, so they are left out.
+UNIQUE_SLOT_INDEXES = {
+    "ux_timetable_staff_slot": "CREATE UNIQUE INDEX ux_timetable_staff_slot ON timetable (staff_name, day, time) WHERE staff_name != ''",
+    "ux_timetable_class_slot": "CREATE UNIQUE INDEX ux_timetable_class_slot ON timetable (department, year, semester, day, time) WHERE department != ''",
+    "ux_timetable_room_slot": "CREATE UNIQUE INDEX ux_timetable_room_slot ON timetable (room, day, time) WHERE room != ''",
+}
+
+def _create_unique_slot_indexes(cursor):
+    if _has_table(cursor, "sessions"):
+        _create_session_overlap_triggers(cursor)
+        return
+    existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for name, sql in UNIQUE_SLOT_INDEXES.items():
+        if name in existing:
+            continue
+        cursor.execute("SAVEPOINT unique_slot")
+        try:
+            cursor.execute(sql)
+        except sqlite3.IntegrityError as e:
+            # Existing double bookings block this index. Leave it out for now;
+            # init_db() tries again on every start until the rows are cleaned up.
+            cursor.execute("ROLLBACK TO unique_slot")
+            app.logger.warning("Double bookings prevent %s: %s", name, e)
+        cursor.execute("RELEASE unique_slot")
+
+def _migrate_unique_slots(cursor):
+    _create_unique_slot_indexes(cursor)
+
+def _migrate_revision_counter(cursor):
+    # Every row change bumps the revision, whichever process or tool made it,
+    # so in-memory caches can tell when the table has moved on without them
+    cursor.execute("CREATE TABLE IF NOT EXISTS timetable_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cursor.execute("INSERT OR IGNORE INTO timetable_meta (key, value) VALUES ('revision', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_timetable_revision_{event.lower()} AFTER {event} ON timetable
+            BEGIN
+                UPDATE timetable_meta SET value = value + 1 WHERE key = 'revision';
+            END
+        """)
+
+def _migrate_entity_revisions(cursor):
+    # Per staff member, class and room change counters, so caches of one
+    # timetable are not thrown away by writes to every other timetable
+    cursor.execute("CREATE TABLE IF NOT EXISTS timetable_revisions (entity TEXT PRIMARY KEY, revision INTEGER NOT NULL)")
+    bump = """
+        INSERT INTO timetable_revisions (entity, revision) VALUES ({entity}, 1)
+        ON CONFLICT (entity) DO UPDATE SET revision = revision + 1;
+    """
+    for event, refs in (("INSERT", ["NEW"]), ("UPDATE", ["OLD", "NEW"]), ("DELETE", ["OLD"])):
+        body = ""
+        for ref in refs:
+            body += bump.format(entity=f"'staff:' || {ref}.staff_name")
+            body += bump.format(entity=f"'class:' || {ref}.department || '|' || IFNULL({ref}.year, '') || '|' || {ref}.semester")
+            body += bump.format(entity=f"'room:' || IFNULL({ref}.room, '')")
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_timetable_entity_revision_{event.lower()} AFTER {event} ON timetable
+            BEGIN
+                {body}
+            END
+        """)
+
+# Normalized storage. Staff, classes and rooms are interned into their own
+# integer-keyed tables and each session stores small day / slot indexes; the
+# old column layout lives on as the ``timetable`` view, so queries keep
+# working and writes go through INSTEAD OF triggers. Id 0 is the blank
+# placeholder in every lookup table, so unique indexes can leave it out with a
+# constant partial-index condition.
+SESSION_KEY_COLUMNS = ("id", "staff_id", "class_id", "room_id", "day", "slot")
+
+# Double bookings of sessions are rejected by BEFORE INSERT / UPDATE triggers
+# rather than unique indexes, because a block covers every period from
+# ``slot`` to ``slot + duration - 1`` and a week 0 session clashes with every
+# week of the rotation. Day and slot indexes only mean the same thing on one
+# calendar, so the triggers compare sessions of the same calendar; clashes
+# across calendars are found by the occupancy checks (see Calendar.project()).
+SESSION_OVERLAP_CHECKS = {"staff": "staff_id", "class": "class_id", "room": "room_id"}
+
+def _session_overlap(column, ref):
+    """Query for a session that shares ``column`` with row ``ref`` and overlaps it."""
+    return f"""
+        SELECT 1 FROM sessions s JOIN classes c ON c.id = s.class_id
+        WHERE s.{column} = {ref}.{column} AND s.{column} != 0 AND s.id IS NOT {ref}.id
+          AND s.day = {ref}.day AND s.slot < {ref}.slot + {ref}.duration AND {ref}.slot < s.slot + s.duration
+          AND (s.week = {ref}.week OR s.week = 0 OR {ref}.week = 0)
+          AND c.calendar_id = (SELECT calendar_id FROM classes WHERE id = {ref}.class_id)"""
+
+def _create_session_overlap_triggers(cursor):
+    if "duration" not in _table_columns(cursor, "sessions"):
+        return
+    existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    for kind, column in SESSION_OVERLAP_CHECKS.items():
+        if f"trg_sessions_{kind}_overlap_insert" in existing:
+            continue
+        if cursor.execute(f"SELECT 1 FROM sessions o WHERE EXISTS ({_session_overlap(column, 'o')}) LIMIT 1").fetchone():
+            # Existing double bookings would make every edit of those rows
+            # fail. Leave the check out for now; init_db() tries again on
+            # every start until the rows are cleaned up.
+            app.logger.warning("Double bookings prevent the %s overlap check", kind)
+            continue
+        for event, when in (("insert", "INSERT"), ("update", "UPDATE OF staff_id, class_id, room_id, day, slot, week, duration")):
+            cursor.execute(f"""
+                CREATE TRIGGER trg_sessions_{kind}_overlap_{event} BEFORE {when} ON sessions
+                WHEN NEW.{column} != 0 AND EXISTS ({_session_overlap(column, "NEW")})
+                BEGIN
+                    SELECT RAISE(ABORT, 'Double booking: {kind} already booked in this period');
+                END
+            """)
+
+def _session_lookup(ref):
+    """Id subqueries that resolve a view row's text values inside a trigger."""
+    return {
+        "staff_id": f"(SELECT id FROM staff WHERE name = {ref}.staff_name)",
+        "class_id": f"(SELECT id FROM classes WHERE department = {ref}.department AND year = IFNULL({ref}.year, '') AND semester = {ref}.semester)",
+        "room_id": f"(SELECT id FROM rooms WHERE name = IFNULL({ref}.room, ''))",
+    }
+
+def _create_timetable_view(cursor):
+    """(Re)create the ``timetable`` view and its write triggers over ``sessions``.
+
+    Plain session columns (subject, and any added by later migrations) are
+    passed through by name, so a migration that adds one only has to call
+    this again.
+    """
+    columns = [row for row in cursor.execute("PRAGMA table_info(sessions)")
+               if row[1] not in SESSION_KEY_COLUMNS + ("subject",)]
+    extra = [row[1] for row in columns]
+    defaults = {row[1]: row[4] for row in columns if row[4] is not None}
+    cursor.execute("DROP VIEW IF EXISTS timetable")
+    if _has_table(cursor, "calendar_days"):
+        # Day and time names belong to the calendar of the row's class
+        calendar_joins = """
+        JOIN calendar_days d ON d.calendar_id = c.calendar_id AND d.idx = s.day
+        JOIN calendar_slots t ON t.calendar_id = c.calendar_id AND t.idx = s.slot"""
+        name_joins = """
+        LEFT JOIN calendar_days d ON d.calendar_id = c.calendar_id AND d.name = NEW.day
+        LEFT JOIN calendar_slots t ON t.calendar_id = c.calendar_id AND t.label = NEW.time"""
+        extra_view = ["c.calendar_id AS calendar_id"]
+    else:
+        # Before calendars existed every class ran on the one bell schedule
+        calendar_joins = """
+        JOIN timetable_days d ON d.idx = s.day
+        JOIN timetable_slots t ON t.idx = s.slot"""
+        name_joins = """
+        LEFT JOIN timetable_days d ON d.name = NEW.day
+        LEFT JOIN timetable_slots t ON t.label = NEW.time"""
+        extra_view = []
+    cursor.execute(f"""
+        CREATE VIEW timetable AS
+        SELECT s.id AS id, st.name AS staff_name, c.department AS department, c.semester AS semester,
+               s.subject AS subject, d.name AS day, t.label AS time, c.year AS year, r.name AS room
+               {"".join(", s." + c for c in extra)}{"".join(", " + c for c in extra_view)}
+        FROM sessions s
+        JOIN staff st ON st.id = s.staff_id
+        JOIN classes c ON c.id = s.class_id
+        JOIN rooms r ON r.id = s.room_id{calendar_joins}
+    """)
+    intern = """
+        INSERT OR IGNORE INTO staff (name) VALUES ({ref}.staff_name);
+        INSERT OR IGNORE INTO classes (department, year, semester) VALUES ({ref}.department, IFNULL({ref}.year, ''), {ref}.semester);
+        INSERT OR IGNORE INTO rooms (name) VALUES (IFNULL({ref}.room, ''));
+    """
+    lookup = _session_lookup("NEW")
+    extra.insert(0, "subject")
+    columns = ["id", "staff_id", "class_id", "room_id", "day", "slot"] + extra
+    # Columns the caller left out arrive as NULL; fall back to the column default
+    values = ["NEW.id", lookup["staff_id"], "c.id", lookup["room_id"], "d.idx", "t.idx"]
+    values += [f"IFNULL(NEW.{c}, {defaults[c]})" if c in defaults else f"NEW.{c}" for c in extra]
+    # The class is resolved once and its calendar joined; an unknown day or
+    # time leaves a NULL that the NOT NULL columns reject
+    source = f"""
+            SELECT {", ".join(values)}
+            FROM classes c{name_joins}
+            WHERE c.department = NEW.department AND c.year = IFNULL(NEW.year, '') AND c.semester = NEW.semester"""
+    cursor.execute(f"""
+        CREATE TRIGGER trg_timetable_view_insert INSTEAD OF INSERT ON timetable
+        BEGIN
+            {intern.format(ref="NEW")}
+            INSERT INTO sessions ({", ".join(columns)}){source};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER trg_timetable_view_update INSTEAD OF UPDATE ON timetable
+        BEGIN
+            {intern.format(ref="NEW")}
+            UPDATE sessions SET ({", ".join(columns)}) = ({source}) WHERE id = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER trg_timetable_view_delete INSTEAD OF DELETE ON timetable
+        BEGIN
+            DELETE FROM sessions WHERE id = OLD.id;
+        END
+    """)
+
+def _create_session_triggers(cursor, stamp=False):
+    # The revision counters of _migrate_revision_counter and
+    # _migrate_entity_revisions, moved onto the base table; with ``stamp``
+    # each counter also records when it last moved (see _migrate_revision_times)
+    names = {
+        "staff": "'staff:' || (SELECT name FROM staff WHERE id = {ref}.staff_id)",
+        "class": "'class:' || (SELECT department || '|' || year || '|' || semester FROM classes WHERE id = {ref}.class_id)",
+        "room": "'room:' || (SELECT name FROM rooms WHERE id = {ref}.room_id)",
+    }
+    bump = """
+        INSERT INTO timetable_revisions (entity, revision) VALUES ({entity}, 1)
+        ON CONFLICT (entity) DO UPDATE SET revision = revision + 1;
+    """
+    if stamp:
+        bump = """
+            INSERT INTO timetable_revisions (entity, revision, changed_at) VALUES ({entity}, 1, strftime('%s', 'now'))
+            ON CONFLICT (entity) DO UPDATE SET revision = revision + 1, changed_at = excluded.changed_at;
+        """
+    for event, refs in (("INSERT", ["NEW"]), ("UPDATE", ["OLD", "NEW"]), ("DELETE", ["OLD"])):
+        body = "UPDATE timetable_meta SET value = value + 1 WHERE key = 'revision';"
+        for ref in refs:
+            for entity in names.values():
+                body += bump.format(entity=entity.format(ref=ref))
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sessions_revision_{event.lower()} AFTER {event} ON sessions
+            BEGIN
+                {body}
+            END
+        """)
+
+def _migrate_normalized_storage(cursor):
+    cursor.execute("CREATE TABLE staff (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("""
+        CREATE TABLE classes (
+            id INTEGER PRIMARY KEY,
+            department TEXT NOT NULL,
+            year TEXT NOT NULL,
+            semester TEXT NOT NULL,
+            UNIQUE (department, year, semester)
+        )
+    """)
+    cursor.execute("CREATE TABLE rooms (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("CREATE TABLE timetable_days (idx INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("CREATE TABLE timetable_slots (idx INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE)")
+    cursor.execute("INSERT INTO staff (id, name) VALUES (0, '')")
+    cursor.execute("INSERT INTO classes (id, department, year, semester) VALUES (0, '', '', '')")
+    cursor.execute("INSERT INTO rooms (id, name) VALUES (0, '')")
+    cursor.executemany("INSERT INTO timetable_days (idx, name) VALUES (?, ?)", enumerate(days))
+    cursor.executemany("INSERT INTO timetable_slots (idx, label) VALUES (?, ?)", enumerate(time_slots))
+    cursor.execute("""
+        CREATE TABLE sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id INTEGER NOT NULL REFERENCES staff (id),
+            class_id INTEGER NOT NULL REFERENCES classes (id),
+            room_id INTEGER NOT NULL REFERENCES rooms (id),
+            subject TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            slot INTEGER NOT NULL
+        )
+    """)
+
+    # Copy the old rows across, keeping their ids
+    cursor.execute("ALTER TABLE timetable RENAME TO timetable_legacy")
+    cursor.execute("INSERT OR IGNORE INTO staff (name) SELECT DISTINCT staff_name FROM timetable_legacy")
+    cursor.execute("""
+        INSERT OR IGNORE INTO classes (department, year, semester)
+        SELECT DISTINCT department, IFNULL(year, ''), semester FROM timetable_legacy
+    """)
+    cursor.execute("INSERT OR IGNORE INTO rooms (name) SELECT DISTINCT IFNULL(room, '') FROM timetable_legacy")
+    lookup = _session_lookup("l")
+    cursor.execute(f"""
+        INSERT INTO sessions (id, staff_id, class_id, room_id, subject, day, slot)
+        SELECT l.id, {lookup["staff_id"]}, {lookup["class_id"]}, {lookup["room_id"]}, l.subject, d.idx, t.idx
+        FROM timetable_legacy l
+        JOIN timetable_days d ON d.name = l.day
+        JOIN timetable_slots t ON t.label = l.time
+    """)
+    # Rows whose day or time is not on the bell schedule never showed up in a
+    # grid; keep them aside instead of dropping them
+    cursor.execute("""
+        CREATE TABLE timetable_unscheduled AS
+        SELECT * FROM timetable_legacy WHERE id NOT IN (SELECT id FROM sessions)
+    """)
+    unscheduled = cursor.execute("SELECT COUNT(*) FROM timetable_unscheduled").fetchone()[0]
+    if unscheduled:
+        app.logger.warning("%d timetable rows with an unknown day or time moved to timetable_unscheduled", unscheduled)
+    # Carry the id sequence over too, so ids of deleted rows are not reused
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'sessions'")
+    cursor.execute("UPDATE sqlite_sequence SET name = 'sessions' WHERE name = 'timetable_legacy'")
+    cursor.execute("DROP TABLE timetable_legacy")
+
+    cursor.execute("CREATE INDEX idx_sessions_staff_slot ON sessions (staff_id, day, slot)")
+    cursor.execute("CREATE INDEX idx_sessions_class_slot ON sessions (class_id, day, slot)")
+    cursor.execute("CREATE INDEX idx_sessions_room_slot ON sessions (room_id, day, slot)")
+    _create_timetable_view(cursor)
+    _create_session_triggers(cursor)
+
+# Calendars: each class runs on a bell schedule of named days, periods (with
+# the break that follows a period, if any) and optional rotation weeks such as
+# odd / even. The pre-calendar schedule becomes calendar 1, which every class
+# starts on. Sessions gain a week column: 0 repeats every week of the
+# rotation, n books week n only.
+DEFAULT_CALENDAR_ID = 1
+
+def _migrate_calendars(cursor):
+    cursor.execute("CREATE TABLE calendars (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("""
+        CREATE TABLE calendar_days (
+            calendar_id INTEGER NOT NULL REFERENCES calendars (id),
+            idx INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (calendar_id, idx),
+            UNIQUE (calendar_id, name)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE calendar_slots (
+            calendar_id INTEGER NOT NULL REFERENCES calendars (id),
+            idx INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            pause TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (calendar_id, idx),
+            UNIQUE (calendar_id, label)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE calendar_weeks (
+            calendar_id INTEGER NOT NULL REFERENCES calendars (id),
+            idx INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            PRIMARY KEY (calendar_id, idx),
+            UNIQUE (calendar_id, label)
+        )
+    """)
+    cursor.execute("INSERT INTO calendars (id, name) VALUES (?, 'Default')", (DEFAULT_CALENDAR_ID,))
+    cursor.execute("INSERT INTO calendar_days (calendar_id, idx, name) SELECT ?, idx, name FROM timetable_days", (DEFAULT_CALENDAR_ID,))
+    cursor.execute("""
+        INSERT INTO calendar_slots (calendar_id, idx, label, pause)
+        SELECT ?, idx, label, CASE label WHEN ? THEN 'BREAK' WHEN ? THEN 'LUNCH' ELSE '' END FROM timetable_slots
+    """, (DEFAULT_CALENDAR_ID, BREAK_AFTER_SLOT, LUNCH_AFTER_SLOT))
+    cursor.execute("DROP VIEW timetable")
+    cursor.execute("DROP TABLE timetable_days")
+    cursor.execute("DROP TABLE timetable_slots")
+    cursor.execute(f"ALTER TABLE classes ADD COLUMN calendar_id INTEGER NOT NULL DEFAULT {DEFAULT_CALENDAR_ID} REFERENCES calendars (id)")
+    cursor.execute("ALTER TABLE sessions ADD COLUMN week INTEGER NOT NULL DEFAULT 0")
+    # Replaced by week-aware checks (see _migrate_block_overlaps)
+    for name in ("ux_sessions_staff_slot", "ux_sessions_class_slot", "ux_sessions_room_slot"):
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+    # Calendar edits bump their own counter, so compiled calendars are rebuilt
+    # only when one changes, and the timetable revision, because the meaning
+    # of stored day / slot indexes changes with them
+    cursor.execute("INSERT OR IGNORE INTO timetable_meta (key, value) VALUES ('calendars', 0)")
+    bump = "UPDATE timetable_meta SET value = value + 1 WHERE key IN ('calendars', 'revision');"
+    for table in ("calendars", "calendar_days", "calendar_slots", "calendar_weeks"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER trg_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    {bump}
+                END
+            """)
+    cursor.execute(f"""
+        CREATE TRIGGER trg_classes_calendar_insert AFTER INSERT ON classes WHEN NEW.calendar_id != {DEFAULT_CALENDAR_ID}
+        BEGIN
+            {bump}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER trg_classes_calendar_update AFTER UPDATE OF calendar_id ON classes
+        BEGIN
+            {bump}
+        END
+    """)
+    _create_timetable_view(cursor)
+
+def _migrate_session_duration(cursor):
+    # Sessions longer than one period (labs) are one row covering
+    # ``duration`` consecutive periods from ``slot``
+    cursor.execute("ALTER TABLE sessions ADD COLUMN duration INTEGER NOT NULL DEFAULT 1 CHECK (duration >= 1)")
+    _create_timetable_view(cursor)
+
+def _migrate_room_catalogue(cursor):
+    # Rooms with a capacity are the catalogue the room allocator picks from;
+    # a class's strength is the number of seats it needs (0 if unknown)
+    cursor.execute("ALTER TABLE rooms ADD COLUMN capacity INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE rooms ADD COLUMN room_type TEXT NOT NULL DEFAULT ''")
+    cursor.execute("ALTER TABLE classes ADD COLUMN strength INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX idx_rooms_capacity ON rooms (capacity, name)")
+
+def _migrate_session_version(cursor):
+    # Optimistic locking: an edit names the version it was made against and
+    # is refused if the row has moved on since
+    cursor.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    _create_timetable_view(cursor)
+
+def _migrate_jobs(cursor):
+    # Background job queue (see JobQueue). At most one queued or running job
+    # per dedup key, so identical submissions share it
+    cursor.execute("""
+        CREATE TABLE jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            dedup_key TEXT NOT NULL,
+            owner TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed', 'cancelled')),
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT NOT NULL DEFAULT '',
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            download_name TEXT,
+            mimetype TEXT,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            heartbeat_at REAL,
+            finished_at REAL,
+            expires_at REAL
+        )
+    """)
+    cursor.execute("CREATE UNIQUE INDEX idx_jobs_in_flight ON jobs (dedup_key) WHERE status IN ('queued', 'running')")
+    cursor.execute("CREATE INDEX idx_jobs_status ON jobs (status, created_at)")
+    cursor.execute("CREATE INDEX idx_jobs_expires ON jobs (expires_at)")
+
+def _migrate_change_log(cursor):
+    # Append-only log of session changes that live views follow (see
+    # ChangeFeed). Written by triggers, so every writer is covered; an edit
+    # is logged as the old row going and the new one arriving
+    cursor.execute("""
+        CREATE TABLE timetable_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL CHECK (op IN ('add', 'remove')),
+            session_id INTEGER NOT NULL,
+            staff_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            room_id INTEGER NOT NULL,
+            subject TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            week INTEGER NOT NULL,
+            duration INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+        )
+    """)
+    log = """
+        INSERT INTO timetable_changes (op, session_id, staff_id, class_id, room_id, subject, day, slot, week, duration, version)
+        VALUES ('{op}', {ref}.id, {ref}.staff_id, {ref}.class_id, {ref}.room_id, {ref}.subject, {ref}.day, {ref}.slot,
+                {ref}.week, {ref}.duration, {ref}.version);
+    """
+    for event, refs in (("INSERT", [("add", "NEW")]), ("UPDATE", [("remove", "OLD"), ("add", "NEW")]), ("DELETE", [("remove", "OLD")])):
+        body = "".join(log.format(op=op, ref=ref) for op, ref in refs)
+        cursor.execute(f"""
+            CREATE TRIGGER trg_sessions_change_log_{event.lower()} AFTER {event} ON sessions
+            BEGIN
+                {body}
+            END
+        """)
+
+def _migrate_revision_times(cursor):
+    # When each staff, class and room timetable last changed, for the
+    # Last-Modified header of the read-only API. Existing counters are stamped
+    # now, which is never earlier than their real last change
+    cursor.execute("ALTER TABLE timetable_revisions ADD COLUMN changed_at INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE timetable_revisions SET changed_at = strftime('%s', 'now')")
+    for event in ("insert", "update", "delete"):
+        cursor.execute(f"DROP TRIGGER trg_sessions_revision_{event}")
+    _create_session_triggers(cursor, stamp=True)
+
+def _migrate_block_overlaps(cursor):
+    # The per-week unique indexes only covered the first period of a block
+    # and treated day / slot indexes of different calendars as the same
+    # period; the overlap triggers replace them
+    for name in ("ux_sessions_staff_week_slot", "ux_sessions_class_week_slot", "ux_sessions_room_week_slot"):
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    _create_session_overlap_triggers(cursor)
+
+def _migrate_database_id(cursor):
+    # Random id of this database file. Revision counters start again when the
+    # database is recreated or restored, so caches that outlive the process
+    # (the export directory) key on this as well
+    cursor.execute("INSERT OR IGNORE INTO timetable_meta (key, value) VALUES ('database_id', random() & 9223372036854775807)")
+
+SCHEMA_MIGRATIONS = [
+    _migrate_base_table,
+    _migrate_year_column,
+    _migrate_room_column,
+    _migrate_slot_indexes,
+    _migrate_unique_slots,
+    _migrate_revision_counter,
+    _migrate_entity_revisions,
+    _migrate_normalized_storage,
+    _migrate_calendars,
+    _migrate_session_duration,
+    _migrate_room_catalogue,
+    _migrate_session_version,
+    _migrate_jobs,
+    _migrate_change_log,
+    _migrate_revision_times,
+    _migrate_block_overlaps,
+    _migrate_database_id,
+]
+
+def init_db(db_path=None):
+    conn = sqlite3.connect(db_path or app.config["DATABASE"], isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        if app.config["DB_WAL"]:
+            # Persistent: once set, every connection to the file uses WAL
+            cursor.execute("PRAGMA journal_mode = WAL")
+        for version, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+            # Take the write lock before reading the version so that several
+            # workers starting together do not run the same migration twice
+            cursor.execute("BEGIN IMMEDIATE")
+            current = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if current >= version:
+                cursor.execute("ROLLBACK")
+                continue
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            cursor.execute("COMMIT")
+            if migration is _migrate_normalized_storage:
+                # Give the space of the old text columns back to the filesystem
+                cursor.execute("VACUUM")
+        # Retry unique indexes and overlap checks that earlier double bookings held back
+        cursor.execute("BEGIN IMMEDIATE")
+        _create_unique_slot_indexes(cursor)
+        cursor.execute("COMMIT")
+    finally:
+        conn.close()
+
+# Time slots and days of the default calendar (calendar 1 of a new database)
 time_slots = [
     "8:30 - 9:20",
     "9:20 - 10:10",
@@ -65,6 +851,1958 @@ time_slots = [
 ]
 days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
 
+# The bell schedule has a short break after this period and lunch after the next one
+BREAK_AFTER_SLOT = "9:20 - 10:10"
+LUNCH_AFTER_SLOT = "11:10 - 12:00"
+
+# Penalty weights for the schedule quality objective
+GAP_WEIGHT = 3        # idle period between two classes in the same session block
+SPREAD_WEIGHT = 5     # same subject taught to a class twice on one day
+DAY_LOAD_WEIGHT = 1   # per period already booked that day (spreads load across days)
+LIMIT_WEIGHT = 10     # per period / day over a soft limit of the workload report
+
+def slot_minutes(labels):
+    """(start, end) minutes after midnight of each "h:mm - h:mm" period label, None for any other label.
+
+    Bell schedules write times on a 12-hour clock without am / pm, so a time
+    earlier than the period before it is read as afternoon ("12:45 - 1:30"
+    is 12:45 to 13:30).
+    """
+    times, last = [], 0
+    for label in labels:
+        found = re.fullmatch(r"\s*(\d{1,2})[:.](\d{2})\s*-\s*(\d{1,2})[:.](\d{2})\s*", label)
+        if not found:
+            times.append(None)
+            continue
+        h1, m1, h2, m2 = map(int, found.groups())
+        start, end = h1 * 60 + m1, h2 * 60 + m2
+        if start < last:
+            start += 12 * 60
+        while end <= start:
+            end += 12 * 60
+        times.append((start, end))
+        last = end
+    return times
+
+# Timetable optimizer
+#
+# A week is a bitset: bit (day_index * slots_per_day + slot_index) is set when
+# the staff member, class or room is busy in that period. Conflict checks and
+# free-slot searches are then single AND / OR operations on Python ints. On a
+# calendar with rotation weeks the bitset spans the whole rotation, one week
+# after the other.
+class Calendar:
+    """A bell schedule compiled into the lookup tables everything else indexes with.
+
+    ``pauses`` maps a slot index to the label of the break that follows it
+    (e.g. "BREAK", "LUNCH"); ``weeks`` lists rotation week labels and is
+    empty when every week is the same.
+    """
+
+    def __init__(self, calendar_id, name, days, time_slots, pauses=None, weeks=()):
+        self.id = calendar_id
+        self.name = name
+        self.days = list(days)
+        self.time_slots = list(time_slots)
+        self.pauses = dict(pauses or {})
+        self.weeks = list(weeks)
+        self.day_index = {d: i for i, d in enumerate(self.days)}
+        self.slot_index = {t: i for i, t in enumerate(self.time_slots)}
+        self.week_index = {w: i for i, w in enumerate(self.weeks, start=1)}
+        self.slots_per_day = len(self.time_slots)
+        self.cycle_days = len(self.days) * max(1, len(self.weeks))
+        self.week_bits = self.cycle_days * self.slots_per_day
+        self.full_week = (1 << self.week_bits) - 1
+        self.day_bits = (1 << self.slots_per_day) - 1
+        # A booking made "every week" repeats at this stride through the rotation
+        stride = len(self.days) * self.slots_per_day
+        self.every_week = sum(1 << (w * stride) for w in range(max(1, len(self.weeks))))
+        # {period label: break label} of the periods a break follows
+        self.pause_labels = {self.time_slots[i]: label for i, label in self.pauses.items()}
+        # Row labels of grids and exports: one per day of the rotation
+        if self.weeks:
+            self.day_labels = [f"{d} ({w})" for w in self.weeks for d in self.days]
+        else:
+            self.day_labels = list(self.days)
+        # Per-day masks of the teaching blocks separated by breaks, and lookup
+        # tables over every possible single-day occupancy pattern
+        self.segments = self._segment_masks()
+        self._run_starts = {}
+        # Every period of one weekday (through the rotation) / of one period label
+        self.day_masks = [sum(self.day_bits << ((w * len(self.days) + d) * self.slots_per_day)
+                              for w in range(max(1, len(self.weeks)))) for d in range(len(self.days))]
+        self.slot_masks = [sum(1 << (d * self.slots_per_day + s) for d in range(self.cycle_days))
+                           for s in range(self.slots_per_day)]
+        self.day_gaps = [self._gap_count(m) for m in range(1 << self.slots_per_day)]
+        self.day_popcount = [bin(m).count("1") for m in range(1 << self.slots_per_day)]
+        # Wall-clock times of the periods, for lining calendars up (see project())
+        self.slot_times = slot_minutes(self.time_slots)
+        self._projections = {}
+
+    def _segment_masks(self):
+        segments, start = [], 0
+        for i in range(self.slots_per_day):
+            if i in self.pauses or i == self.slots_per_day - 1:
+                segments.append(((1 << (i + 1)) - 1) ^ ((1 << start) - 1))
+                start = i + 1
+        return segments
+
+    def _gap_count(self, day_mask):
+        gaps = 0
+        for segment in self.segments:
+            m = day_mask & segment
+            if m:
+                low = (m & -m).bit_length() - 1
+                high = m.bit_length() - 1
+                gaps += (high - low + 1) - bin(m).count("1")
+        return gaps
+
+    def parse_week(self, value):
+        """Week number of a label or number ('' for every week), or None if unknown."""
+        value = str(value or "").strip()
+        if not value or value == "0":
+            return 0
+        if value in self.week_index:
+            return self.week_index[value]
+        if value.isdigit() and int(value) <= len(self.weeks):
+            return int(value)
+        return None
+
+    def fits_block(self, slot_index, duration):
+        """Whether ``duration`` periods from ``slot_index`` stay inside one teaching block."""
+        run = ((1 << duration) - 1) << slot_index
+        return any(run & segment == run for segment in self.segments)
+
+    def run_starts(self, duration):
+        """Mask over the rotation of every period a ``duration``-period block may start in."""
+        starts = self._run_starts.get(duration)
+        if starts is None:
+            day = 0
+            for s in range(self.slots_per_day):
+                if self.fits_block(s, duration):
+                    day |= 1 << s
+            starts = sum(day << (d * self.slots_per_day) for d in range(self.cycle_days))
+            self._run_starts[duration] = starts
+        return starts
+
+    def block_starts(self, free, duration=1):
+        """Start bits of every run of ``duration`` free periods in ``free`` that crosses no break.
+
+        Shift-and-AND over the whole rotation at once: bit b survives only if
+        bits b .. b + duration - 1 are all free, and the precomputed start mask
+        drops runs that would span a break or the end of a day.
+        """
+        starts = free & self.run_starts(duration)
+        for k in range(1, duration):
+            starts &= free >> k
+        return starts
+
+    def index_mask(self, day_index, slot_index, week=0, duration=1):
+        run = ((1 << duration) - 1) << (day_index * self.slots_per_day + slot_index)
+        if week:
+            return run << ((week - 1) * len(self.days) * self.slots_per_day)
+        # Copies of the run a week apart; they cannot overlap since a run is shorter than a week
+        return self.every_week * run
+
+    def mask(self, day, time, week=0, duration=1):
+        """Bits a (day, time, week) booking of ``duration`` periods occupies, or 0 if it is not on this calendar."""
+        d = self.day_index.get(day)
+        t = self.slot_index.get(time)
+        if d is None or t is None or not 0 <= (week or 0) <= len(self.weeks):
+            return 0
+        if duration > 1 and not self.fits_block(t, duration):
+            return 0
+        return self.index_mask(d, t, week or 0, duration)
+
+    def project(self, mask, other):
+        """The periods of calendar ``other`` that overlap the periods in ``mask``, a mask on this calendar.
+
+        Staff and rooms are shared between calendars, so their bookings on
+        one calendar are checked and shown on another through this. Days are
+        matched by name and periods by wall-clock time (by label when either
+        is not a "h:mm - h:mm" range). Rotation weeks line up one to one when
+        both calendars have as many; otherwise a booking covers every week
+        of ``other`` it could fall in.
+        """
+        if other.id == self.id:
+            return mask
+        table = self._projections.get(other)
+        if table is None:
+            table = self._projections[other] = [self._project_bit(bit, other) for bit in range(self.week_bits)]
+        projected = 0
+        while mask:
+            low = mask & -mask
+            projected |= table[low.bit_length() - 1]
+            mask ^= low
+        return projected
+
+    def _project_bit(self, bit, other):
+        day, slot = divmod(bit, self.slots_per_day)
+        week, day = divmod(day, len(self.days))
+        d = other.day_index.get(self.days[day])
+        if d is None:
+            return 0
+        here = self.slot_times[slot]
+        slots = 0
+        for s, there in enumerate(other.slot_times):
+            if here and there:
+                overlaps = here[0] < there[1] and there[0] < here[1]
+            else:
+                overlaps = self.time_slots[slot] == other.time_slots[s]
+            if overlaps:
+                slots |= 1 << s
+        if not other.weeks:
+            weeks = [0]
+        elif len(self.weeks) == len(other.weeks):
+            weeks = [week]
+        else:
+            weeks = range(len(other.weeks))
+        return sum(slots << ((w * len(other.days) + d) * other.slots_per_day) for w in weeks)
+
+    def bit_slot(self, bit):
+        """(day, time, week) of a bit; week is 0 on a calendar without rotation."""
+        day, slot = divmod(bit, self.slots_per_day)
+        week, day = divmod(day, len(self.days))
+        return self.days[day], self.time_slots[slot], week + 1 if self.weeks else 0
+
+    def day_cost(self, mask):
+        """Gap and load penalty of a mask, summed over the days of the rotation."""
+        cost = 0
+        for d in range(self.cycle_days):
+            m = (mask >> (d * self.slots_per_day)) & self.day_bits
+            cost += GAP_WEIGHT * self.day_gaps[m] + DAY_LOAD_WEIGHT * self.day_popcount[m] * (self.day_popcount[m] - 1) // 2
+        return cost
+
+    def spread_cost(self, mask):
+        cost = 0
+        for d in range(self.cycle_days):
+            n = self.day_popcount[(mask >> (d * self.slots_per_day)) & self.day_bits]
+            cost += SPREAD_WEIGHT * n * (n - 1) // 2
+        return cost
+
+    def empty_schedule(self, value=""):
+        return {d: {t: value for t in self.time_slots} for d in self.day_labels}
+
+DEFAULT_CALENDAR = Calendar(
+    DEFAULT_CALENDAR_ID, "Default", days, time_slots,
+    pauses={time_slots.index(BREAK_AFTER_SLOT): "BREAK", time_slots.index(LUNCH_AFTER_SLOT): "LUNCH"},
+)
+def row_week(row):
+    """Rotation week of a timetable row; rows built before calendars had none."""
+    return (row["week"] or 0) if "week" in row.keys() else 0
+
+def row_duration(row):
+    """Number of periods a timetable row covers (1 unless it is a block)."""
+    return (row["duration"] or 1) if "duration" in row.keys() else 1
+
+def parse_duration(value):
+    """Block length from a form or file field ('' for one period), or None if it is not a sensible number."""
+    value = str(value or "").strip()
+    if not value:
+        return 1
+    if not value.isdigit() or not 1 <= int(value) <= MAX_SLOTS_PER_DAY:
+        return None
+    return int(value)
+
+def read_calendar_revision(db):
+    return db.execute("SELECT value FROM timetable_meta WHERE key = 'calendars'").fetchone()[0]
+
+class CalendarRegistry:
+    """Every calendar in the database, compiled once and reused until one changes.
+
+    Triggers bump the 'calendars' counter on any calendar edit or class
+    reassignment; each lookup compares it and recompiles only then.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.revision = None
+        self.by_id = {DEFAULT_CALENDAR_ID: DEFAULT_CALENDAR}
+        self.class_calendars = {}
+
+    def _reload(self, db, revision):
+        specs = {cid: (name, [], [], {}, []) for cid, name in db.execute("SELECT id, name FROM calendars")}
+        for cid, name in db.execute("SELECT calendar_id, name FROM calendar_days ORDER BY calendar_id, idx"):
+            specs[cid][1].append(name)
+        for cid, idx, label, pause in db.execute("SELECT calendar_id, idx, label, pause FROM calendar_slots ORDER BY calendar_id, idx"):
+            specs[cid][2].append(label)
+            if pause:
+                specs[cid][3][idx] = pause
+        for cid, label in db.execute("SELECT calendar_id, label FROM calendar_weeks ORDER BY calendar_id, idx"):
+            specs[cid][4].append(label)
+        self.by_id = {cid: Calendar(cid, *spec) for cid, spec in specs.items()}
+        # Only classes off the default calendar are listed
+        self.class_calendars = {
+            (department, year, semester): cid
+            for department, year, semester, cid in db.execute(
+                "SELECT department, year, semester, calendar_id FROM classes WHERE calendar_id != ?", (DEFAULT_CALENDAR_ID,))
+        }
+        self.revision = revision
+
+    def sync(self, db):
+        revision = read_calendar_revision(db)
+        if revision != self.revision:
+            with self._lock:
+                if revision != self.revision:
+                    self._reload(db, revision)
+        return self
+
+    def get(self, db, calendar_id=DEFAULT_CALENDAR_ID):
+        self.sync(db)
+        return self.by_id.get(calendar_id) or self.by_id[DEFAULT_CALENDAR_ID]
+
+    def for_class(self, db, cls):
+        self.sync(db)
+        return self.class_calendar(cls)
+
+    def class_calendar(self, cls):
+        """for_class() without the revision check, for loops after one sync()."""
+        return self.by_id[self.class_calendars.get(tuple(v or "" for v in cls), DEFAULT_CALENDAR_ID)]
+
+    def for_entity(self, db, mode, key):
+        """Calendar a class, staff member or room is shown on.
+
+        A staff member or room may teach on several calendars; their grid is
+        laid out on the one most of their sessions are on, and sessions on
+        the others are placed at the periods they overlap (see
+        Calendar.project()).
+        """
+        if mode == "dept":
+            return self.for_class(db, key)
+        column = "room" if mode == "room" else "staff_name"
+        row = db.execute(f"SELECT calendar_id FROM timetable WHERE {column} = ? GROUP BY calendar_id ORDER BY COUNT(*) DESC, calendar_id LIMIT 1",
+                         (key,)).fetchone()
+        return self.get(db, row[0] if row else DEFAULT_CALENDAR_ID)
+
+    def main_calendars(self, db, mode):
+        """{name: calendar id} of every staff member ('staff') or room ('room'), as for_entity() picks it."""
+        table, column = ("rooms", "room_id") if mode == "room" else ("staff", "staff_id")
+        found = {}
+        for name, calendar_id, _ in db.execute(f"""
+            SELECT e.name, c.calendar_id, COUNT(*) AS n FROM sessions s
+            JOIN {table} e ON e.id = s.{column} JOIN classes c ON c.id = s.class_id
+            WHERE s.{column} != 0 GROUP BY s.{column}, c.calendar_id ORDER BY n DESC, c.calendar_id
+        """):
+            found.setdefault(name, calendar_id)
+        return found
+
+    def all_labels(self, db):
+        """Day names and period labels of every calendar, for entry forms."""
+        self.sync(db)
+        day_names, slot_labels = [], []
+        for calendar in self.by_id.values():
+            day_names += [d for d in calendar.days if d not in day_names]
+            slot_labels += [t for t in calendar.time_slots if t not in slot_labels]
+        return day_names, slot_labels
+
+    def longest_day(self, db):
+        """Most periods in a day on any calendar: the longest block an entry form can ask for."""
+        self.sync(db)
+        return max(calendar.slots_per_day for calendar in self.by_id.values())
+
+calendar_registry = CalendarRegistry()
+
+# Lookup tables hold one entry per possible day pattern (2 ** periods)
+MAX_SLOTS_PER_DAY = 16
+
+def save_calendar(db, spec):
+    """Create or replace a calendar and move classes onto it; returns its id.
+
+    ``spec`` is a dict with name, days (names), slots (labels, or
+    {"label", "pause"} dicts where pause names the break after that period),
+    optional weeks (rotation week labels) and optional classes
+    ([department, year, semester] lists). Editing an existing calendar keeps
+    sessions at the same day / period positions; a class that moves from
+    another calendar keeps its sessions at the same day and period names.
+    Raises ValueError if the calendar is invalid or the sessions do not fit.
+    """
+    name = str(spec.get("name") or "").strip()
+    day_names = [str(d).strip() for d in spec.get("days") or []]
+    slot_labels, pauses = [], {}
+    for i, slot in enumerate(spec.get("slots") or []):
+        if isinstance(slot, dict):
+            slot_labels.append(str(slot.get("label") or "").strip())
+            if slot.get("pause"):
+                pauses[i] = str(slot["pause"]).strip()
+        else:
+            slot_labels.append(str(slot).strip())
+    weeks = [str(w).strip() for w in spec.get("weeks") or []]
+    if not name:
+        raise ValueError("Calendar name is missing")
+    for label, values in (("days", day_names), ("slots", slot_labels), ("weeks", weeks)):
+        if "" in values or len(set(values)) != len(values):
+            raise ValueError(f"Calendar {label} must be unique and non-empty")
+    if not day_names or not slot_labels:
+        raise ValueError("A calendar needs at least one day and one slot")
+    if len(slot_labels) > MAX_SLOTS_PER_DAY:
+        raise ValueError(f"A calendar can have at most {MAX_SLOTS_PER_DAY} slots per day")
+    if len(weeks) == 1:
+        raise ValueError("A rotation needs at least two weeks")
+
+    try:
+        row = db.execute("SELECT id FROM calendars WHERE name = ?", (name,)).fetchone()
+        if row:
+            calendar_id = row[0]
+            used = db.execute("""
+                SELECT MAX(s.day), MAX(s.slot), MAX(s.week) FROM sessions s JOIN classes c ON c.id = s.class_id
+                WHERE c.calendar_id = ?
+            """, (calendar_id,)).fetchone()
+            if used[0] is not None and (used[0] >= len(day_names) or used[1] >= len(slot_labels) or used[2] > len(weeks)):
+                raise ValueError(f"Calendar {name} has sessions outside the new days, slots or weeks")
+            for table in ("calendar_days", "calendar_slots", "calendar_weeks"):
+                db.execute(f"DELETE FROM {table} WHERE calendar_id = ?", (calendar_id,))
+        else:
+            calendar_id = db.execute("INSERT INTO calendars (name) VALUES (?)", (name,)).lastrowid
+        db.executemany("INSERT INTO calendar_days (calendar_id, idx, name) VALUES (?, ?, ?)",
+                       [(calendar_id, i, d) for i, d in enumerate(day_names)])
+        db.executemany("INSERT INTO calendar_slots (calendar_id, idx, label, pause) VALUES (?, ?, ?, ?)",
+                       [(calendar_id, i, t, pauses.get(i, "")) for i, t in enumerate(slot_labels)])
+        db.executemany("INSERT INTO calendar_weeks (calendar_id, idx, label) VALUES (?, ?, ?)",
+                       [(calendar_id, i, w) for i, w in enumerate(weeks, start=1)])
+
+        for department, year, semester in spec.get("classes") or []:
+            db.execute("INSERT OR IGNORE INTO classes (department, year, semester) VALUES (?, ?, ?)", (department, year, semester))
+            class_id, old_id = db.execute(
+                "SELECT id, calendar_id FROM classes WHERE department = ? AND year = ? AND semester = ?",
+                (department, year, semester)).fetchone()
+            if old_id == calendar_id:
+                continue
+            if not weeks and db.execute("SELECT 1 FROM sessions WHERE class_id = ? AND week != 0", (class_id,)).fetchone():
+                raise ValueError(f"Class {department} {year} {semester} has rotation-week sessions; {name} has no rotation")
+            # Re-point the class's sessions at the same day and period names on the new calendar
+            db.execute("""
+                UPDATE sessions SET
+                    day = (SELECT n.idx FROM calendar_days o JOIN calendar_days n ON n.calendar_id = :new AND n.name = o.name
+                           WHERE o.calendar_id = :old AND o.idx = sessions.day),
+                    slot = (SELECT n.idx FROM calendar_slots o JOIN calendar_slots n ON n.calendar_id = :new AND n.label = o.label
+                            WHERE o.calendar_id = :old AND o.idx = sessions.slot)
+                WHERE class_id = :class_id
+            """, {"new": calendar_id, "old": old_id, "class_id": class_id})
+            db.execute("UPDATE classes SET calendar_id = ? WHERE id = ?", (calendar_id, class_id))
+        # Blocks must still be consecutive periods between two breaks
+        calendar = Calendar(calendar_id, name, day_names, slot_labels, pauses, weeks)
+        blocks = db.execute("""
+            SELECT DISTINCT s.slot, s.duration FROM sessions s JOIN classes c ON c.id = s.class_id
+            WHERE c.calendar_id = ? AND s.duration > 1
+        """, (calendar_id,))
+        for slot, duration in blocks:
+            if slot is not None and not calendar.fits_block(slot, duration):
+                raise ValueError(f"A {duration}-period session from {slot_labels[slot]} would run into a break or past the last period of {name}")
+        db.commit()
+    except sqlite3.IntegrityError as e:
+        db.rollback()
+        raise ValueError(f"Sessions do not fit calendar {name}: {e}")
+    except ValueError:
+        db.rollback()
+        raise
+    return calendar_id
+
+def class_key(department, year, semester):
+    return (department, year, semester)
+
+def empty_occupancy():
+    return {"staff": {}, "class": {}, "room": {}}
+
+def read_revision(db):
+    """Current value of the table-wide change counter."""
+    return db.execute("SELECT value FROM timetable_meta WHERE key = 'revision'").fetchone()[0]
+
+def read_database_id(db):
+    """Random id of this database, new whenever it is recreated."""
+    return db.execute("SELECT value FROM timetable_meta WHERE key = 'database_id'").fetchone()[0]
+
+# Staff members and rooms can be booked on several calendars, whose bits mean
+# different periods, so their busy masks are kept per calendar as
+# {calendar id: mask} and only combined on one calendar's layout when
+# checked; a class is always on one calendar and has a plain mask.
+def busy_on(masks, calendar):
+    """The periods of ``calendar`` that per-calendar masks ({calendar id: mask}) are busy in."""
+    busy = 0
+    for calendar_id, mask in masks.items():
+        if calendar_id == calendar.id:
+            busy |= mask
+        elif mask:
+            busy |= calendar_registry.by_id.get(calendar_id, DEFAULT_CALENDAR).project(mask, calendar)
+    return busy
+
+def book_on(masks, calendar, flag, on=True):
+    """A copy of per-calendar masks with ``flag``, a mask on ``calendar``, booked (or freed with on=False)."""
+    masks = dict(masks)
+    mask = masks.get(calendar.id, 0)
+    masks[calendar.id] = mask | flag if on else mask & ~flag
+    return masks
+
+def book_row(occupancy, row, calendar, flag):
+    """Book ``flag``, a mask on ``calendar``, for the staff member, class and room of ``row``.
+
+    ``occupancy`` is load_occupancy()-shaped and is updated in place; the
+    return value lists what was already busy in those periods.
+    """
+    cls = class_key(row["department"], row.get("year", ""), row.get("semester", ""))
+    staff, classes, rooms = occupancy["staff"], occupancy["class"], occupancy["room"]
+    clashes = []
+    if busy_on(staff.get(row["staff_name"], {}), calendar) & flag:
+        clashes.append("staff")
+    if classes.get(cls, 0) & flag:
+        clashes.append("class")
+    if row.get("room") and busy_on(rooms.get(row["room"], {}), calendar) & flag:
+        clashes.append("room")
+    staff[row["staff_name"]] = book_on(staff.get(row["staff_name"], {}), calendar, flag)
+    classes[cls] = classes.get(cls, 0) | flag
+    if row.get("room"):
+        rooms[row["room"]] = book_on(rooms.get(row["room"], {}), calendar, flag)
+    return clashes
+
+class OccupancyIndex:
+    """Process-wide busy masks for every staff member, class and room.
+
+    Loaded from the table once and then kept current by commit_timetable(),
+    so conflict checks and free-slot queries are bitwise operations instead of
+    queries. The revision counter maintained by triggers is checked on each
+    use; if another process (or a write this process did not record) changed
+    the table, the index reloads itself. Staff and room masks are kept per
+    calendar (see busy_on()); the dicts are replaced, never changed in place.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.revision = None
+        self.staff = {}
+        self.classes = {}
+        self.rooms = {}
+
+    def _reload(self, db):
+        staff, classes, rooms = {}, {}, {}
+        revision = read_revision(db)
+        # Build masks on the integer ids and translate to names once per entity
+        staff_ids, class_ids, room_ids = {}, {}, {}
+        calendars = calendar_registry.sync(db).by_id
+        sessions = db.execute("""
+            SELECT s.staff_id, s.class_id, s.room_id, s.day, s.slot, s.week, s.duration, c.calendar_id
+            FROM sessions s JOIN classes c ON c.id = s.class_id
+        """)
+        for staff_id, class_id, room_id, day, slot, week, duration, calendar_id in sessions:
+            calendar = calendars.get(calendar_id, DEFAULT_CALENDAR)
+            flag = calendar.index_mask(day, slot, week, duration)
+            masks = staff_ids.setdefault(staff_id, {})
+            masks[calendar.id] = masks.get(calendar.id, 0) | flag
+            class_ids[class_id] = class_ids.get(class_id, 0) | flag
+            if room_id:
+                masks = room_ids.setdefault(room_id, {})
+                masks[calendar.id] = masks.get(calendar.id, 0) | flag
+        for staff_id, name in db.execute("SELECT id, name FROM staff"):
+            if staff_id in staff_ids:
+                staff[name] = staff_ids[staff_id]
+        for class_id, department, year, semester in db.execute("SELECT id, department, year, semester FROM classes"):
+            if class_id in class_ids:
+                classes[(department, year, semester)] = class_ids[class_id]
+        for room_id, name in db.execute("SELECT id, name FROM rooms"):
+            if room_id in room_ids:
+                rooms[name] = room_ids[room_id]
+        self.staff, self.classes, self.rooms = staff, classes, rooms
+        self.revision = revision
+
+    def sync(self, db):
+        """Reload if the table changed since the index last saw it."""
+        revision = read_revision(db)
+        if revision != self.revision:
+            with self._lock:
+                if revision != self.revision:
+                    self._reload(db)
+        return self
+
+    def _refresh_keys(self, db, rows):
+        # Recompute masks for the keys a deleted row touched; a legacy double
+        # booking may still hold the same slot through another row
+        keys = {(row["staff_name"], (row["department"], row["year"], row["semester"]), row["room"]) for row in rows}
+        fresh = load_occupancy_from_db(
+            db,
+            staff_names=[k[0] for k in keys],
+            class_keys=[k[1] for k in keys],
+            room_names=[k[2] for k in keys],
+        )
+        # Keys left with nothing booked are dropped, as a reload would
+        for masks, kind in ((self.staff, "staff"), (self.classes, "class"), (self.rooms, "room")):
+            for key, mask in fresh[kind].items():
+                if mask:
+                    masks[key] = mask
+                else:
+                    masks.pop(key, None)
+
+    def apply(self, db, revision, changes, added=(), removed=()):
+        """Fold a committed write into the index.
+
+        ``revision`` is the counter read inside the write transaction and
+        ``changes`` the number of rows it touched; if the index was not at
+        ``revision - changes`` it missed someone else's write and is dropped
+        so the next sync() reloads it.
+        """
+        with self._lock:
+            if self.revision is None or self.revision != revision - changes:
+                self.revision = None
+                return
+            if removed:
+                self._refresh_keys(db, removed)
+            calendar_registry.sync(db)
+            for row in added:
+                cls = (row["department"], row["year"], row["semester"])
+                calendar = calendar_registry.class_calendar(cls)
+                flag = calendar.mask(row["day"], row["time"], row_week(row), row_duration(row))
+                if not flag:
+                    continue
+                self.staff[row["staff_name"]] = book_on(self.staff.get(row["staff_name"], {}), calendar, flag)
+                self.classes[cls] = self.classes.get(cls, 0) | flag
+                if row["room"]:
+                    self.rooms[row["room"]] = book_on(self.rooms.get(row["room"], {}), calendar, flag)
+            self.revision = revision
+
+    def busy_mask(self, db, staff_name=None, cls=None, room=None, calendar=DEFAULT_CALENDAR):
+        """Union of the busy masks of the given staff member, class and room, on ``calendar``."""
+        self.sync(db)
+        calendar_registry.sync(db)
+        mask = 0
+        if staff_name:
+            mask |= busy_on(self.staff.get(staff_name, {}), calendar)
+        if cls:
+            mask |= calendar_registry.class_calendar(cls).project(self.classes.get(cls, 0), calendar)
+        if room:
+            mask |= busy_on(self.rooms.get(room, {}), calendar)
+        return mask
+
+    def free_mask(self, db, staff_name=None, cls=None, room=None, calendar=DEFAULT_CALENDAR):
+        return calendar.full_week & ~self.busy_mask(db, staff_name, cls, room, calendar)
+
+    def conflicts(self, db, staff_name, cls, room, day, time, week=0, duration=1):
+        """Which of staff / class / room are already booked in the ``duration`` periods from (day, time) on the class's calendar."""
+        calendar = calendar_registry.for_class(db, cls)
+        flag = calendar.mask(day, time, week, duration)
+        if not flag:
+            return []
+        self.sync(db)
+        found = []
+        if busy_on(self.staff.get(staff_name, {}), calendar) & flag:
+            found.append("staff")
+        if self.classes.get(cls, 0) & flag:
+            found.append("class")
+        if room and busy_on(self.rooms.get(room, {}), calendar) & flag:
+            found.append("room")
+        return found
+
+    def snapshot(self, db, staff_names=(), class_keys=(), room_names=()):
+        """Busy masks for the given entities; staff and rooms per calendar (see busy_on())."""
+        self.sync(db)
+        with self._lock:
+            return {
+                "staff": {s: self.staff.get(s, {}) for s in set(staff_names)},
+                "class": {c: self.classes.get(c, 0) for c in set(class_keys)},
+                "room": {r: self.rooms.get(r, {}) for r in set(room_names) if r},
+            }
+
+occupancy_index = OccupancyIndex()
+
+def entity_name(mode, key):
+    """Revision-table name of a class ('dept' mode, key (department, year, semester)), staff member or room."""
+    if mode == "dept":
+        return "class:" + "|".join(v or "" for v in key)
+    return f"{mode}:{key}"
+
+def entity_revision(db, mode, key):
+    row = db.execute("SELECT revision FROM timetable_revisions WHERE entity = ?", (entity_name(mode, key),)).fetchone()
+    return row[0] if row else 0
+
+# Schedule grids
+#
+# One class or staff timetable as a flat array over the week: cells[bit] is an
+# index into entries (or -1 for a free period), with bits laid out like the
+# occupancy masks. The dashboard, check-slots page and both exporters all read
+# the same grid, which is cached per (mode, key) until that timetable changes.
+# A staff grid is laid out on one calendar; entries from classes on other
+# calendars fill the periods they overlap, and an entry with no period on the
+# grid (its day is not on that calendar) is listed in ``hidden`` so views can
+# say so.
+GRID_COLUMNS = ["id", "staff_name", "department", "year", "semester", "subject", "room", "day", "time", "week", "duration"]
+
+class TimetableGrid:
+    __slots__ = ("mode", "key", "calendar", "entries", "cells", "hidden")
+
+    def __init__(self, mode, key, rows, calendar=DEFAULT_CALENDAR, calendars=None):
+        self.mode = mode
+        self.key = key
+        self.calendar = calendar
+        self.entries = []
+        self.cells = [-1] * calendar.week_bits
+        self.hidden = []
+        calendars = calendars or calendar_registry.by_id
+        for row in rows:
+            # Rows carry their class's calendar_id when read through fetch_grid_rows()
+            source = calendar
+            if "calendar_id" in row.keys() and row["calendar_id"] != calendar.id:
+                source = calendars.get(row["calendar_id"], calendar)
+            mask = source.project(source.mask(row["day"], row["time"], row_week(row), row_duration(row)), calendar)
+            if not mask:
+                self.hidden.append({column: row[column] for column in GRID_COLUMNS})
+                continue
+            # A legacy double booking keeps the last row, as the old grids did
+            index = len(self.entries)
+            self.entries.append({column: row[column] for column in GRID_COLUMNS})
+            while mask:
+                low = mask & -mask
+                self.cells[low.bit_length() - 1] = index
+                mask ^= low
+
+    def at(self, day_index, slot_index):
+        """Entry in a period; day_index counts days of the whole rotation."""
+        i = self.cells[day_index * self.calendar.slots_per_day + slot_index]
+        return self.entries[i] if i >= 0 else None
+
+    def schedule(self):
+        """Nested {day: {time: entry or None}} view for templates."""
+        return {
+            d: {t: self.at(di, ti) for ti, t in enumerate(self.calendar.time_slots)}
+            for di, d in enumerate(self.calendar.day_labels)
+        }
+
+def fetch_grid_rows(db, mode, key):
+    columns = ", ".join(GRID_COLUMNS + ["calendar_id"])
+    if mode == 'dept':
+        return db.execute(f"SELECT {columns} FROM timetable WHERE department=? AND year=? AND semester=?", key).fetchall()
+    return db.execute(f"SELECT {columns} FROM timetable WHERE staff_name=?", (key,)).fetchall()
+
+class GridCache:
+    """LRU of TimetableGrid objects tagged with their entity revision."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._grids = OrderedDict()
+
+    def get(self, db, mode, key):
+        revision = (entity_revision(db, mode, key), read_calendar_revision(db))
+        name = entity_name(mode, key)
+        with self._lock:
+            hit = self._grids.get(name)
+            if hit is not None and hit[0] == revision:
+                self._grids.move_to_end(name)
+                return hit[1]
+        calendar = calendar_registry.for_entity(db, mode, key)
+        grid = TimetableGrid(mode, key, fetch_grid_rows(db, mode, key), calendar)
+        with self._lock:
+            self._grids[name] = (revision, grid)
+            self._grids.move_to_end(name)
+            while len(self._grids) > self.max_entries:
+                self._grids.popitem(last=False)
+        return grid
+
+    def invalidate(self, entities):
+        with self._lock:
+            for entity in entities:
+                self._grids.pop(entity, None)
+
+grid_cache = GridCache()
+
+def get_grid(db, mode, key):
+    """Cached grid of a class ('dept', (department, year, semester)) or staff ('staff', name) timetable."""
+    return grid_cache.get(db, mode, key)
+
+def row_entities(row):
+    """Entity names a timetable row belongs to."""
+    entities = [
+        entity_name("staff", row["staff_name"]),
+        entity_name("dept", (row["department"], row["year"], row["semester"])),
+    ]
+    if row["room"]:
+        entities.append(entity_name("room", row["room"]))
+    return entities
+
+# Change feed: live views (the dashboard grid, check slots) follow the
+# timetable_changes log instead of reloading. Each change becomes a small
+# delta naming the entry and the grid cells it covers; a client resumes from
+# the last sequence number it saw, and is told to reload instead when that
+# point has been trimmed from the log or too much has changed since.
+CHANGE_LOG_KEEP = 10000       # log rows kept; older ones are trimmed as new ones arrive
+CHANGE_BATCH_LIMIT = 500      # more pending changes than this and the client reloads instead
+CHANGE_POLL_SECONDS = 1.0     # how often a stream looks for writes made by other processes
+CHANGE_RETRY_MS = 3000        # how soon the browser reconnects once a stream has ended
+
+class ChangeFeed:
+    """Reads the change log for live views and wakes their streams when this process commits."""
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self._changed:
+            self.generation += 1
+            self._changed.notify_all()
+
+    def wait(self, generation, timeout=CHANGE_POLL_SECONDS):
+        """Block until a commit after ``generation`` or ``timeout``; returns the current generation."""
+        with self._changed:
+            if self.generation == generation:
+                self._changed.wait(timeout)
+            return self.generation
+
+    def bounds(self, db):
+        """(oldest, newest) sequence number in the log; (0, 0) if nothing was ever logged."""
+        oldest, newest = db.execute(
+            "SELECT (SELECT MIN(seq) FROM timetable_changes), (SELECT MAX(seq) FROM timetable_changes)"
+        ).fetchone()
+        return oldest or 0, newest or 0
+
+    def trim(self, db):
+        """Drop old log rows, in batches so a busy log is not rewritten on every commit."""
+        oldest, newest = self.bounds(db)
+        if newest - oldest >= 2 * CHANGE_LOG_KEEP:
+            db.execute("DELETE FROM timetable_changes WHERE seq <= ?", (newest - CHANGE_LOG_KEEP,))
+
+    def read(self, db, since, mode=None, key=None):
+        """Deltas after ``since`` for one class ('dept') or staff timetable, or all of them.
+
+        Returns (deltas, newest), or (None, newest) when the client has to
+        reload: its position was trimmed away (or is from another database),
+        or more than CHANGE_BATCH_LIMIT changes are pending. Cells are
+        [day row, period] of the grid the client shows, laid out like
+        TimetableGrid.
+        """
+        oldest, newest = self.bounds(db)
+        if since > newest or since < oldest - 1:
+            return None, newest
+        if since == newest:
+            return [], newest
+        where, params = "", []
+        if mode == "dept":
+            where, params = " AND cl.department = ? AND cl.year = ? AND cl.semester = ?", list(key)
+        elif mode == "staff":
+            where, params = " AND st.name = ?", [key]
+        rows = db.execute(f"""
+            SELECT c.seq, c.op, c.session_id, st.name, cl.department, cl.year, cl.semester, cl.calendar_id, r.name,
+                   c.subject, c.day, c.slot, c.week, c.duration, c.version
+            FROM timetable_changes c
+            JOIN staff st ON st.id = c.staff_id
+            JOIN classes cl ON cl.id = c.class_id
+            JOIN rooms r ON r.id = c.room_id
+            WHERE c.seq > ? AND c.seq <= ?{where}
+            ORDER BY c.seq LIMIT ?
+        """, [since, newest] + params + [CHANGE_BATCH_LIMIT + 1]).fetchall()
+        if len(rows) > CHANGE_BATCH_LIMIT:
+            return None, newest
+        calendars = calendar_registry.sync(db).by_id
+        view = calendar_registry.for_entity(db, mode, key) if mode else None
+        deltas = []
+        for (seq, op, entry_id, staff_name, department, year, semester, calendar_id, room,
+             subject, day, slot, week, duration, version) in rows:
+            calendar = calendars.get(calendar_id, DEFAULT_CALENDAR)
+            delta = {
+                "seq": seq, "op": op, "id": entry_id, "version": version,
+                "staff_name": staff_name, "department": department, "year": year, "semester": semester,
+                "subject": subject, "room": room, "day": calendar.days[day], "time": calendar.time_slots[slot],
+                "week": calendar.weeks[week - 1] if week else "", "duration": duration,
+            }
+            grid = view or calendar
+            # A staff grid is laid out on the staff member's calendar; an entry on another one fills the periods it overlaps
+            mask = calendar.project(calendar.index_mask(day, slot, week, duration), grid)
+            cells = []
+            while mask:
+                low = mask & -mask
+                cells.append(list(divmod(low.bit_length() - 1, grid.slots_per_day)))
+                mask ^= low
+            delta["cells"] = cells
+            deltas.append(delta)
+        return deltas, newest
+
+change_feed = ChangeFeed()
+
+def commit_timetable(db, added=(), removed=(), updated=()):
+    """Commit the pending timetable write and record it in the occupancy index.
+
+    ``added`` and ``removed`` are the inserted and deleted rows; ``updated``
+    holds (old_row, new_row) pairs. Rows are mappings with staff_name,
+    department, year, semester, room, day and time.
+    """
+    revision = read_revision(db)
+    change_feed.trim(db)
+    db.commit()
+    change_feed.notify()
+    removed = list(removed) + [old for old, _ in updated]
+    added = list(added) + [new for _, new in updated]
+    occupancy_index.apply(db, revision, len(added) + len(removed) - len(updated), added, removed)
+    touched = {entity for row in added + removed for entity in row_entities(row)}
+    grid_cache.invalidate(touched)
+    export_cache.invalidate(touched)
+    api_cache.invalidate()
+
+def load_occupancy(db, staff_names=(), class_keys=(), room_names=()):
+    """Weekly busy masks for the given staff, classes and rooms; staff and rooms per calendar (see busy_on())."""
+    return occupancy_index.snapshot(db, staff_names, class_keys, room_names)
+
+def occupancy_on(occupancy, calendar):
+    """load_occupancy() masks laid out on ``calendar``, the shape solve_timetable() expects."""
+    return {
+        "staff": {s: busy_on(masks, calendar) for s, masks in occupancy["staff"].items()},
+        "class": {c: calendar_registry.class_calendar(c).project(mask, calendar) for c, mask in occupancy["class"].items()},
+        "room": {r: busy_on(masks, calendar) for r, masks in occupancy["room"].items()},
+    }
+
+def load_occupancy_from_db(db, staff_names=(), class_keys=(), room_names=(), exclude_ids=()):
+    """Same as load_occupancy() but read straight from the table, leaving out the rows in ``exclude_ids``."""
+    occupancy = empty_occupancy()
+    exclude_ids = list(exclude_ids)
+    exclude = f" AND id NOT IN ({', '.join('?' * len(exclude_ids))})" if exclude_ids else ""
+    queries = [
+        ("staff", "SELECT day, time, week, duration, calendar_id FROM timetable WHERE staff_name=?", [(s,) for s in set(staff_names)]),
+        ("class", "SELECT day, time, week, duration, calendar_id FROM timetable WHERE department=? AND year=? AND semester=?", list(set(class_keys))),
+        ("room", "SELECT day, time, week, duration, calendar_id FROM timetable WHERE room=?", [(r,) for r in set(room_names) if r]),
+    ]
+    calendars = calendar_registry.sync(db).by_id
+    for kind, sql, keys in queries:
+        found = occupancy[kind]
+        for params in keys:
+            key = params[0] if kind != "class" else tuple(params)
+            masks = {}
+            for row in db.execute(sql + exclude, tuple(params) + tuple(exclude_ids)):
+                calendar = calendars.get(row["calendar_id"], DEFAULT_CALENDAR)
+                masks[calendar.id] = masks.get(calendar.id, 0) | calendar.mask(row["day"], row["time"], row["week"], row["duration"])
+            # A class is on one calendar
+            found[key] = sum(masks.values()) if kind == "class" else masks
+    return occupancy
+
+def solve_timetable(requirements, rooms=None, occupancy=None, time_budget=5.0, seed=0, calendar=DEFAULT_CALENDAR):
+    """Place a batch of teaching requirements into a conflict-free weekly timetable.
+
+    Each requirement is a dict with staff_name, department, year, semester,
+    subject and hours (periods per week), plus an optional room_type that is
+    looked up in ``rooms`` ({room_type: [room, ...]}), a list of candidate
+    rooms in order of preference or a fixed room, and an
+    optional duration: the hours are then booked as blocks of that many
+    consecutive periods that do not cross a break.
+    ``occupancy`` holds bookings that must be kept (see load_occupancy()).
+    All classes are placed on ``calendar``; with rotation weeks, hours count
+    periods per rotation.
+
+    Sessions are placed most-constrained first into the cheapest free slot,
+    blocked sessions are repaired by moving one clashing session elsewhere,
+    and the remaining time budget is spent on local search that moves single
+    sessions to lower the gap / spread / day-load cost.
+
+    Returns {"assignments", "unplaced", "cost", "elapsed"}; assignments carry
+    the requirement fields plus day, time, week, duration and room.
+    """
+    started = perf_counter()
+    deadline = started + time_budget
+    rng = random.Random(seed)
+    rooms = rooms or {}
+    occupancy = occupancy or empty_occupancy()
+    slots_per_day, day_bits = calendar.slots_per_day, calendar.day_bits
+    day_gaps, day_popcount = calendar.day_gaps, calendar.day_popcount
+
+    staff_occ = dict(occupancy["staff"])
+    class_occ = dict(occupancy["class"])
+    room_occ = dict(occupancy["room"])
+    subject_occ = {}
+    # (kind, key, bit) -> session index for bookings made by this run; fixed
+    # bookings have no owner and can never be moved
+    owner = {}
+
+    sessions = []
+    for req in requirements:
+        hours = int(req.get("hours", 1) or 0)
+        cls = class_key(req["department"], req.get("year", ""), req.get("semester", ""))
+        if req.get("room"):
+            candidates = (req["room"],)
+        elif req.get("rooms"):
+            candidates = tuple(req["rooms"])
+        elif req.get("room_type"):
+            candidates = tuple(rooms.get(req["room_type"], ()))
+        else:
+            candidates = ()
+        duration = max(1, int(req.get("duration", 1) or 1))
+        while hours > 0:
+            length = min(duration, hours)
+            sessions.append((req, req["staff_name"], cls, (cls, req["subject"]), candidates, length))
+            hours -= length
+
+    staff_load, class_load = {}, {}
+    for _, staff, cls, _, _, length in sessions:
+        staff_load[staff] = staff_load.get(staff, 0) + length
+        class_load[cls] = class_load.get(cls, 0) + length
+    order = sorted(
+        range(len(sessions)),
+        key=lambda i: (
+            -sessions[i][5],
+            -(staff_load[sessions[i][1]] + class_load[sessions[i][2]]),
+            len(sessions[i][4]) or calendar.week_bits,
+            rng.random(),
+        ),
+    )
+    placement = [None] * len(sessions)
+
+    def run_bits(i, bit):
+        return range(bit, bit + sessions[i][5])
+
+    def free_mask(i):
+        """Start bits where session i's whole block is free for its staff, class and some room."""
+        _, staff, cls, _, candidates, length = sessions[i]
+        starts = calendar.block_starts(calendar.full_week & ~(staff_occ.get(staff, 0) | class_occ.get(cls, 0)), length)
+        if candidates and starts:
+            any_room = 0
+            for room in candidates:
+                any_room |= calendar.block_starts(calendar.full_week & ~room_occ.get(room, 0), length)
+            starts &= any_room
+        return starts
+
+    def cost_at(i, bit):
+        _, staff, cls, subject_key, _, length = sessions[i]
+        d, shift = divmod(bit, slots_per_day)
+        base = d * slots_per_day
+        run = ((1 << length) - 1) << shift
+        cost = 0
+        for mask in (class_occ.get(cls, 0), staff_occ.get(staff, 0)):
+            before = (mask >> base) & day_bits
+            after = before | run
+            cost += GAP_WEIGHT * (day_gaps[after] - day_gaps[before]) + DAY_LOAD_WEIGHT * day_popcount[before]
+        cost += SPREAD_WEIGHT * day_popcount[(subject_occ.get(subject_key, 0) >> base) & day_bits]
+        return cost
+
+    def assign(i, bit):
+        _, staff, cls, subject_key, candidates, length = sessions[i]
+        flag = ((1 << length) - 1) << bit
+        room = ""
+        for r in candidates:
+            if not room_occ.get(r, 0) & flag:
+                room = r
+                break
+        staff_occ[staff] = staff_occ.get(staff, 0) | flag
+        class_occ[cls] = class_occ.get(cls, 0) | flag
+        subject_occ[subject_key] = subject_occ.get(subject_key, 0) | flag
+        for b in run_bits(i, bit):
+            owner[("staff", staff, b)] = i
+            owner[("class", cls, b)] = i
+            if room:
+                owner[("room", room, b)] = i
+        if room:
+            room_occ[room] = room_occ.get(room, 0) | flag
+        placement[i] = (bit, room)
+
+    def unassign(i):
+        _, staff, cls, subject_key, _, length = sessions[i]
+        bit, room = placement[i]
+        flag = ((1 << length) - 1) << bit
+        staff_occ[staff] &= ~flag
+        class_occ[cls] &= ~flag
+        subject_occ[subject_key] &= ~flag
+        for b in run_bits(i, bit):
+            del owner[("staff", staff, b)]
+            del owner[("class", cls, b)]
+            if room:
+                del owner[("room", room, b)]
+        if room:
+            room_occ[room] &= ~flag
+        placement[i] = None
+        return bit
+
+    def best_bit(i):
+        free = free_mask(i)
+        best, best_cost = None, None
+        while free:
+            low = free & -free
+            bit = low.bit_length() - 1
+            free ^= low
+            cost = cost_at(i, bit)
+            if best is None or cost < best_cost:
+                best, best_cost = bit, cost
+        return best, best_cost
+
+    def repair(i):
+        """Place session i by moving the sessions that block one of its slots."""
+        _, staff, cls, _, candidates, length = sessions[i]
+        flag = (1 << length) - 1
+        starts = calendar.run_starts(length)
+        bits = [bit for bit in range(calendar.week_bits) if starts >> bit & 1]
+        rng.shuffle(bits)
+        for bit in bits:
+            if perf_counter() > deadline:
+                return False
+            blockers = set()
+            for kind, key in (("staff", staff), ("class", cls)):
+                mask = (staff_occ if kind == "staff" else class_occ).get(key, 0)
+                for b in run_bits(i, bit):
+                    if mask >> b & 1:
+                        blockers.add(owner.get((kind, key, b)))
+            if candidates and all(room_occ.get(r, 0) >> bit & flag for r in candidates):
+                # Every suitable room is taken; free the first one held only by movable sessions
+                held = None
+                for r in candidates:
+                    busy = [b for b in run_bits(i, bit) if room_occ.get(r, 0) >> b & 1]
+                    if all(("room", r, b) in owner for b in busy):
+                        held = {owner[("room", r, b)] for b in busy}
+                        break
+                blockers |= held if held else {None}
+            if not blockers or None in blockers or len(blockers) > length + 1:
+                continue
+            moved = {j: unassign(j) for j in blockers}
+            if free_mask(i) >> bit & 1:
+                assign(i, bit)
+                replaced = []
+                for j in moved:
+                    target, _ = best_bit(j)
+                    if target is None:
+                        break
+                    assign(j, target)
+                    replaced.append(j)
+                else:
+                    return True
+                for j in replaced:
+                    unassign(j)
+                unassign(i)
+            for j, old_bit in moved.items():
+                assign(j, old_bit)
+        return False
+
+    # Construction
+    unplaced = []
+    for i in order:
+        bit, _ = best_bit(i)
+        if bit is not None:
+            assign(i, bit)
+        elif not repair(i):
+            unplaced.append(i)
+
+    # Improvement: move single sessions while it lowers the cost
+    improved = True
+    while improved and perf_counter() < deadline:
+        improved = False
+        for i in order:
+            if placement[i] is None:
+                continue
+            if perf_counter() > deadline:
+                break
+            current = unassign(i)
+            current_cost = cost_at(i, current)
+            bit, cost = best_bit(i)
+            if bit is not None and cost < current_cost:
+                assign(i, bit)
+                improved = True
+            else:
+                assign(i, current)
+
+    assignments = []
+    for i, placed in enumerate(placement):
+        if placed is None:
+            continue
+        req, staff, cls, _, _, length = sessions[i]
+        day, t, week = calendar.bit_slot(placed[0])
+        assignments.append({
+            "staff_name": staff,
+            "department": cls[0],
+            "year": cls[1],
+            "semester": cls[2],
+            "subject": req["subject"],
+            "room": placed[1],
+            "day": day,
+            "time": t,
+            "week": week,
+            "duration": length,
+        })
+    missing = {}
+    for i in unplaced:
+        req = sessions[i][0]
+        missing.setdefault(id(req), [req, 0])[1] += sessions[i][5]
+    cost = sum(calendar.day_cost(m) for m in class_occ.values()) + sum(calendar.day_cost(m) for m in staff_occ.values())
+    cost += sum(calendar.spread_cost(m) for m in subject_occ.values())
+    return {
+        "assignments": assignments,
+        "unplaced": [dict(req, hours=n) for req, n in missing.values()],
+        "cost": cost,
+        "elapsed": perf_counter() - started,
+    }
+
+def solve_on_calendars(db, requirements, rooms=None, time_budget=5.0):
+    """solve_timetable() run once per calendar the requirements' classes are on.
+
+    A room_type that is not in ``rooms`` is looked up in the room catalogue:
+    the candidates are the rooms of that type that seat the class, smallest
+    first, and a requirement no catalogued room fits is left unplaced. The
+    time budget is shared out by number of requirements; results are
+    merged into one solve_timetable()-shaped dict.
+    """
+    rooms = rooms or {}
+    merged = {"assignments": [], "unplaced": [], "cost": 0, "elapsed": 0.0}
+    catalogue = strengths = None
+    groups = {}
+    for req in requirements:
+        cls = class_key(req["department"], req.get("year", ""), req.get("semester", ""))
+        if req.get("room_type") and req["room_type"] not in rooms and not req.get("room") and "rooms" not in req:
+            if catalogue is None:
+                catalogue, strengths = load_room_catalogue(db), load_class_strengths(db)
+            req = dict(req, rooms=suitable_rooms(catalogue, strengths.get(cls, 0), req["room_type"]))
+            if not req["rooms"]:
+                merged["unplaced"].append(req)
+                continue
+        calendar = calendar_registry.for_class(db, cls)
+        groups.setdefault(calendar.id, (calendar, []))[1].append(req)
+    # One occupancy for the whole run: each group's sessions are booked into
+    # it before the next group is solved, so a staff member or room shared
+    # between calendars is not placed twice at the same clock time
+    grouped = [r for _, group in groups.values() for r in group]
+    occupancy = load_occupancy(
+        db,
+        staff_names=[r["staff_name"] for r in grouped],
+        class_keys=[class_key(r["department"], r.get("year", ""), r.get("semester", "")) for r in grouped],
+        room_names=[room for names in rooms.values() for room in names]
+                   + [room for r in grouped for room in r.get("rooms", ())] + [r.get("room", "") for r in grouped],
+    )
+    for calendar, group in groups.values():
+        result = solve_timetable(group, rooms=rooms, occupancy=occupancy_on(occupancy, calendar), calendar=calendar,
+                                 time_budget=time_budget * len(group) / len(requirements))
+        for a in result["assignments"]:
+            book_row(occupancy, a, calendar, calendar.mask(a["day"], a["time"], a["week"], a["duration"]))
+        merged["assignments"] += result["assignments"]
+        merged["unplaced"] += result["unplaced"]
+        merged["cost"] += result["cost"]
+        merged["elapsed"] += result["elapsed"]
+    return merged
+
+# Room catalogue: rooms with a capacity (and optionally a type), and the
+# strength of each class. The allocator and the utilization report work off
+# the occupancy index, so neither runs a query per room or per slot.
+def load_room_catalogue(db):
+    """Catalogued rooms, smallest first: [(name, room_type, capacity), ...]."""
+    return db.execute("SELECT name, room_type, capacity FROM rooms WHERE capacity > 0 ORDER BY capacity, name").fetchall()
+
+def load_class_strengths(db):
+    """{(department, year, semester): number of students} for classes with a known strength."""
+    return {(d, y, s): n for d, y, s, n in db.execute("SELECT department, year, semester, strength FROM classes WHERE strength > 0")}
+
+def suitable_rooms(catalogue, strength, room_type=""):
+    """Names of the catalogued rooms of ``room_type`` (any type if blank) that seat ``strength``, smallest first."""
+    return [name for name, rtype, capacity in catalogue if capacity >= strength and (not room_type or rtype == room_type)]
+
+def allocate_room(db, cls, day, time, week=0, duration=1, room_type=""):
+    """Smallest catalogued room of ``room_type`` that seats the class and is free for the whole session, or None."""
+    calendar = calendar_registry.for_class(db, cls)
+    flag = calendar.mask(day, time, week, duration)
+    if not flag:
+        return None
+    occupancy_index.sync(db)
+    for name in suitable_rooms(load_room_catalogue(db), load_class_strengths(db).get(cls, 0), room_type):
+        if not busy_on(occupancy_index.rooms.get(name, {}), calendar) & flag:
+            return name
+    return None
+
+def room_too_small(db, room, cls):
+    """Why ``room`` cannot seat the class, or None if it can (or its capacity is unknown)."""
+    seats = db.execute("SELECT capacity FROM rooms WHERE name = ?", (room,)).fetchone()
+    strength = load_class_strengths(db).get(cls, 0)
+    if seats and 0 < seats[0] < strength:
+        return f"{room} seats {seats[0]}; this class has {strength} students."
+    return None
+
+def save_room_catalogue(db, rooms=(), strengths=()):
+    """Add or update catalogue rooms ((name, capacity, room_type) tuples) and class strengths
+    ((department, year, semester, strength) tuples) in one transaction."""
+    db.executemany("""
+        INSERT INTO rooms (name, capacity, room_type) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET capacity = excluded.capacity, room_type = excluded.room_type
+    """, rooms)
+    db.executemany("""
+        INSERT INTO classes (department, year, semester, strength) VALUES (?, ?, ?, ?)
+        ON CONFLICT (department, year, semester) DO UPDATE SET strength = excluded.strength
+    """, strengths)
+    db.commit()
+
+def room_utilization(db):
+    """Share of periods booked per room, per weekday and per period, from the occupancy masks.
+
+    Each room is measured on the calendar of most of the classes booked
+    into it (the default calendar if it is unused), with its bookings on
+    other calendars counted at the periods they overlap. Returns {"rooms": [...],
+    "days": {day: percent}, "slots": {period: percent}, "percent": overall}.
+    """
+    occupancy_index.sync(db)
+    calendars = calendar_registry.sync(db).by_id
+    room_calendars = calendar_registry.main_calendars(db, "room")
+    day_totals, slot_totals = {}, {}
+
+    def add(totals, label, booked, periods):
+        total = totals.setdefault(label, [0, 0])
+        total[0] += booked
+        total[1] += periods
+
+    def percent(booked, periods):
+        return round(100.0 * booked / periods, 1) if periods else 0.0
+
+    report = []
+    booked_all = periods_all = 0
+    for name, room_type, capacity in db.execute("SELECT name, room_type, capacity FROM rooms WHERE id != 0 ORDER BY name"):
+        calendar = calendars.get(room_calendars.get(name), DEFAULT_CALENDAR)
+        mask = busy_on(occupancy_index.rooms.get(name, {}), calendar) & calendar.full_week
+        booked = bin(mask).count("1")
+        days, slots = {}, {}
+        for day, day_mask in zip(calendar.days, calendar.day_masks):
+            day_booked, day_periods = bin(mask & day_mask).count("1"), bin(day_mask).count("1")
+            days[day] = percent(day_booked, day_periods)
+            add(day_totals, day, day_booked, day_periods)
+        for slot, slot_mask in zip(calendar.time_slots, calendar.slot_masks):
+            slot_booked, slot_periods = bin(mask & slot_mask).count("1"), bin(slot_mask).count("1")
+            slots[slot] = percent(slot_booked, slot_periods)
+            add(slot_totals, slot, slot_booked, slot_periods)
+        report.append({
+            "room": name,
+            "room_type": room_type,
+            "capacity": capacity,
+            "booked": booked,
+            "periods": calendar.week_bits,
+            "percent": percent(booked, calendar.week_bits),
+            "days": days,
+            "slots": slots,
+        })
+        booked_all += booked
+        periods_all += calendar.week_bits
+    return {
+        "rooms": report,
+        "days": {day: percent(*total) for day, total in day_totals.items()},
+        "slots": {slot: percent(*total) for slot, total in slot_totals.items()},
+        "percent": percent(booked_all, periods_all),
+    }
+
+def insert_sessions(db, rows):
+    """Insert many timetable rows straight into the sessions table.
+
+    Names are interned once per batch instead of once per row as the
+    timetable view's trigger does. Rows need staff_name, department, year,
+    semester, subject, room, day, time and week (and optionally duration),
+    with day / time on the class's calendar. Does not commit.
+    """
+    db.executemany("INSERT OR IGNORE INTO staff (name) VALUES (?)", {(r["staff_name"],) for r in rows})
+    db.executemany("INSERT OR IGNORE INTO classes (department, year, semester) VALUES (?, ?, ?)",
+                   {(r["department"], r["year"] or "", r["semester"]) for r in rows})
+    db.executemany("INSERT OR IGNORE INTO rooms (name) VALUES (?)", {(r["room"] or "",) for r in rows})
+    staff_ids = dict(db.execute("SELECT name, id FROM staff"))
+    room_ids = dict(db.execute("SELECT name, id FROM rooms"))
+    class_ids = {(d, y, s): i for i, d, y, s in db.execute("SELECT id, department, year, semester FROM classes")}
+    calendar_registry.sync(db)
+
+    def values():
+        for r in rows:
+            cls = (r["department"], r["year"] or "", r["semester"])
+            calendar = calendar_registry.class_calendar(cls)
+            # An unknown day or time becomes NULL and is rejected like a view insert
+            yield (staff_ids[r["staff_name"]], class_ids[cls], room_ids[r["room"] or ""], r["subject"],
+                   calendar.day_index.get(r["day"]), calendar.slot_index.get(r["time"]), r["week"] or 0,
+                   r.get("duration") or 1)
+
+    db.executemany(
+        "INSERT INTO sessions (staff_id, class_id, room_id, subject, day, slot, week, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        values()
+    )
+
+def save_assignments(db, assignments):
+    """Insert solver output in a single transaction, checked against the timetable as it stands.
+
+    Like edit_entries(), the write lock is taken first and every session is
+    checked, by clock time across calendars, against the occupancy and the
+    sessions before it. Raises ValueError, with nothing saved, on a clash.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        calendar_registry.sync(db)
+        occupancy = load_occupancy_from_db(
+            db,
+            staff_names=[a["staff_name"] for a in assignments],
+            class_keys=[class_key(a["department"], a.get("year", ""), a.get("semester", "")) for a in assignments],
+            room_names=[a.get("room", "") for a in assignments],
+        )
+        for a in assignments:
+            calendar = calendar_registry.class_calendar(class_key(a["department"], a.get("year", ""), a.get("semester", "")))
+            flag = calendar.mask(a["day"], a["time"], a.get("week") or 0, a.get("duration") or 1)
+            if not flag:
+                raise ValueError(f"{a['subject']} ({a['staff_name']}): {a['day']} {a['time']} is not free of breaks on {calendar.name}.")
+            clashes = book_row(occupancy, a, calendar, flag)
+            if clashes:
+                raise ValueError(f"{a['subject']} ({a['staff_name']}): {'/'.join(clashes)} already booked on {a['day']} {a['time']}.")
+        insert_sessions(db, assignments)
+    except sqlite3.IntegrityError:
+        db.rollback()
+        raise ValueError("Conflict detected! Staff, Class, or Room is already booked at this time.")
+    except ValueError:
+        db.rollback()
+        raise
+    commit_timetable(db, added=assignments)
+
+def auto_assign_session(db, staff_name, department, year, semester, subject, duration=1, room_type=""):
+    """Book one session of ``duration`` periods for a subject in the best slot that is free for both the staff member and the class.
+
+    If there is a room catalogue, the session also gets the smallest free
+    room of ``room_type`` (any type if blank) that seats the class.
+    """
+    requirement = {"staff_name": staff_name, "department": department, "year": year, "semester": semester,
+                   "subject": subject, "hours": duration, "duration": duration}
+    catalogue = load_room_catalogue(db)
+    if catalogue:
+        strength = load_class_strengths(db).get(class_key(department, year, semester), 0)
+        requirement["rooms"] = suitable_rooms(catalogue, strength, room_type)
+        if not requirement["rooms"]:
+            return None
+    result = solve_on_calendars(db, [requirement], time_budget=0.2)
+    if not result["assignments"]:
+        return None
+    try:
+        save_assignments(db, result["assignments"])
+    except ValueError:
+        return None
+    return result["assignments"][0]
+
+# Edits: single-entry edits and batch moves / swaps go through one path that
+# takes the write lock up front (BEGIN IMMEDIATE), checks row versions,
+# validates every changed row against the rest of the timetable and each
+# other, and rewrites the rows in the same transaction
+EDIT_COLUMNS = ["staff_name", "department", "year", "semester", "subject", "room", "day", "time", "week", "duration"]
+
+def _load_entries(db, current, ids):
+    """Fill ``current`` ({id: row dict}) with the given entries as they stand in the table."""
+    missing = [i for i in ids if i not in current]
+    if missing:
+        rows = db.execute(f"SELECT * FROM timetable WHERE id IN ({', '.join('?' * len(missing))})", missing).fetchall()
+        current.update((row["id"], dict(row)) for row in rows)
+    for i in ids:
+        if i not in current:
+            raise ValueError(f"Entry {i} no longer exists.")
+
+def _resolve_edits(db, operations):
+    """Old and new row dicts ({id: row}) after applying ``operations`` in order.
+
+    Operations:
+      {"op": "update", "id": 7, "version": 3, "day": "Friday", ...}
+      {"op": "swap", "ids": [7, 9], "versions": [3, 1]}   -- exchange day, time and week
+      {"op": "move", "where": {"staff_name": "X", "day": "Tuesday"}, "set": {"day": "Thursday"}}
+    Versions are optional; a stale one raises ValueError.
+    """
+    old, current = {}, {}
+
+    def check_version(entry_id, version):
+        if version not in (None, "") and int(version) != old[entry_id]["version"]:
+            raise ValueError(f"Entry {entry_id} was changed by someone else; reload it and try again.")
+
+    def fields(values):
+        unknown = set(values) - set(EDIT_COLUMNS)
+        if unknown:
+            raise ValueError(f"Cannot change {', '.join(sorted(unknown))}")
+        return values
+
+    for op in operations:
+        kind = op.get("op", "update")
+        if kind == "update":
+            ids = [int(op["id"])]
+            changes = fields({k: v for k, v in op.items() if k not in ("op", "id", "version")})
+            versions = [op.get("version")]
+        elif kind == "swap":
+            ids = [int(i) for i in op.get("ids", ())]
+            if len(ids) != 2 or ids[0] == ids[1]:
+                raise ValueError("A swap needs two different entries")
+            versions = list(op.get("versions") or [None, None])
+        elif kind == "move":
+            where = fields(dict(op.get("where") or {}))
+            if not where:
+                raise ValueError("A move needs at least one condition")
+            changes = fields(dict(op.get("set") or {}))
+            sql = " AND ".join(f"{column} = ?" for column in where)
+            ids = [row[0] for row in db.execute(f"SELECT id FROM timetable WHERE {sql}", list(where.values()))]
+            versions = [None] * len(ids)
+        else:
+            raise ValueError(f"Unknown operation: {kind}")
+        _load_entries(db, old, ids)
+        for entry_id, version in zip(ids, versions):
+            check_version(entry_id, version)
+            current.setdefault(entry_id, dict(old[entry_id]))
+        if kind == "swap":
+            a, b = current[ids[0]], current[ids[1]]
+            for column in ("day", "time", "week"):
+                a[column], b[column] = b[column], a[column]
+        else:
+            for entry_id in ids:
+                current[entry_id].update(changes)
+    return old, current
+
+def _validate_edits(db, old, new):
+    """Normalise the changed rows in place and raise ValueError on the first invalid or clashing one."""
+    calendar_registry.sync(db)
+    for entry_id, row in new.items():
+        for column in ("staff_name", "department", "semester", "subject", "day", "time"):
+            if not str(row[column] or "").strip():
+                raise ValueError(f"Entry {entry_id}: {column.replace('_', ' ')} is required.")
+        row["year"], row["room"] = row["year"] or "", row["room"] or ""
+        cls = class_key(row["department"], row["year"], row["semester"])
+        calendar = calendar_registry.class_calendar(cls)
+        week, duration = calendar.parse_week(row["week"]), parse_duration(row["duration"])
+        if week is None:
+            raise ValueError(f"Entry {entry_id}: unknown week {row['week']} on {calendar.name}.")
+        if duration is None:
+            raise ValueError(f"Entry {entry_id}: bad duration {row['duration']}.")
+        row["week"], row["duration"] = week, duration
+        row["flag"] = calendar.mask(row["day"], row["time"], week, duration)
+        if not row["flag"]:
+            raise ValueError(f"Entry {entry_id}: {row['day']} {row['time']} for {duration} period(s) is not free of breaks on {calendar.name}.")
+        if row["room"] and row["room"] != old[entry_id]["room"] and room_too_small(db, row["room"], cls):
+            raise ValueError(f"Entry {entry_id}: {room_too_small(db, row['room'], cls)}")
+
+    # Busy masks of everyone involved without the rows being changed, then
+    # the new rows folded in one by one so they are checked against each other too
+    rows = list(old.values()) + list(new.values())
+    occupancy = load_occupancy_from_db(
+        db,
+        staff_names=[r["staff_name"] for r in rows],
+        class_keys=[class_key(r["department"], r["year"], r["semester"]) for r in rows],
+        room_names=[r["room"] for r in rows],
+        exclude_ids=list(new),
+    )
+    for entry_id, row in new.items():
+        calendar = calendar_registry.class_calendar(class_key(row["department"], row["year"], row["semester"]))
+        clashes = book_row(occupancy, row, calendar, row.pop("flag"))
+        before = old[entry_id]
+        # A row that keeps its people, room and slot (say, a subject rename)
+        # is not blamed for a legacy double booking it was already part of
+        kept = (all((row[c] or "") == (before[c] or "") for c in ("staff_name", "department", "year", "semester", "room", "day", "time"))
+                and row["week"] == row_week(before) and row["duration"] == row_duration(before))
+        if clashes and not kept:
+            raise ValueError(f"Entry {entry_id}: {'/'.join(clashes)} already booked on {row['day']} {row['time']}.")
+
+def edit_entries(db, operations):
+    """Apply a batch of edits (see _resolve_edits()) atomically and return the new rows.
+
+    Raises ValueError, with nothing written, if an entry is missing or
+    stale, a changed row is invalid, or any of them would double-book a
+    staff member, class or room.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old, new = _resolve_edits(db, operations)
+        new = {i: row for i, row in new.items() if any(row[c] != old[i][c] for c in EDIT_COLUMNS)}
+        if not new:
+            db.rollback()
+            return []
+        old = {i: old[i] for i in new}
+        _validate_edits(db, old, new)
+        # Delete then re-insert under the same ids, so rows can trade places
+        # without tripping the overlap checks halfway through
+        ids = list(new)
+        db.execute(f"DELETE FROM timetable WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        for entry_id, row in new.items():
+            row["version"] = old[entry_id]["version"] + 1
+        db.executemany(
+            f"INSERT INTO timetable (id, {', '.join(EDIT_COLUMNS)}, version) VALUES (:id, {', '.join(':' + c for c in EDIT_COLUMNS)}, :version)",
+            list(new.values())
+        )
+    except sqlite3.IntegrityError:
+        db.rollback()
+        raise ValueError("Conflict detected! Staff, Class, or Room is already booked at this time.")
+    except (KeyError, TypeError) as e:
+        db.rollback()
+        raise ValueError(f"Malformed edit: {e}")
+    except ValueError:
+        db.rollback()
+        raise
+    commit_timetable(db, added=list(new.values()), removed=list(old.values()))
+    return list(new.values())
+
+# Disruption repair: when a staff member is away or a room is closed, only the
+# sessions that lose their slot are re-placed, starting from the current
+# occupancy rather than solving again. A plan is a list of moves that
+# apply_repair() hands to edit_entries(), so it is applied atomically and
+# refused if any entry changed since it was planned.
+REPAIR_TIME_WEIGHT = 10      # moving a session to another period at all
+REPAIR_ROOM_WEIGHT = 2       # giving it another room
+REPAIR_DISPLACE_WEIGHT = 50  # moving a second, undisrupted entry to make space
+
+def parse_disruption(db, data):
+    """{"staff_name", "room", "days"} from a form or JSON payload; raises ValueError."""
+    staff_name = str(data.get("staff_name") or "").strip()
+    room = str(data.get("room") or "").strip()
+    days = data.get("days") or []
+    if isinstance(days, str):
+        days = [d.strip() for d in days.split(",") if d.strip()]
+    if bool(staff_name) == bool(room):
+        raise ValueError("Name either a staff member who is away or a room that is closed.")
+    known = {d for calendar in calendar_registry.sync(db).by_id.values() for d in calendar.days}
+    unknown = [d for d in days if d not in known]
+    if unknown:
+        raise ValueError(f"Unknown day: {', '.join(unknown)}")
+    return {"staff_name": staff_name, "room": room, "days": list(days)}
+
+def plan_repair(db, disruption, time_budget=0.5):
+    """Moves that take the sessions hit by a disruption out of it, changing as little as possible.
+
+    ``disruption`` (see parse_disruption()) is a staff member away on
+    ``days``, or a room closed on ``days`` (every day if none are given).
+    Only the sessions in the disruption move. A session of a closed room
+    first tries another free room of the same type that seats the class at
+    the same time; otherwise sessions go to the free period (in the same
+    rotation week, in their own room if it is free) that adds the fewest
+    gaps and least day load for their class and staff member. A session
+    with no free period may displace one other entry of its class or staff
+    member, if that entry can itself move to a free period. All of it is
+    worked out on the occupancy index's busy masks.
+
+    Returns {"disruption", "affected", "moves", "unplaced", "elapsed"}; a
+    move has the entry's id, version, subject, staff_name, department,
+    year, semester and duration, "from" and "to" ({day, time, week, room})
+    and whether it was displaced to make space.
+    """
+    started = perf_counter()
+    deadline = started + time_budget
+    staff_name, room_name, days = disruption["staff_name"], disruption["room"], disruption["days"]
+    disrupted = ("staff", staff_name) if staff_name else ("room", room_name)
+    sql = "staff_name = ?" if staff_name else "room = ?"
+    params = [staff_name or room_name]
+    if days:
+        sql += f" AND day IN ({', '.join('?' * len(days))})"
+        params += days
+    calendar_registry.sync(db)
+    occupancy_index.sync(db)
+
+    # Working copies of the busy masks of everyone involved, fetched on first
+    # use; staff and rooms per calendar (see busy_on())
+    busy = {"staff": {}, "class": {}, "room": {}}
+    index = {"staff": occupancy_index.staff, "class": occupancy_index.classes, "room": occupancy_index.rooms}
+    # Entries by id as planned so far, and the ids of each staff member's / class's entries
+    current, entries_of = {}, {}
+    options_of = {}
+
+    def raw_masks(kind, key):
+        if key not in busy[kind]:
+            busy[kind][key] = index[kind].get(key, 0 if kind == "class" else {})
+        return busy[kind][key]
+
+    def masks(kind, key, calendar):
+        """Busy periods of a staff member, class or room on ``calendar``."""
+        found = raw_masks(kind, key)
+        return found if kind == "class" else busy_on(found, calendar)
+
+    def unavailable(kind, key, calendar):
+        if (kind, key) != disrupted:
+            return 0
+        if not days:
+            return calendar.full_week
+        return sum(calendar.day_masks[calendar.day_index[d]] for d in days if d in calendar.day_index)
+
+    def calendar_of(row):
+        return calendar_registry.class_calendar(class_key(row["department"], row["year"], row["semester"]))
+
+    def track(row):
+        row = current.setdefault(row["id"], dict(row))
+        if "flag" not in row:
+            row["flag"] = calendar_of(row).mask(row["day"], row["time"], row_week(row), row_duration(row))
+        return row
+
+    def keys(row):
+        found = [("staff", row["staff_name"]), ("class", class_key(row["department"], row["year"], row["semester"]))]
+        return found + [("room", row["room"])] if row["room"] else found
+
+    def book(row, flag, on=True):
+        calendar = calendar_of(row)
+        for kind, key in keys(row):
+            mask = raw_masks(kind, key)
+            if kind == "class":
+                busy[kind][key] = mask | flag if on else mask & ~flag
+            else:
+                busy[kind][key] = book_on(mask, calendar, flag, on)
+
+    def occupants(kind, key, flag, calendar):
+        if (kind, key) not in entries_of:
+            sql = "staff_name = ?" if kind == "staff" else "department = ? AND year = ? AND semester = ?"
+            rows = db.execute(f"SELECT * FROM timetable WHERE {sql}", (key,) if kind == "staff" else key)
+            entries_of[(kind, key)] = [track(row)["id"] for row in rows]
+        return [current[i] for i in entries_of[(kind, key)] if calendar_of(current[i]).project(current[i]["flag"], calendar) & flag]
+
+    def alternatives(own, cls):
+        """Catalogue rooms of the same type as ``own`` that seat the class, smallest first.
+
+        Read through the capacity index only as far as callers get, and
+        remembered, so a large catalogue is not loaded for one free room.
+        """
+        if (own, cls) not in options_of:
+            strength = db.execute("SELECT strength FROM classes WHERE department = ? AND year = ? AND semester = ?", cls).fetchone()
+            room_type = db.execute("SELECT room_type FROM rooms WHERE name = ?", (own,)).fetchone()
+            room_type = room_type[0] if room_type else ""
+            cursor = db.execute("SELECT name FROM rooms WHERE capacity >= ? AND (? = '' OR room_type = ?) ORDER BY capacity, name",
+                                (max(strength[0] if strength else 0, 1), room_type, room_type))
+            options_of[(own, cls)] = ([], cursor)
+        names, cursor = options_of[(own, cls)]
+        i = 0
+        while True:
+            if i == len(names):
+                found = cursor.fetchone()
+                if found is None:
+                    return
+                names.append(found[0])
+            yield names[i]
+            i += 1
+
+    def free_room(row, cls, flag, calendar):
+        """The entry's own room if it is free for ``flag``, else the first free alternative;
+        "" for an entry without a room, None if no room is free."""
+        def free(room):
+            return not flag & (masks("room", room, calendar) | unavailable("room", room, calendar))
+        own = row["room"]
+        if not own:
+            return ""
+        if free(own):
+            return own
+        return next((room for room in alternatives(own, cls) if free(room)), None)
+
+    def cost_at(row, flag, room, calendar):
+        cls = class_key(row["department"], row["year"], row["semester"])
+        cost = 0
+        for mask in (masks("class", cls, calendar), masks("staff", row["staff_name"], calendar)):
+            cost += calendar.day_cost(mask | flag) - calendar.day_cost(mask)
+        if flag != row["flag"]:
+            cost += REPAIR_TIME_WEIGHT
+        if room != row["room"]:
+            cost += REPAIR_ROOM_WEIGHT
+        return cost
+
+    def slots(row, calendar):
+        week, duration = row_week(row), row_duration(row)
+        for d in range(len(calendar.days)):
+            for s in range(calendar.slots_per_day):
+                if calendar.fits_block(s, duration):
+                    yield d, s, calendar.index_mask(d, s, week, duration)
+
+    def best_slot(row):
+        """(cost, flag, day index, slot index, room) of the cheapest free place for an entry, or None."""
+        calendar = calendar_of(row)
+        cls = class_key(row["department"], row["year"], row["semester"])
+        taken = masks("staff", row["staff_name"], calendar) | unavailable("staff", row["staff_name"], calendar) | masks("class", cls, calendar)
+        best = None
+        for d, s, flag in slots(row, calendar):
+            if flag & taken:
+                continue
+            room = free_room(row, cls, flag, calendar)
+            if room is None:
+                continue
+            cost = cost_at(row, flag, room, calendar)
+            if best is None or cost < best[0]:
+                best = (cost, flag, d, s, room)
+        return best
+
+    def displace(row):
+        """Place an entry by moving the one other entry in its way; returns the two moves' slots, or None."""
+        calendar = calendar_of(row)
+        cls = class_key(row["department"], row["year"], row["semester"])
+        away = unavailable("staff", row["staff_name"], calendar)
+        best = None
+        for d, s, flag in slots(row, calendar):
+            if perf_counter() > deadline:
+                break
+            if flag & away:
+                continue
+            blockers = {r["id"]: r for kind, key in (("staff", row["staff_name"]), ("class", cls)) for r in occupants(kind, key, flag, calendar)}
+            if len(blockers) != 1:
+                continue
+            other = next(iter(blockers.values()))
+            if other["id"] in planned or other["id"] in affected_ids:
+                continue
+            book(other, other["flag"], on=False)
+            room = free_room(row, cls, flag, calendar)
+            if room is not None and not flag & (masks("staff", row["staff_name"], calendar) | masks("class", cls, calendar)):
+                cost = cost_at(row, flag, room, calendar)
+                book(dict(row, room=room), flag)
+                other_slot = best_slot(other)
+                book(dict(row, room=room), flag, on=False)
+                if other_slot and (best is None or cost + other_slot[0] < best[0]):
+                    best = (cost + other_slot[0], (cost, flag, d, s, room), other, other_slot)
+            book(other, other["flag"])
+        return best and best[1:]
+
+    def move(row, slot, displaced=False):
+        _, flag, d, s, room = slot
+        calendar = calendar_of(row)
+        if displaced:
+            book(row, row["flag"], on=False)
+        before = {"day": row["day"], "time": row["time"], "week": row_week(row), "room": row["room"]}
+        row.update(day=calendar.days[d], time=calendar.time_slots[s], room=room, flag=flag)
+        book(row, flag)
+        planned.add(row["id"])
+        moves.append({
+            "id": row["id"], "version": row["version"], "subject": row["subject"], "staff_name": row["staff_name"],
+            "department": row["department"], "year": row["year"], "semester": row["semester"], "duration": row_duration(row),
+            "from": before, "to": {"day": row["day"], "time": row["time"], "week": row_week(row), "room": room},
+            "displaced": displaced,
+        })
+
+    affected = [track(row) for row in db.execute(f"SELECT * FROM timetable WHERE {sql} ORDER BY id", params)]
+    affected_ids = {row["id"] for row in affected}
+    moves, unplaced, planned = [], [], set()
+    # Longest blocks first, while there is most room for them
+    for row in sorted(affected, key=lambda r: -row_duration(r)):
+        book(row, row["flag"], on=False)
+        slot = best_slot(row)
+        if slot:
+            move(row, slot)
+            continue
+        found = displace(row) if perf_counter() < deadline else None
+        if found:
+            slot, other, other_slot = found
+            move(row, slot)
+            move(other, other_slot, displaced=True)
+            continue
+        book(row, row["flag"])
+        unplaced.append({
+            "id": row["id"], "subject": row["subject"], "staff_name": row["staff_name"], "department": row["department"],
+            "year": row["year"], "semester": row["semester"], "day": row["day"], "time": row["time"], "room": row["room"],
+            "reason": "No free period for the class, staff member and a room, even moving one other entry.",
+        })
+    for _, cursor in options_of.values():
+        cursor.close()
+    return {
+        "disruption": disruption,
+        "affected": len(affected),
+        "moves": moves,
+        "unplaced": unplaced,
+        "elapsed": perf_counter() - started,
+    }
+
+def apply_repair(db, moves):
+    """Apply a plan_repair() plan through edit_entries(); raises ValueError, with nothing changed, if it is out of date."""
+    try:
+        operations = [
+            {"op": "update", "id": m["id"], "version": m["version"],
+             "day": m["to"]["day"], "time": m["to"]["time"], "week": m["to"]["week"], "room": m["to"]["room"]}
+            for m in moves
+        ]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed move: {e}")
+    return edit_entries(db, operations)
+
+# Bulk import: CSV / XLSX rows checked against each other and the existing
+# timetable in one pass over the occupancy masks, then written in one transaction
+IMPORT_COLUMNS = ["staff_name", "department", "year", "semester", "subject", "room", "day", "time", "week", "duration"]
+IMPORT_REQUIRED = ["staff_name", "department", "semester", "subject", "day", "time"]
+REPORT_DIR = os.path.join(DB_DIR, "import_reports")
+
+def _import_header(cells):
+    return [str(c or "").strip().lower().replace(" ", "_") for c in cells]
+
+def read_import_rows(stream, filename):
+    """Yield (line_number, row dict) from an uploaded CSV or XLSX file."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        import openpyxl
+        wb = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = _import_header(next(rows, []))
+            for line_no, values in enumerate(rows, start=2):
+                yield line_no, {k: "" if v is None else str(v).strip() for k, v in zip(header, values)}
+        finally:
+            wb.close()
+    else:
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+        header = _import_header(next(reader, []))
+        for line_no, values in enumerate(reader, start=2):
+            yield line_no, {k: v.strip() for k, v in zip(header, values)}
+
+def import_timetable(db, rows):
+    """Validate and insert (line_number, row) pairs.
+
+    Day, time and the optional rotation week are read on the calendar of
+    the row's class; an optional duration books that many periods from the
+    row's time. Rows with a bad day / time / week / duration, a block that
+    crosses a break, or a staff, class or room clash (against the
+    table or an earlier row of the same file) are rejected; everything else
+    is inserted with insert_sessions() in a single transaction. Returns
+    {"imported": count, "rejected": [(line_number, row, reason), ...]}.
+    """
+    parsed, rejected = [], []
+    calendar_registry.sync(db)
+    for line_no, row in rows:
+        entry = {column: row.get(column, "") for column in IMPORT_COLUMNS}
+        missing = [column for column in IMPORT_REQUIRED if not entry[column]]
+        if missing:
+            rejected.append((line_no, entry, "Missing " + ", ".join(missing)))
+            continue
+        calendar = calendar_registry.class_calendar(class_key(entry["department"], entry["year"], entry["semester"]))
+        week = calendar.parse_week(entry["week"])
+        if week is None:
+            rejected.append((line_no, entry, f"Unknown week: {entry['week']}"))
+            continue
+        duration = parse_duration(entry["duration"])
+        if duration is None:
+            rejected.append((line_no, entry, f"Bad duration: {entry['duration']}"))
+            continue
+        flag = calendar.mask(entry["day"], entry["time"], week, duration)
+        if not flag:
+            if duration > 1 and calendar.mask(entry["day"], entry["time"], week):
+                rejected.append((line_no, entry, f"{duration} periods from {entry['day']} {entry['time']} run into a break or past the last period"))
+            else:
+                rejected.append((line_no, entry, f"Unknown day or time: {entry['day']} {entry['time']}"))
+            continue
+        parsed.append((line_no, entry, week, flag, duration, calendar))
+
+    occupancy = load_occupancy(
+        db,
+        staff_names=[p[1]["staff_name"] for p in parsed],
+        class_keys=[class_key(p[1]["department"], p[1]["year"], p[1]["semester"]) for p in parsed],
+        room_names=[p[1]["room"] for p in parsed],
+    )
+    staff_occ, class_occ, room_occ = occupancy["staff"], occupancy["class"], occupancy["room"]
+    accepted = []
+    for line_no, entry, week, flag, duration, calendar in parsed:
+        cls = class_key(entry["department"], entry["year"], entry["semester"])
+        clashes = []
+        if busy_on(staff_occ[entry["staff_name"]], calendar) & flag:
+            clashes.append("staff")
+        if class_occ[cls] & flag:
+            clashes.append("class")
+        if entry["room"] and busy_on(room_occ[entry["room"]], calendar) & flag:
+            clashes.append("room")
+        if clashes:
+            rejected.append((line_no, entry, f"{'/'.join(clashes).capitalize()} already booked on {entry['day']} {entry['time']}"))
+            continue
+        staff_occ[entry["staff_name"]] = book_on(staff_occ[entry["staff_name"]], calendar, flag)
+        class_occ[cls] |= flag
+        if entry["room"]:
+            room_occ[entry["room"]] = book_on(room_occ[entry["room"]], calendar, flag)
+        accepted.append(dict(entry, week=week, duration=duration))
+
+    if accepted:
+        insert_sessions(db, accepted)
+        commit_timetable(db, added=accepted)
+    rejected.sort(key=lambda r: r[0])
+    return {"imported": len(accepted), "rejected": rejected}
+
+def write_import_report(rejected, out):
+    writer = csv.writer(out)
+    writer.writerow(["line"] + IMPORT_COLUMNS + ["reason"])
+    for line_no, entry, reason in rejected:
+        writer.writerow([line_no] + [entry[c] for c in IMPORT_COLUMNS] + [reason])
+
+def save_upload(stream, filename):
+    """Copy an upload into the job directory for an import job; returns its file name there.
+
+    The name is the content hash, so the same file uploaded twice gives the
+    same job parameters and the second import joins the first.
+    """
+    directory = job_queue.directory
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha1()
+    with tempfile.NamedTemporaryFile(dir=directory, prefix="incoming-", delete=False) as tmp:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+    name = f"upload-{digest.hexdigest()}{os.path.splitext(filename)[1].lower()}"
+    os.replace(tmp.name, os.path.join(directory, name))
+    return name
+
+def save_import_report(rejected):
+    """Write the rejections into REPORT_DIR; returns the report id for /import/report/<report>, or None if there were none."""
+    if not rejected:
+        return None
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    report = secrets.token_hex(8)
+    with open(os.path.join(REPORT_DIR, f"{report}.csv"), "w", newline="", encoding="utf-8") as out:
+        write_import_report(rejected, out)
+    return report
+
 # Add entry route for manual timetable entry
 @app.route("/add", methods=["GET", "POST"])
 def add_entry():
@@ -79,60 +2817,165 @@ def add_entry():
         room = request.form.get("room", "")
         day = request.form["day"]
         time = request.form["time"]
+        duration = parse_duration(request.form.get("duration"))
         db = get_db()
+        calendar = calendar_registry.for_class(db, class_key(department, year, semester))
+        if not calendar.mask(day, time):
+            flash(f"⚠️ {day} {time} is not a period on this class's calendar ({calendar.name}).")
+            return redirect(url_for("add_entry"))
+        if duration is None or not calendar.mask(day, time, duration=duration):
+            flash(f"⚠️ A {request.form.get('duration')}-period session from {day} {time} runs into a break or past the last period.")
+            return redirect(url_for("add_entry"))
+        cls = class_key(department, year, semester)
+        # Check and insert under the write lock, so no other writer can book
+        # the slot in between; the index re-syncs to what is committed
+        db.execute("BEGIN IMMEDIATE")
+        if not room and request.form.get("auto_room"):
+            room = allocate_room(db, cls, day, time, duration=duration, room_type=request.form.get("room_type", "").strip())
+            if not room:
+                db.rollback()
+                flash("⚠️ No free room in the catalogue seats this class at that time.")
+                return redirect(url_for("add_entry"))
+        elif room and room_too_small(db, room, cls):
+            db.rollback()
+            flash(f"⚠️ {room_too_small(db, room, cls)}")
+            return redirect(url_for("add_entry"))
         # Smart Conflict Check:
         # 1. Check if the Staff is already booked at this time
         # 2. Check if the Class (Dept + Year + Sem) is already booked at this time
         # 3. Check if the Room is already booked at this time (if room is specified)
-        conflict = db.execute(
-            """SELECT * FROM timetable 
-               WHERE (staff_name=? AND day=? AND time=?) 
-               OR (department=? AND year=? AND semester=? AND day=? AND time=?)
-               OR (room != '' AND room=? AND day=? AND time=?)""",
-            (staff_name, day, time, department, year, semester, day, time, room, day, time)
-        ).fetchone()
+        conflict = occupancy_index.conflicts(db, staff_name, class_key(department, year, semester), room, day, time, duration=duration)
         if conflict:
+            db.rollback()
+            flash("⚠️ Conflict detected! Staff, Class, or Room is already booked at this time.")
+            return redirect(url_for("add_entry"))
+        try:
+            entry = {"staff_name": staff_name, "department": department, "year": year, "semester": semester, "subject": subject, "room": room, "day": day, "time": time, "duration": duration}
+            db.execute(
+                "INSERT INTO timetable (staff_name, department, year, semester, subject, room, day, time, duration) VALUES (:staff_name, :department, :year, :semester, :subject, :room, :day, :time, :duration)",
+                entry
+            )
+            commit_timetable(db, added=[entry])
+        except sqlite3.IntegrityError:
+            # Another request booked the same slot between the check and the insert
+            db.rollback()
             flash("⚠️ Conflict detected! Staff, Class, or Room is already booked at this time.")
             return redirect(url_for("add_entry"))
-        db.execute(
-            "INSERT INTO timetable (staff_name, department, year, semester, subject, room, day, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (staff_name, department, year, semester, subject, room, day, time)
-        )
-        db.commit()
         flash("✅ Entry added successfully!")
         return redirect(url_for("dashboard"))
-    return render_template("add_timetable.html", days=days, time_slots=time_slots)
+    db = get_db()
+    day_names, slot_labels = calendar_registry.all_labels(db)
+    return render_template("add_timetable.html", days=day_names, time_slots=slot_labels, max_duration=calendar_registry.longest_day(db))
 
 # Edit entry route
 @app.route("/edit/<int:entry_id>", methods=["GET", "POST"])
 def edit_entry(entry_id):
     db = get_db()
     if request.method == "POST":
-        staff_name = request.form["staff_name"]
-        department = request.form["department"]
-        semester = request.form["semester"]
-        subject = request.form["subject"]
-        day = request.form["day"]
-        time = request.form["time"]
-        
-        # Update the entry
-        db.execute(
-            "UPDATE timetable SET staff_name=?, department=?, semester=?, subject=?, day=?, time=? WHERE id=?",
-            (staff_name, department, semester, subject, day, time, entry_id)
-        )
-        db.commit()
+        # Same conflict checks as adding, in one locked transaction; the
+        # version from the form makes a concurrent edit fail instead of being overwritten
+        operation = {"op": "update", "id": entry_id, "version": request.form.get("version")}
+        operation.update((column, request.form.get(column, "")) for column in EDIT_COLUMNS)
+        try:
+            edit_entries(db, [operation])
+        except ValueError as e:
+            flash(f"⚠️ {e}")
+            return redirect(url_for("edit_entry", entry_id=entry_id))
         flash("✏️ Entry updated successfully!")
         return redirect(url_for("dashboard"))
     
     entry = db.execute("SELECT * FROM timetable WHERE id=?", (entry_id,)).fetchone()
-    return render_template("Edit_Timetable.html", entry=entry, days=days, time_slots=time_slots)
+    if entry is None:
+        flash("⚠️ That entry no longer exists.")
+        return redirect(url_for("dashboard"))
+    calendar = calendar_registry.get(db, entry["calendar_id"])
+    week = calendar.weeks[entry["week"] - 1] if entry["week"] else ""
+    day_names, slot_labels = calendar_registry.all_labels(db)
+    return render_template("Edit_Timetable.html", entry=entry, week=week, days=day_names, time_slots=slot_labels,
+                           max_duration=calendar_registry.longest_day(db))
+
+# Batch edit API: moves and swaps applied atomically (see _resolve_edits())
+@app.route("/api/entries/batch", methods=["POST"])
+def batch_edit():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get("operations")
+    if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+        return {"error": "Expected {\"operations\": [...]}"}, 400
+    try:
+        changed = edit_entries(get_db(), operations)
+    except ValueError as e:
+        return {"error": str(e)}, 409
+    return {"changed": changed}
+
+# Disruption repair: preview the moves for a staff absence or room closure, then apply them
+@app.route("/repair", methods=["GET", "POST"])
+def repair():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    db = get_db()
+    calendars = calendar_registry.sync(db).by_id.values()
+    all_days = list(dict.fromkeys(d for calendar in calendars for d in calendar.days))
+    staff_list = [r[0] for r in db.execute("SELECT name FROM staff WHERE name != '' ORDER BY name")]
+    room_list = [r[0] for r in db.execute("SELECT name FROM rooms WHERE name != '' ORDER BY name")]
+    form = request.form
+    if request.method == "POST" and form.get("moves"):
+        try:
+            changed = apply_repair(db, json.loads(form["moves"]))
+        except ValueError as e:
+            flash(f"⚠️ {e} Preview the repair again.")
+            return redirect(url_for("repair"))
+        flash(f"✅ Moved {len(changed)} entries.")
+        return redirect(url_for("dashboard"))
+    plan = None
+    if request.method == "POST":
+        try:
+            disruption = parse_disruption(db, {
+                "staff_name": form.get("staff_name") if form.get("kind") == "staff" else "",
+                "room": form.get("room") if form.get("kind") == "room" else "",
+                "days": form.getlist("days"),
+            })
+        except ValueError as e:
+            flash(f"⚠️ {e}")
+            return redirect(url_for("repair"))
+        plan = plan_repair(db, disruption)
+        if not plan["affected"]:
+            flash("Nothing to repair: no entries fall in this disruption.")
+    return render_template("Repair.html", plan=plan, days=all_days, staff_list=staff_list, room_list=room_list)
+
+@app.route("/api/repair", methods=["POST"])
+def repair_api():
+    """Plan a repair; with "apply": true also apply it (or the "moves" of an earlier preview)."""
+    if "username" not in session:
+        return redirect(url_for("login"))
+    payload = request.get_json(silent=True) or {}
+    db = get_db()
+    moves = payload.get("moves")
+    if payload.get("apply") and moves is not None:
+        if not isinstance(moves, list) or not all(isinstance(m, dict) for m in moves):
+            return {"error": "Expected \"moves\": [...] from a preview"}, 400
+        plan = {"moves": moves}
+    else:
+        try:
+            disruption = parse_disruption(db, payload)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        plan = plan_repair(db, disruption)
+    if payload.get("apply"):
+        try:
+            plan["changed"] = apply_repair(db, plan["moves"])
+        except ValueError as e:
+            return {"error": str(e)}, 409
+    return plan
 
 # Delete entry route
 @app.route("/delete/<int:entry_id>", methods=["POST"])
 def delete_entry(entry_id):
     db = get_db()
+    entry = db.execute("SELECT * FROM timetable WHERE id=?", (entry_id,)).fetchone()
     db.execute("DELETE FROM timetable WHERE id=?", (entry_id,))
-    db.commit()
+    commit_timetable(db, removed=[entry] if entry else [])
     flash("🗑️ Entry deleted successfully!")
     return redirect(request.referrer or url_for("dashboard"))
 
@@ -144,75 +2987,536 @@ def auto_assign():
     year = request.form.get("year", "")
     semester = request.form.get("semester", "")
     subject = request.form.get("subject")
+    duration = parse_duration(request.form.get("duration")) or 1
+    db = get_db()
+    placed = auto_assign_session(db, staff_name, department, year, semester, subject, duration, request.form.get("room_type", "").strip())
+    if placed:
+        flash(f"Auto-assigned {subject} to {placed['day']} {placed['time']}" + (f" for {duration} periods" if duration > 1 else "")
+              + (f" in {placed['room']}." if placed["room"] else "."))
+    else:
+        flash("No free slot available for auto-assign.")
+    return redirect(url_for("check_slots"))
+
+def parse_requirements(text):
+    """Parse requirement lines: subject, staff, department, year, semester, hours[, room_type[, duration]]."""
+    requirements = []
+    for line_no, fields in enumerate(csv.reader(io.StringIO(text)), start=1):
+        fields = [f.strip() for f in fields]
+        if not any(fields) or fields[0].startswith("#"):
+            continue
+        if len(fields) < 6:
+            raise ValueError(f"Line {line_no}: expected subject, staff, department, year, semester, hours[, room_type[, duration]]")
+        requirements.append(check_requirement(dict(zip(REQUIREMENT_FIELDS + ("room_type", "duration"), fields)), f"Line {line_no}"))
+    return requirements
+
+REQUIREMENT_FIELDS = ("subject", "staff_name", "department", "year", "semester", "hours")
+
+def check_requirement(req, where):
+    """A clean copy of one requirement dict (see solve_timetable()), or ValueError starting with ``where``."""
+    if not isinstance(req, dict):
+        raise ValueError(f"{where}: expected an object with {', '.join(REQUIREMENT_FIELDS)}")
+    missing = [key for key in REQUIREMENT_FIELDS if key not in req]
+    if missing:
+        raise ValueError(f"{where}: missing {', '.join(missing)}")
+    text = ("subject", "staff_name", "department", "year", "semester", "room_type", "room")
+    if any(isinstance(req.get(key), (dict, list)) for key in text):
+        raise ValueError(f"{where}: {', '.join(k for k in text if isinstance(req.get(k), (dict, list)))} must be text")
+    hours = req["hours"]
+    if isinstance(hours, bool) or not str(hours).strip().isdigit() or int(hours) < 1:
+        raise ValueError(f"{where}: hours must be a whole number of periods, at least 1 (got {hours!r})")
+    duration = parse_duration(req.get("duration"))
+    if duration is None or isinstance(req.get("duration"), bool):
+        raise ValueError(f"{where}: duration must be a whole number of periods from 1 to {MAX_SLOTS_PER_DAY} (got {req.get('duration')!r})")
+    clean = {key: str(req[key]).strip() for key in REQUIREMENT_FIELDS[:5]}
+    clean.update(hours=int(hours), duration=duration, room_type=str(req.get("room_type") or "").strip())
+    if req.get("room"):
+        clean["room"] = str(req["room"]).strip()
+    if "rooms" in req:
+        if not isinstance(req["rooms"], list) or not all(isinstance(room, str) for room in req["rooms"]):
+            raise ValueError(f"{where}: rooms must be a list of room names")
+        clean["rooms"] = req["rooms"]
+    return clean
+
+def check_requirement_calendars(db, requirements):
+    """ValueError naming the first requirement whose blocks do not fit between the breaks of its class's calendar."""
+    for i, req in enumerate(requirements, start=1):
+        calendar = calendar_registry.for_class(db, class_key(req["department"], req["year"], req["semester"]))
+        if not calendar.run_starts(req["duration"]):
+            raise ValueError(f"Requirement {i} ({req['subject']}, {req['staff_name']}): a {req['duration']}-period block "
+                             f"does not fit between the breaks of calendar {calendar.name}")
+
+def parse_time_budget(value):
+    """Optimizer time budget in seconds, clamped to 0.1 - 60; ValueError if it is not a number."""
+    try:
+        budget = float(5 if value in (None, "") else value)
+    except (TypeError, ValueError):
+        raise ValueError(f"time_budget must be a number of seconds (got {value!r})") from None
+    if budget != budget or isinstance(value, bool):
+        raise ValueError(f"time_budget must be a number of seconds (got {value!r})")
+    return min(max(budget, 0.1), 60)
+
+def parse_rooms(text):
+    """Parse 'room_type: room, room, ...' lines."""
+    rooms = {}
+    for line in text.splitlines():
+        if ":" in line:
+            room_type, names = line.split(":", 1)
+            rooms[room_type.strip()] = [n.strip() for n in names.split(",") if n.strip()]
+    return rooms
+
+def optimize_summary(result, apply, saved):
+    if apply and not saved and result["assignments"]:
+        return "⚠️ Conflict detected while saving; the timetable changed during optimization. Please run it again."
+    placed = sum(a["duration"] for a in result["assignments"])
+    missing = sum(r["hours"] for r in result["unplaced"])
+    summary = f"Optimizer placed {placed} periods ({missing} unplaced, cost {result['cost']}) in {result['elapsed']:.2f}s."
+    if "workload" in result:
+        summary += f" Workload penalty of the staff and classes involved: {result['workload']['before']} → {result['workload']['after']}."
+    return summary
+
+def score_solution(db, result):
+    """Add the workload score of a solver result (see score_assignments()) when numpy is installed."""
+    try:
+        result["workload"] = score_assignments(db, result["assignments"])
+    except ImportError:
+        pass
+    return result
+
+# Optimizer route: solve a batch of requirements into a complete timetable
+@app.route("/optimize", methods=["GET", "POST"])
+def optimize():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    if request.method == "GET":
+        return render_template("Optimize.html")
+
+    db = get_db()
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get("requirements", []), list):
+            return {"error": "Expected {\"requirements\": [...]}"}, 400
+        rooms = payload.get("rooms") or {}
+        if not isinstance(rooms, dict) or not all(isinstance(names, list) and all(isinstance(n, str) for n in names) for names in rooms.values()):
+            return {"error": "Expected \"rooms\": {room_type: [room, ...]}"}, 400
+        try:
+            requirements = [check_requirement(req, f"Requirement {i}") for i, req in enumerate(payload.get("requirements", []), start=1)]
+            check_requirement_calendars(db, requirements)
+            time_budget = parse_time_budget(payload.get("time_budget"))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        apply = bool(payload.get("apply"))
+        background = bool(payload.get("background"))
+    else:
+        try:
+            requirements = parse_requirements(request.form.get("requirements", ""))
+            check_requirement_calendars(db, requirements)
+            time_budget = parse_time_budget(request.form.get("time_budget"))
+        except ValueError as e:
+            flash(f"⚠️ {e}")
+            return redirect(url_for("optimize"))
+        rooms = parse_rooms(request.form.get("rooms", ""))
+        apply = request.form.get("apply") == "1"
+        background = request.form.get("background") == "1"
+    if background:
+        return submit_job("optimize", {"requirements": requirements, "rooms": rooms, "time_budget": time_budget, "apply": apply})
+
+    result = score_solution(db, solve_on_calendars(db, requirements, rooms=rooms, time_budget=time_budget))
+    saved = False
+    if apply and result["assignments"]:
+        try:
+            save_assignments(db, result["assignments"])
+            saved = True
+        except ValueError as e:
+            app.logger.warning("Optimizer result not saved: %s", e)
+
+    if request.is_json:
+        return dict(result, saved=saved)
+    flash(optimize_summary(result, apply, saved))
+    if saved:
+        return redirect(url_for("dashboard"))
+    return render_template("Optimize.html", result=result, requirements_text=request.form.get("requirements", ""), rooms_text=request.form.get("rooms", ""))
+
+def parse_room_catalogue(text):
+    """Parse 'room, capacity[, room_type]' lines."""
+    rooms = []
+    for line_no, fields in enumerate(csv.reader(io.StringIO(text)), start=1):
+        fields = [f.strip() for f in fields]
+        if not any(fields) or fields[0].startswith("#"):
+            continue
+        if len(fields) < 2 or not fields[0] or not fields[1].isdigit() or int(fields[1]) < 1:
+            raise ValueError(f"Rooms line {line_no}: expected room, capacity[, room_type]")
+        rooms.append((fields[0], int(fields[1]), fields[2] if len(fields) > 2 else ""))
+    return rooms
+
+def parse_class_strengths(text):
+    """Parse 'department, year, semester, strength' lines."""
+    strengths = []
+    for line_no, fields in enumerate(csv.reader(io.StringIO(text)), start=1):
+        fields = [f.strip() for f in fields]
+        if not any(fields) or fields[0].startswith("#"):
+            continue
+        if len(fields) < 4 or not fields[0] or not fields[3].isdigit():
+            raise ValueError(f"Classes line {line_no}: expected department, year, semester, strength")
+        strengths.append((fields[0], fields[1], fields[2], int(fields[3])))
+    return strengths
+
+# Rooms route: room catalogue, class strengths and room utilization
+@app.route("/rooms", methods=["GET", "POST"])
+def rooms():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    db = get_db()
+    if request.method == "POST":
+        try:
+            catalogue = parse_room_catalogue(request.form.get("rooms", ""))
+            strengths = parse_class_strengths(request.form.get("strengths", ""))
+        except ValueError as e:
+            flash(f"⚠️ {e}")
+            return redirect(url_for("rooms"))
+        save_room_catalogue(db, catalogue, strengths)
+        flash(f"✅ Saved {len(catalogue)} rooms and {len(strengths)} class strengths.")
+        return redirect(url_for("rooms"))
+    rooms_text = "\n".join(f"{name}, {capacity}, {room_type}".rstrip(", ") for name, room_type, capacity in load_room_catalogue(db))
+    strengths_text = "\n".join(f"{d}, {y}, {s}, {n}" for (d, y, s), n in sorted(load_class_strengths(db).items()))
+    return render_template("Rooms.html", utilization=room_utilization(db), rooms_text=rooms_text, strengths_text=strengths_text)
+
+@app.route("/api/room_utilization")
+def room_utilization_api():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    return room_utilization(get_db())
+
+# Bulk import route
+@app.route("/import", methods=["GET", "POST"])
+def bulk_import():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    if request.method == "GET":
+        return render_template("Import.html", columns=IMPORT_COLUMNS)
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("⚠️ Please choose a CSV or Excel file to import.")
+        return redirect(url_for("bulk_import"))
+    if request.form.get("background") == "1":
+        return submit_job("import", {"upload": save_upload(upload.stream, upload.filename), "filename": upload.filename})
+    db = get_db()
+    try:
+        result = import_timetable(db, read_import_rows(upload.stream, upload.filename))
+    except ImportError:
+        flash("Error: 'openpyxl' library is missing. Please install it using 'pip install openpyxl'.")
+        return redirect(url_for("bulk_import"))
+    except sqlite3.IntegrityError:
+        db.rollback()
+        flash("⚠️ Conflict detected! The timetable changed during the import. Nothing was imported, please try again.")
+        return redirect(url_for("bulk_import"))
+    report = save_import_report(result["rejected"])
+    flash(f"✅ Imported {result['imported']} entries, rejected {len(result['rejected'])}.")
+    return render_template("Import.html", columns=IMPORT_COLUMNS, result=result, report=report)
+
+@app.route("/import/report/<report>")
+def import_report(report):
+    if "username" not in session:
+        return redirect(url_for("login"))
+    if not all(c in "0123456789abcdef" for c in report):
+        return "Report not found", 404
+    return send_from_directory(REPORT_DIR, f"{report}.csv", as_attachment=True, download_name="import_rejections.csv")
+
+@app.cli.command("import-timetable")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--report", type=click.Path(dir_okay=False), help="Write rejected rows to this CSV file.")
+def import_timetable_command(path, report):
+    """Bulk import timetable entries from a CSV or XLSX file."""
+    init_db()
     db = get_db()
-    used = db.execute(
-        "SELECT day, time FROM timetable WHERE staff_name=? AND department=?",
-        (staff_name, department)
-    ).fetchall()
-    used_slots = {(row["day"], row["time"]) for row in used}
-    assigned = False
-    for t in time_slots:
-        for d in days:
-            if (d, t) not in used_slots:
-                db.execute(
-                    "INSERT INTO timetable (staff_name, department, year, semester, subject, day, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (staff_name, department, year, semester, subject, d, t)
-                )
-                db.commit()
-                flash(f"Auto-assigned {subject} to {d} {t}.")
-                assigned = True
-                break
-        if assigned:
-            break
-    if not assigned:
-        flash("No free slot available for auto-assign.")
-    return redirect(url_for("check_slots"))
+    started = perf_counter()
+    try:
+        with open(path, "rb") as stream:
+            result = import_timetable(db, read_import_rows(stream, path))
+    except ImportError:
+        raise click.ClickException("'openpyxl' library is missing. Please install it using 'pip install openpyxl'.")
+    except sqlite3.IntegrityError:
+        db.rollback()
+        raise click.ClickException("Conflict detected! The timetable changed during the import. Nothing was imported, please try again.")
+    click.echo(f"Imported {result['imported']} entries, rejected {len(result['rejected'])} in {perf_counter() - started:.2f}s.")
+    if report and result["rejected"]:
+        with open(report, "w", newline="", encoding="utf-8") as out:
+            write_import_report(result["rejected"], out)
+        click.echo(f"Rejections written to {report}.")
+
+@app.cli.command("import-calendar")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_calendar_command(path):
+    """Create or update a calendar from a JSON file (see save_calendar())."""
+    init_db()
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    try:
+        calendar_id = save_calendar(get_db(), spec)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Saved calendar {spec['name']} (id {calendar_id}) with {len(spec.get('classes') or [])} classes.")
 
 # Home route
 @app.route("/")
 def home():
     return redirect(url_for("login"))
 
+# Results that only change when the timetable does, keyed by the table revision
+_revision_cache = {}
+
+def cached_by_revision(db, name, build):
+    """Return build(db), recomputing it only after the timetable has changed."""
+    revision = read_revision(db)
+    hit = _revision_cache.get(name)
+    if hit is not None and hit[0] == revision:
+        return hit[1]
+    # Tag with the revision read before building: a write that lands while
+    # building only causes one extra rebuild, never a stale hit
+    value = build(db)
+    _revision_cache[name] = (revision, value)
+    return value
+
+def build_dashboard_summary(db):
+    """Filter lists and chart data for the dashboard from a single grouped scan."""
+    departments, years, semesters = set(), set(), set()
+    dept_counts, staff_counts = {}, {}
+    rows = db.execute("SELECT department, year, semester, staff_name, COUNT(*) FROM timetable GROUP BY department, year, semester, staff_name")
+    for department, year, semester, staff_name, count in rows:
+        departments.add(department)
+        years.add(year)
+        semesters.add(semester)
+        dept_counts[department] = dept_counts.get(department, 0) + count
+        staff_counts[staff_name] = staff_counts.get(staff_name, 0) + count
+    return {
+        "departments": [{"department": v} for v in sorted(v for v in departments if v)],
+        "years": [{"year": v} for v in sorted(v for v in years if v)],
+        "semesters": [{"semester": v} for v in sorted(v for v in semesters if v)],
+        "staff_list": [{"staff_name": v} for v in sorted(v for v in staff_counts if v)],
+        # Lists for Chart.js
+        "dept_analytics": {"labels": sorted(dept_counts, key=str), "data": [dept_counts[k] for k in sorted(dept_counts, key=str)]},
+        "staff_analytics": {"labels": sorted(staff_counts, key=str), "data": [staff_counts[k] for k in sorted(staff_counts, key=str)]},
+    }
+
+# Workload analytics: per staff member and per class, how the week is laid
+# out (periods per day, idle gaps, the longest run of back-to-back periods,
+# first- and last-period days) and which soft limits it breaks. The
+# timetables of each calendar are unpacked from their occupancy masks into
+# one timetables x days x periods boolean tensor and every metric is a NumPy
+# reduction over it, so the whole institution costs a few array operations
+# rather than a Python loop per timetable. The penalty uses the optimizer's
+# weights, so a timetable can be scored before and after a change.
+WORKLOAD_METRICS = ["periods", "busiest_day", "days_taught", "gaps", "max_streak", "first_periods", "last_periods"]
+
+def occupancy_tensor(masks, calendar):
+    """(len(masks), cycle_days, slots_per_day) bool array of busy masks on ``calendar``."""
+    import numpy as np
+
+    width = (calendar.week_bits + 7) // 8
+    raw = np.frombuffer(b"".join((m & calendar.full_week).to_bytes(width, "little") for m in masks), dtype=np.uint8)
+    bits = np.unpackbits(raw.reshape(len(masks), width), axis=1, count=calendar.week_bits, bitorder="little")
+    return bits.reshape(len(masks), calendar.cycle_days, calendar.slots_per_day).astype(bool)
+
+def workload_metrics(occupied, calendar, limits):
+    """{metric: array with one value per timetable} of an occupancy tensor on ``calendar``.
+
+    Gaps are counted as the optimizer counts them: free periods between two
+    busy ones in the same block between breaks. A streak is a run of busy
+    periods and is not ended by a break. ``limits`` maps the keys of
+    WORKLOAD_LIMITS to caps; "excess" holds, per limit, how far over it each
+    timetable is.
+    """
+    import numpy as np
+
+    per_day = occupied.sum(axis=2)
+    # Each day as its bit pattern, looked up in the calendar's gap table
+    patterns = occupied.astype(np.int64) @ (1 << np.arange(calendar.slots_per_day, dtype=np.int64))
+    gaps = np.asarray(calendar.day_gaps, dtype=np.int64)[patterns]
+    run = np.zeros(per_day.shape, dtype=np.int64)
+    streak = np.zeros(per_day.shape, dtype=np.int64)
+    for s in range(calendar.slots_per_day):
+        run = (run + 1) * occupied[:, :, s]
+        np.maximum(streak, run, out=streak)
+    metrics = {
+        "per_day": per_day,
+        "periods": per_day.sum(axis=1),
+        "busiest_day": per_day.max(axis=1, initial=0),
+        "days_taught": (per_day > 0).sum(axis=1),
+        "first_periods": occupied[:, :, 0].sum(axis=1),
+        "last_periods": occupied[:, :, -1].sum(axis=1),
+        "gaps": gaps.sum(axis=1),
+        "max_streak": streak.max(axis=1, initial=0),
+        "spread": per_day.std(axis=1),
+    }
+
+    def over(values, cap):
+        return np.maximum(values - cap, 0)
+
+    caps = {
+        "periods_per_day": lambda cap: over(per_day, cap).sum(axis=1),
+        "periods_per_week": lambda cap: over(metrics["periods"], cap),
+        "gaps_per_day": lambda cap: over(gaps, cap).sum(axis=1),
+        "streak": lambda cap: over(streak, cap).sum(axis=1),
+        "first_periods": lambda cap: over(metrics["first_periods"], cap),
+        "last_periods": lambda cap: over(metrics["last_periods"], cap),
+    }
+    metrics["excess"] = {name: caps[name](cap) for name, cap in limits.items() if cap is not None and name in caps}
+    metrics["penalty"] = (GAP_WEIGHT * metrics["gaps"]
+                          + DAY_LOAD_WEIGHT * (per_day * (per_day - 1) // 2).sum(axis=1)
+                          + LIMIT_WEIGHT * sum(metrics["excess"].values(), np.zeros(len(per_day), dtype=np.int64)))
+    return metrics
+
+def entity_calendars(db, kind, keys):
+    """{key: Calendar} for staff names or class keys, with a single query for staff."""
+    if kind == "class":
+        return {key: calendar_registry.class_calendar(key) for key in keys}
+    if len(calendar_registry.by_id) == 1:
+        return dict.fromkeys(keys, next(iter(calendar_registry.by_id.values())))
+    # Measured on the calendar their grid is shown on (see CalendarRegistry.for_entity)
+    ids = calendar_registry.main_calendars(db, "staff")
+    return {key: calendar_registry.by_id.get(ids.get(key), DEFAULT_CALENDAR) for key in keys}
+
+def workload_groups(db, kind, masks):
+    """Yield (calendar, keys, metrics) for the given busy masks (per calendar for staff, see busy_on()), one tensor per calendar."""
+    groups = {}
+    for key, calendar in entity_calendars(db, kind, masks).items():
+        groups.setdefault(calendar.id, (calendar, []))[1].append(key)
+    for calendar, keys in groups.values():
+        limits = app.config["WORKLOAD_LIMITS"].get(kind, {})
+        busy = [masks[k] if kind == "class" else busy_on(masks[k], calendar) for k in keys]
+        yield calendar, keys, workload_metrics(occupancy_tensor(busy, calendar), calendar, limits)
+
+def build_workload_report(db):
+    """Workload metrics of every staff member and class, worst penalty first."""
+    index = occupancy_index.sync(db)
+    calendar_registry.sync(db)
+    report = {"limits": app.config["WORKLOAD_LIMITS"], "calendars": {}}
+    for kind, masks in (("staff", index.staff), ("class", index.classes)):
+        # Blank names and classes are placeholders, not timetables
+        masks = {key: mask for key, mask in masks.items() if key and (kind == "staff" or key[0])}
+        rows = []
+        for calendar, keys, metrics in workload_groups(db, kind, masks):
+            columns = {name: metrics[name].tolist() for name in WORKLOAD_METRICS + ["penalty"]}
+            spread = metrics["spread"].round(2).tolist()
+            per_day = metrics["per_day"].tolist()
+            excess = {name: values.tolist() for name, values in metrics["excess"].items()}
+            # per_day follows the days of the timetable's calendar
+            report["calendars"][calendar.name] = calendar.day_labels
+            for i, key in enumerate(keys):
+                row = {"staff_name": key} if kind == "staff" else dict(zip(("department", "year", "semester"), key))
+                row.update((name, values[i]) for name, values in columns.items())
+                row.update(calendar=calendar.name, spread=spread[i], per_day=per_day[i],
+                           violations={name: values[i] for name, values in excess.items() if values[i]})
+                rows.append(row)
+        rows.sort(key=lambda r: -r["penalty"])
+        report[kind] = rows
+        report[f"{kind}_over_limits"] = sum(1 for r in rows if r["violations"])
+    return report
+
+def score_assignments(db, assignments):
+    """Workload penalty of the staff and classes ``assignments`` touch, before and after adding them.
+
+    A scoring function for automatic scheduling: a proposed batch of
+    sessions (as returned by solve_on_calendars()) is judged on the same
+    metrics as the workload report without being written.
+    """
+    index = occupancy_index.sync(db)
+    calendar_registry.sync(db)
+    score = {"before": 0, "after": 0}
+    for kind, current, empty in (("staff", index.staff, {}), ("class", index.classes, 0)):
+        after = {}
+        for row in assignments:
+            cls = class_key(row["department"], row.get("year", ""), row.get("semester", ""))
+            calendar = calendar_registry.class_calendar(cls)
+            flag = calendar.mask(row["day"], row["time"], row_week(row), row_duration(row))
+            if kind == "staff":
+                after[row["staff_name"]] = book_on(after.get(row["staff_name"], current.get(row["staff_name"], empty)), calendar, flag)
+            else:
+                after[cls] = after.get(cls, current.get(cls, empty)) | flag
+        before = {key: current.get(key, empty) for key in after}
+        for label, masks in (("before", before), ("after", after)):
+            for _, _, metrics in workload_groups(db, kind, masks):
+                score[label] += int(metrics["penalty"].sum())
+    return score
+
+# Entry listing: keyset pagination over (sort column, id)
+ENTRY_SORT_COLUMNS = ["id", "staff_name", "department", "year", "semester", "subject", "room", "day", "time"]
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def entry_filters(args):
+    """WHERE clause and parameters for the staff / department / year filters and the search box."""
+    where, params = "1=1", []
+    for column in ("staff_name", "department", "year"):
+        if args.get(column):
+            where += f" AND {column} = ?"
+            params.append(args[column])
+    search = args.get("q", "").strip()
+    if search:
+        like = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where += " AND (staff_name LIKE ? ESCAPE '\\' OR subject LIKE ? ESCAPE '\\' OR room LIKE ? ESCAPE '\\')"
+        params += [like, like, like]
+    return where, params
+
+def encode_cursor(value, entry_id):
+    return base64.urlsafe_b64encode(json.dumps([value, entry_id]).encode()).decode()
+
+def decode_cursor(token):
+    try:
+        value, entry_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return value, int(entry_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def fetch_entry_page(db, args):
+    """One page of entries and the cursor for the next page (None on the last page)."""
+    sort = args.get("sort") if args.get("sort") in ENTRY_SORT_COLUMNS else "id"
+    direction, op = ("DESC", "<") if args.get("order") == "desc" else ("ASC", ">")
+    try:
+        page_size = min(max(int(args.get("page_size", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = DEFAULT_PAGE_SIZE
+    where, params = entry_filters(args)
+    # Old rows may have NULL year / room; sort them as blanks so the keyset stays total
+    key = "id" if sort == "id" else f"IFNULL({sort}, '')"
+    cursor = decode_cursor(args.get("cursor", ""))
+    if cursor:
+        value, last_id = cursor
+        if sort == "id":
+            where += f" AND id {op} ?"
+            params.append(last_id)
+        else:
+            where += f" AND ({key} {op} ? OR ({key} = ? AND id {op} ?))"
+            params += [value, value, last_id]
+    order = f"id {direction}" if sort == "id" else f"{key} {direction}, id {direction}"
+    rows = db.execute(f"SELECT * FROM timetable WHERE {where} ORDER BY {order} LIMIT ?", params + [page_size + 1]).fetchall()
+    if len(rows) <= page_size:
+        return rows, None
+    last = rows[page_size - 1]
+    value = last["id"] if sort == "id" else (last[sort] or "")
+    return rows[:page_size], encode_cursor(value, last["id"])
+
 # Dashboard route
 @app.route("/dashboard")
 def dashboard():
     if "username" not in session:
         return redirect(url_for("login"))
     db = get_db()
+    # Read before anything else, so the live updates start from no later than what the page shows
+    change_seq = change_feed.bounds(db)[1]
 
-    # Filter parameters
-    staff_name = request.args.get("staff_name")
-    department = request.args.get("department")
-    year = request.args.get("year")
-
-    query = "SELECT * FROM timetable WHERE 1=1"
-    params = []
-
-    if staff_name:
-        query += " AND staff_name = ?"
-        params.append(staff_name)
-    if department:
-        query += " AND department = ?"
-        params.append(department)
-    if year:
-        query += " AND year = ?"
-        params.append(year)
-
-    entries = db.execute(query, params).fetchall()
-
-    # Get distinct values for filter buttons
-    departments = db.execute("SELECT DISTINCT department FROM timetable WHERE department != '' ORDER BY department").fetchall()
-    years = db.execute("SELECT DISTINCT year FROM timetable WHERE year != '' ORDER BY year").fetchall()
-    semesters = db.execute("SELECT DISTINCT semester FROM timetable WHERE semester != '' ORDER BY semester").fetchall()
-    staff_list = db.execute("SELECT DISTINCT staff_name FROM timetable WHERE staff_name != '' ORDER BY staff_name").fetchall()
-
-    # Analytics Data for Charts
-    dept_counts = db.execute("SELECT department, COUNT(*) as count FROM timetable GROUP BY department").fetchall()
-    staff_counts = db.execute("SELECT staff_name, COUNT(*) as count FROM timetable GROUP BY staff_name").fetchall()
-    
-    # Prepare data for frontend (Lists for Chart.js)
-    dept_analytics = {"labels": [row["department"] for row in dept_counts], "data": [row["count"] for row in dept_counts]}
-    staff_analytics = {"labels": [row["staff_name"] for row in staff_counts], "data": [row["count"] for row in staff_counts]}
+    # One page of the entry list, with filters, search and sorting
+    entries, next_cursor = fetch_entry_page(db, request.args)
+    page_args = request.args.to_dict()
+    page_args.pop("cursor", None)
+    first_page_url = url_for("dashboard", **page_args) if request.args.get("cursor") else None
+    next_page_url = url_for("dashboard", **dict(page_args, cursor=next_cursor)) if next_cursor else None
+
+    # Filter buttons and chart data come from the cached summary
+    summary = cached_by_revision(db, "dashboard_summary", build_dashboard_summary)
+    departments = summary["departments"]
+    years = summary["years"]
+    semesters = summary["semesters"]
+    staff_list = summary["staff_list"]
 
     # Logic for Grid View (Department Wise or Staff Wise)
     mode = request.args.get("mode")
@@ -226,8 +3530,10 @@ def dashboard():
         session['export_staff'] = request.args.get("staff_name")
 
     grid_view = False
-    schedule = {d: {t: None for t in time_slots} for d in days}
+    calendar = calendar_registry.get(db)
+    schedule = calendar.empty_schedule(None)
     filter_desc = ""
+    hidden = []
 
     if mode == 'dept':
         dept = request.args.get("department")
@@ -236,233 +3542,1069 @@ def dashboard():
         if dept and yr and sem:
             grid_view = True
             filter_desc = f"Class Timetable: {dept} - Year {yr} - Semester {sem}"
-            rows = db.execute("SELECT * FROM timetable WHERE department=? AND year=? AND semester=?", (dept, yr, sem)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    schedule[row["day"]][row["time"]] = row
+            grid = get_grid(db, mode, (dept, yr, sem))
+            calendar, schedule = grid.calendar, grid.schedule()
 
     elif mode == 'staff':
         staff = request.args.get("staff_name")
         if staff:
             grid_view = True
             filter_desc = f"Staff Timetable: {staff}"
-            rows = db.execute("SELECT * FROM timetable WHERE staff_name=?", (staff,)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    schedule[row["day"]][row["time"]] = row
+            grid = get_grid(db, mode, staff)
+            calendar, schedule = grid.calendar, grid.schedule()
+            hidden = grid.hidden
 
-    return render_template("dashboard.html", entries=entries, departments=departments, years=years, semesters=semesters, staff_list=staff_list, time_slots=time_slots, days=days, grid_view=grid_view, schedule=schedule, filter_desc=filter_desc, username=session.get("username", "Guest"), dept_analytics=dept_analytics, staff_analytics=staff_analytics)
+    # Only a grid is patched live; the entry list alone is refreshed on request
+    live_url = change_stream_url(change_seq, *change_view(request.args)) if grid_view else None
+    return render_template("dashboard.html", live_url=live_url, entries=entries, first_page_url=first_page_url, next_page_url=next_page_url, sort_columns=ENTRY_SORT_COLUMNS, departments=departments, years=years, semesters=semesters, staff_list=staff_list, time_slots=calendar.time_slots, days=calendar.day_labels, pauses=calendar.pause_labels, grid_view=grid_view, schedule=schedule, filter_desc=filter_desc, hidden=hidden, username=session.get("username", "Guest"))
 
-# Export Excel Route
-@app.route("/export_excel")
-def export_excel():
-    db = get_db()
+# Streamed entry listing: rows go out as they are read, so memory stays flat
+# however large the table is. NDJSON by default, ?format=json for one array.
+@app.route("/api/entries")
+def entries_stream():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    where, params = entry_filters(request.args)
+    as_array = request.args.get("format") == "json"
+    columns = ["id", "staff_name", "department", "year", "semester", "subject", "room", "day", "time"]
+
+    def generate():
+        # A connection of its own: the response outlives the request's get_db()
+        conn = connect_db()
+        try:
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM timetable WHERE {where} ORDER BY id", params)
+            if as_array:
+                yield "["
+            first = True
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                for row in rows:
+                    line = json.dumps(dict(zip(columns, row)))
+                    if as_array:
+                        yield line if first else "," + line
+                    else:
+                        yield line + "\n"
+                    first = False
+            if as_array:
+                yield "]"
+        finally:
+            conn.close()
+
+    mimetype = "application/json" if as_array else "application/x-ndjson"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# Chart data for the dashboard, fetched by the browser after the page loads
+@app.route("/api/analytics")
+def analytics():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    summary = cached_by_revision(get_db(), "dashboard_summary", build_dashboard_summary)
+    return {"departments": summary["dept_analytics"], "staff": summary["staff_analytics"]}
+
+# Workload report: per staff member and class metrics and soft-limit
+# violations, for the dashboard and for tools that balance timetables
+@app.route("/api/workload")
+def workload():
+    if "username" not in session:
+        return redirect(url_for("login"))
     try:
-        import openpyxl
-        from openpyxl.styles import Alignment, Font, Border, Side
-        from openpyxl.utils import get_column_letter
+        report = cached_by_revision(get_db(), "workload", build_workload_report)
     except ImportError:
-        flash("Error: 'openpyxl' library is missing. Please install it using 'pip install openpyxl'.")
-        return redirect(url_for('dashboard'))
+        return {"error": "The workload report requires numpy. Please install it."}, 503
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        report = dict(report, staff=report["staff"][:limit])
+        report["class"] = report["class"][:limit]
+    return report
 
-    # Try to get params from URL, otherwise fall back to session
-    mode = request.args.get("mode") or session.get('export_mode')
-    schedule = {d: {t: "" for t in time_slots} for d in days}
-    filename = "timetable.xlsx"
+# Live updates: a server-sent event stream of the change feed (see
+# ChangeFeed). The browser's EventSource reconnects on its own and sends the
+# id of the last event it saw as Last-Event-ID, so nothing is missed in between.
+# A stream holds its worker thread, so by default it only sends what is
+# pending and ends, and the browser polls by reconnecting every
+# CHANGE_RETRY_MS; with an async worker class CHANGE_STREAM_SECONDS can
+# keep streams open instead.
+def change_view(args):
+    """(mode, key) of the class or staff timetable a live view shows, or (None, None) for every change."""
+    mode = args.get("mode")
+    if mode == "dept" and args.get("department") and args.get("semester"):
+        return mode, class_key(args["department"], args.get("year", ""), args["semester"])
+    if mode == "staff" and args.get("staff_name"):
+        return mode, args["staff_name"]
+    return None, None
+
+def change_stream_url(seq, mode=None, key=None):
+    """Stream URL for a page rendered at change ``seq``, so it gets every change made after that."""
+    if mode == "dept":
+        return url_for("change_stream", since=seq, mode=mode, department=key[0], year=key[1], semester=key[2])
+    if mode == "staff":
+        return url_for("change_stream", since=seq, mode=mode, staff_name=key)
+    return url_for("change_stream", since=seq)
+
+@app.route("/api/changes")
+def change_stream():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    mode, key = change_view(request.args)
+    position = request.headers.get("Last-Event-ID") or request.args.get("since", "")
+    since = int(position) if position.isdigit() else None
+    hold = app.config["CHANGE_STREAM_SECONDS"]
+
+    def generate():
+        # A connection of its own: the stream outlives the request's get_db()
+        conn = connect_db()
+        try:
+            seq = change_feed.bounds(conn)[1] if since is None else since
+            calendars = read_calendar_revision(conn)
+            generation = change_feed.generation
+            yield f"retry: {CHANGE_RETRY_MS}\nid: {seq}\n\n"
+            deadline = perf_counter() + hold
+            last_sent = perf_counter()
+            while True:
+                # A changed calendar moves cells around, so the page has to be rebuilt
+                if read_calendar_revision(conn) != calendars:
+                    deltas, newest = None, change_feed.bounds(conn)[1]
+                else:
+                    deltas, newest = change_feed.read(conn, seq, mode, key)
+                if deltas is None:
+                    yield f"event: reset\nid: {newest}\ndata: {json.dumps({'seq': newest})}\n\n"
+                    return
+                for delta in deltas:
+                    yield f"event: change\nid: {delta['seq']}\ndata: {json.dumps(delta)}\n\n"
+                if newest != seq:
+                    if not deltas or deltas[-1]["seq"] != newest:
+                        # Changes to other timetables still move the resume point on
+                        # (an id with no data updates it without firing an event)
+                        yield f"id: {newest}\n\n"
+                    last_sent = perf_counter()
+                elif perf_counter() - last_sent > 15:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    last_sent = perf_counter()
+                seq = newest
+                if perf_counter() >= deadline:
+                    return
+                generation = change_feed.wait(generation)
+        finally:
+            conn.close()
 
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Timetable exports
+#
+# The document builders below take plain data (a title, a {day: {time: text}}
+# schedule and its Calendar) so the single-timetable routes and the bulk export, which renders in
+# worker processes, share them.
+def export_target(args):
+    """(mode, key) of the timetable to export, from the URL or else the dashboard's last view."""
+    # Try to get params from URL, otherwise fall back to session
+    mode = args.get("mode") or session.get('export_mode')
     if mode == 'dept':
-        dept = request.args.get("department") or session.get('export_dept')
-        yr = request.args.get("year") or session.get('export_year')
-        sem = request.args.get("semester") or session.get('export_sem')
+        dept = args.get("department") or session.get('export_dept')
+        yr = args.get("year") or session.get('export_year')
+        sem = args.get("semester") or session.get('export_sem')
         if dept and yr and sem:
-            filename = f"{dept}_{yr}_Sem{sem}_timetable.xlsx"
-            rows = db.execute("SELECT * FROM timetable WHERE department=? AND year=? AND semester=?", (dept, yr, sem)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    # Format: Subject (Staff Name) [Room]
-                    room_str = f" [{row['room']}]" if row['room'] else ""
-                    schedule[row["day"]][row["time"]] = f"{row['subject']} ({row['staff_name']}){room_str}"
-
+            return mode, (dept, yr, sem)
     elif mode == 'staff':
-        staff = request.args.get("staff_name") or session.get('export_staff')
+        staff = args.get("staff_name") or session.get('export_staff')
         if staff:
-            filename = f"{staff}_timetable.xlsx"
-            rows = db.execute("SELECT * FROM timetable WHERE staff_name=?", (staff,)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    # Format: Subject (Dept - Y:Year) [Room]
-                    room_str = f" [{row['room']}]" if row['room'] else ""
-                    schedule[row["day"]][row["time"]] = f"{row['subject']} ({row['department']} - Y:{row['year']}){room_str}"
-
-    # Generate Excel with openpyxl
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Timetable"
-    
+            return mode, staff
+    return mode, None
+
+def export_names(mode, key):
+    """(file name stem, PDF title) for a class or staff timetable."""
+    if mode == 'dept':
+        dept, yr, sem = key
+        return f"{dept}_{yr}_Sem{sem}_timetable", f"Department: {dept} | Year: {yr} | Sem: {sem}"
+    return f"{key}_timetable", f"Staff: {key}"
+
+HIDDEN_NOTE = " | Not shown (day not on this calendar): "
+
+def export_title(title, grid):
+    """``title`` with a note of any entries the grid has no period for, so an export never leaves one out silently."""
+    if not grid.hidden:
+        return title
+    return title + HIDDEN_NOTE + "; ".join(
+        f"{e['subject']} ({e['department']} - Y:{e['year']}) {e['day']} {e['time']}" for e in grid.hidden)
+
+def export_schedule(grid):
+    """{day: {time: cell text}} of a grid, in the exporters' cell format."""
+    calendar = grid.calendar
+    schedule = calendar.empty_schedule()
+    for bit, i in enumerate(grid.cells):
+        if i < 0:
+            continue
+        row = grid.entries[i]
+        day = calendar.day_labels[bit // calendar.slots_per_day]
+        t = calendar.time_slots[bit % calendar.slots_per_day]
+        room_str = f" [{row['room']}]" if row['room'] else ""
+        if grid.mode == 'dept':
+            # Format: Subject (Staff Name) [Room]
+            schedule[day][t] = f"{row['subject']} ({row['staff_name']}){room_str}"
+        else:
+            # Format: Subject (Dept - Y:Year) [Room]
+            schedule[day][t] = f"{row['subject']} ({row['department']} - Y:{row['year']}){room_str}"
+    return schedule
+
+def fill_timetable_sheet(ws, schedule, calendar=DEFAULT_CALENDAR):
+    """Write one weekly grid, with a column for each break, into an openpyxl worksheet."""
+    from openpyxl.styles import Alignment, Font, Border, Side
+    from openpyxl.utils import get_column_letter
+
     # Styles
     bold_font = Font(bold=True)
     center_align = Alignment(horizontal='center', vertical='center', wrap_text=True)
     border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    
+
     # Write Header Row
     ws.cell(row=1, column=1, value="Day").font = bold_font
-    
+
     col_idx = 2
     col_map = {} # Map slot time to column index
-    break_col_idx = -1
-    lunch_col_idx = -1
+    pause_cols = [] # (column index, break label) of each narrow break column
 
-    for slot in time_slots:
+    for slot in calendar.time_slots:
         ws.cell(row=1, column=col_idx, value=slot).font = bold_font
         col_map[slot] = col_idx
         col_idx += 1
-        
-        if slot == "9:20 - 10:10":
-            ws.cell(row=1, column=col_idx, value="").font = bold_font
-            ws.column_dimensions[get_column_letter(col_idx)].width = 3 # Narrow column
-            break_col_idx = col_idx
-            col_idx += 1
-            
-        if slot == "11:10 - 12:00":
+
+        if slot in calendar.pause_labels:
             ws.cell(row=1, column=col_idx, value="").font = bold_font
             ws.column_dimensions[get_column_letter(col_idx)].width = 3 # Narrow column
-            lunch_col_idx = col_idx
+            pause_cols.append((col_idx, calendar.pause_labels[slot].upper()))
             col_idx += 1
 
     # Write Data Rows
-    break_letters = ["B", "R", "E", "A", "K"]
-    lunch_letters = ["L", "U", "N", "C", "H"]
-
-    for row_idx, d in enumerate(days, start=2):
+    for row_idx, d in enumerate(calendar.day_labels, start=2):
         day_index = row_idx - 2
         ws.cell(row=row_idx, column=1, value=d).alignment = center_align
-        for slot in time_slots:
+        for slot in calendar.time_slots:
             val = schedule[d][slot] or "-"
             ws.cell(row=row_idx, column=col_map[slot], value=val).alignment = center_align
-        
-        # Add Break Letter (B, R, E, A, K)
-        if break_col_idx != -1 and day_index < len(break_letters):
-            cell = ws.cell(row=row_idx, column=break_col_idx, value=break_letters[day_index])
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = bold_font
-
-        # Add Lunch Letter (L, U, N, C, H)
-        if lunch_col_idx != -1 and day_index < len(lunch_letters):
-            cell = ws.cell(row=row_idx, column=lunch_col_idx, value=lunch_letters[day_index])
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = bold_font
+
+        # Spell the break label down its column, one letter per day (B, R, E, A, K)
+        for pause_col, letters in pause_cols:
+            if day_index < len(letters):
+                cell = ws.cell(row=row_idx, column=pause_col, value=letters[day_index])
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.font = bold_font
 
     # Apply borders
-    end_row = 2 + len(days) - 1
+    end_row = 2 + len(calendar.day_labels) - 1
     for row in ws.iter_rows(min_row=1, max_row=end_row, min_col=1, max_col=col_idx-1):
         for cell in row:
             cell.border = border
 
+def render_excel(title, schedule, calendar=DEFAULT_CALENDAR):
+    import openpyxl
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Timetable"
+    fill_timetable_sheet(ws, schedule, calendar)
+    if HIDDEN_NOTE in title:
+        # The sheet has no title row, so the note goes under the grid
+        ws.cell(row=len(calendar.day_labels) + 3, column=1, value=HIDDEN_NOTE.lstrip(" |") + title.split(HIDDEN_NOTE, 1)[1])
     out = io.BytesIO()
     wb.save(out)
-    out.seek(0)
+    return out.getvalue()
+
+# PDF documents come from one Jinja template, compiled once per process, with
+# the stylesheet written into it once and every value escaped. A document can
+# hold any number of timetables, each starting on a new page, so exporting
+# many of them costs one xhtml2pdf run instead of one per timetable.
+PDF_TEMPLATE = jinja2.Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True).from_string("""
+<html>
+<head>
+    <style>
+        @page { size: landscape; margin: 1cm; }
+        body { font-family: Helvetica, sans-serif; }
+        h2 { text-align: center; color: #333; }
+        h2.next-page { page-break-before: always; }
+        table { width: 100%; border-collapse: collapse; margin-top: 20px; }
+        th, td { border: 1px solid #444; padding: 6px; text-align: center; font-size: 10px; }
+        th { background-color: #f2f2f2; font-weight: bold; }
+        .break-col { background-color: #e0e0e0; color: #555; font-weight: bold; vertical-align: middle; width: 15px; }
+        .day { background-color: #eee; font-weight: bold; width: 80px; }
+    </style>
+</head>
+<body>
+{% for title, schedule, calendar in timetables %}
+{% set pauses = calendar.pause_labels %}
+    <h2{% if not loop.first %} class="next-page"{% endif %}>{{ title }}</h2>
+    <table>
+        <thead>
+            <tr>
+                <th>Day / Time</th>
+                {% for t in calendar.time_slots %}<th>{{ t }}</th>{% if t in pauses %}<th class="break-col"></th>{% endif %}{% endfor %}
+
+            </tr>
+        </thead>
+        <tbody>
+        {% for d in calendar.day_labels %}
+        {% set i = loop.index0 %}
+            <tr><td class="day">{{ d }}</td>{% for t in calendar.time_slots %}<td>{{ schedule[d][t] or "-" }}</td>{% if t in pauses %}{% set letters = pauses[t] | upper %}<td class="break-col">{{ letters[i] if i < letters | length else "" }}</td>{% endif %}{% endfor %}</tr>
+        {% endfor %}
+        </tbody>
+    </table>
+{% endfor %}
+</body>
+</html>
+""")
+
+def render_pdf_html(timetables):
+    """HTML for xhtml2pdf of (title, schedule, calendar) timetables, one per page."""
+    return PDF_TEMPLATE.render(timetables=timetables)
+
+def write_pdf(timetables, out):
+    """Write (title, schedule, calendar) timetables as one PDF, a page or more each, into ``out``.
+
+    Uses a single CreatePDF call however many timetables there are.
+    Returns False if xhtml2pdf reports an error.
+    """
+    from xhtml2pdf import pisa
+    return not pisa.CreatePDF(render_pdf_html(timetables), dest=out).err
+
+def render_pdf(title, schedule, calendar=DEFAULT_CALENDAR):
+    """PDF bytes for one timetable, or None if xhtml2pdf reports an error."""
+    pdf = io.BytesIO()
+    if not write_pdf([(title, schedule, calendar)], pdf):
+        return None
+    return pdf.getvalue()
+
+# Export Excel Route
+@app.route("/export_excel")
+def export_excel():
+    db = get_db()
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        flash("Error: 'openpyxl' library is missing. Please install it using 'pip install openpyxl'.")
+        return redirect(url_for('dashboard'))
 
-    output = make_response(out.getvalue())
-    output.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    output.headers["Content-type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    return output
+    mode, key = export_target(request.args)
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    if not key:
+        schedule = DEFAULT_CALENDAR.empty_schedule()
+        return export_response(render_excel("Timetable", schedule), None, "timetable.xlsx", mimetype)
+
+    if request.args.get("background") == "1":
+        return submit_job("export_xlsx", {"mode": mode, "key": key})
+    stem, title = export_names(mode, key)
+    grid = get_grid(db, mode, key)
+    data, etag = cached_export(db, mode, key, "xlsx", lambda: render_excel(export_title(title, grid), export_schedule(grid), grid.calendar))
+    return export_response(data, etag, f"{stem}.xlsx", mimetype)
 
 @app.route("/export_pdf")
 def export_pdf():
     db = get_db()
     try:
-        from xhtml2pdf import pisa
+        from xhtml2pdf import pisa  # noqa: F401
     except ImportError:
         flash("Error: 'xhtml2pdf' library is missing. Please install it using 'pip install xhtml2pdf'.")
         return redirect(url_for('dashboard'))
 
-    mode = request.args.get("mode") or session.get('export_mode')
-    schedule = {d: {t: "" for t in time_slots} for d in days}
-    filename = "timetable.pdf"
-    title = "Timetable"
+    mode, key = export_target(request.args)
+    if not key:
+        pdf, etag, filename = render_pdf("Timetable", DEFAULT_CALENDAR.empty_schedule()), None, "timetable.pdf"
+    elif request.args.get("background") == "1":
+        return submit_job("export_pdf", {"mode": mode, "key": key})
+    else:
+        stem, title = export_names(mode, key)
+        filename = f"{stem}.pdf"
+        grid = get_grid(db, mode, key)
+        # Create PDF (only when this timetable changed since it was last built)
+        pdf, etag = cached_export(db, mode, key, "pdf", lambda: render_pdf(export_title(title, grid), export_schedule(grid), grid.calendar))
 
-    if mode == 'dept':
-        dept = request.args.get("department") or session.get('export_dept')
-        yr = request.args.get("year") or session.get('export_year')
-        sem = request.args.get("semester") or session.get('export_sem')
-        if dept and yr and sem:
-            filename = f"{dept}_{yr}_Sem{sem}_timetable.pdf"
-            title = f"Department: {dept} | Year: {yr} | Sem: {sem}"
-            rows = db.execute("SELECT * FROM timetable WHERE department=? AND year=? AND semester=?", (dept, yr, sem)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    room_str = f" [{row['room']}]" if row['room'] else ""
-                    schedule[row["day"]][row["time"]] = f"{row['subject']} ({row['staff_name']}){room_str}"
+    if pdf is None:
+        return "Error generating PDF", 500
+    return export_response(pdf, etag, filename, "application/pdf")
 
-    elif mode == 'staff':
-        staff = request.args.get("staff_name") or session.get('export_staff')
-        if staff:
-            filename = f"{staff}_timetable.pdf"
-            title = f"Staff: {staff}"
-            rows = db.execute("SELECT * FROM timetable WHERE staff_name=?", (staff,)).fetchall()
-            for row in rows:
-                if row["day"] in schedule and row["time"] in schedule[row["day"]]:
-                    room_str = f" [{row['room']}]" if row['room'] else ""
-                    schedule[row["day"]][row["time"]] = f"{row['subject']} ({row['department']} - Y:{row['year']}){room_str}"
-
-    # Generate HTML for PDF
-    html_content = f"""
-    <html>
-    <head>
-        <style>
-            @page {{ size: landscape; margin: 1cm; }}
-            body {{ font-family: Helvetica, sans-serif; }}
-            h2 {{ text-align: center; color: #333; }}
-            table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-            th, td {{ border: 1px solid #444; padding: 6px; text-align: center; font-size: 10px; }}
-            th {{ background-color: #f2f2f2; font-weight: bold; }}
-            .break-col {{ background-color: #e0e0e0; color: #555; font-weight: bold; vertical-align: middle; width: 15px; }}
-            .day {{ background-color: #eee; font-weight: bold; width: 80px; }}
-        </style>
-    </head>
-    <body>
-        <h2>{title}</h2>
-        <table>
-            <thead>
-                <tr>
-                    <th>Day / Time</th>
-                    {''.join([f'<th>{t}</th>' + ('<th class="break-col"></th>' if t == "9:20 - 10:10" else '') + ('<th class="break-col"></th>' if t == "11:10 - 12:00" else '') for t in time_slots])}
-                </tr>
-            </thead>
-            <tbody>
+# Generated documents, keyed by what they were built from: (mode, key, format,
+# database id, entity revision). A changed timetable has a new revision and so
+# a new key; the database id keeps a recreated or restored database, whose
+# counters start again, from reading the files of the old one on disk. Old
+# entries are dropped on write and otherwise age out of the LRU.
+class ExportCache:
+    """Size-bounded LRU of export bytes in memory, backed by a size-bounded directory on disk."""
+
+    def __init__(self, directory, memory_bytes=64 * 1024 * 1024, disk_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._by_entity = {}
+
+    @staticmethod
+    def digest(cache_key):
+        return hashlib.sha1(repr(cache_key).encode()).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def get(self, cache_key):
+        digest = self.digest(cache_key)
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                return data
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read()
+            os.utime(self._path(digest))
+        except OSError:
+            return None
+        self._remember(digest, data, cache_key)
+        return data
+
+    def put(self, cache_key, data):
+        digest = self.digest(cache_key)
+        self._remember(digest, data, cache_key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename so other workers never read a partial file
+            tmp = self._path(digest) + f".{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(digest))
+            self._trim_disk()
+        except OSError as e:
+            app.logger.warning("Export cache write failed: %s", e)
+
+    def _remember(self, digest, data, cache_key):
+        mode, key = cache_key[0], cache_key[1]
+        with self._lock:
+            if digest in self._memory:
+                self._memory_size -= len(self._memory.pop(digest))
+            self._memory[digest] = data
+            self._memory_size += len(data)
+            self._by_entity.setdefault(entity_name(mode, key), set()).add(digest)
+            while self._memory_size > self.memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _trim_disk(self):
+        try:
+            files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if not name.endswith(".tmp")]
+            stats = sorted(((os.stat(p), p) for p in files), key=lambda item: item[0].st_mtime)
+        except OSError:
+            return
+        total = sum(st.st_size for st, _ in stats)
+        for st, path in stats:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= st.st_size
+
+    def invalidate(self, entities):
+        """Drop every cached document of the given entities."""
+        with self._lock:
+            digests = set()
+            for entity in entities:
+                digests |= self._by_entity.pop(entity, set())
+            for digest in digests:
+                data = self._memory.pop(digest, None)
+                if data is not None:
+                    self._memory_size -= len(data)
+        for digest in digests:
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+export_cache = ExportCache(os.path.join(DB_DIR, "export_cache"))
+# Bump when the document layout changes so cached files from older code are not served
+EXPORT_CACHE_VERSION = 3
+
+def cached_export(db, mode, key, fmt, build):
+    """(bytes, etag) of an export, built with build() only when the timetable changed."""
+    cache_key = (mode, key, fmt, read_database_id(db), entity_revision(db, mode, key), read_calendar_revision(db),
+                 EXPORT_CACHE_VERSION)
+    etag = ExportCache.digest(cache_key)
+    data = export_cache.get(cache_key)
+    if data is None:
+        started = perf_counter()
+        data = build()
+        if app.config["METRICS"]:
+            metrics.observe("timetable_export_seconds", perf_counter() - started, format=fmt)
+        if data is not None:
+            export_cache.put(cache_key, data)
+    return data, etag
+
+def export_response(data, etag, filename, mimetype):
+    response = make_response(data)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.headers["Content-Type"] = mimetype
+    if etag:
+        # Let browsers revalidate and get a 304 while the timetable is unchanged
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response = response.make_conditional(request)
+    return response
+
+# Bulk export: every class and staff timetable from one table scan, rendered
+# across a process pool (xhtml2pdf is CPU-bound) and written into one ZIP
+EXPORT_FORMATS = {"xlsx": render_excel, "pdf": render_pdf}
+
+def group_export_rows(rows, by=("dept", "staff")):
+    """{(mode, key): [rows]} for every class and / or staff member in ``rows``."""
+    groups = {}
+    for row in rows:
+        if "dept" in by and row["department"]:
+            groups.setdefault(("dept", (row["department"], row["year"], row["semester"])), []).append(row)
+        if "staff" in by and row["staff_name"]:
+            groups.setdefault(("staff", row["staff_name"]), []).append(row)
+    return groups
+
+def _safe_filename(name):
+    return "".join(c if c.isalnum() or c in " ._-" else "_" for c in name).strip() or "timetable"
+
+def _render_export_job(job):
+    fmt, arcname, title, schedule, calendar = job
+    return arcname, EXPORT_FORMATS[fmt](title, schedule, calendar)
+
+def group_grid(mode, key, group, calendars):
+    """Grid of one group from group_export_rows(), on the calendar most of its rows are on (see CalendarRegistry.for_entity)."""
+    counts = {}
+    for row in group:
+        counts[row["calendar_id"]] = counts.get(row["calendar_id"], 0) + 1
+    calendar_id = min(counts, key=lambda c: (-counts[c], c))
+    return TimetableGrid(mode, key, group, calendars.get(calendar_id, DEFAULT_CALENDAR), calendars)
+
+def build_export_zip(rows, out, formats=("xlsx", "pdf"), by=("dept", "staff"), workers=None, calendars=None, progress=None):
+    """Write every timetable in ``rows`` into a ZIP file object; returns the list of files that failed to render.
+
+    ``calendars`` maps calendar ids to Calendar objects (see CalendarRegistry.by_id).
+    ``progress(fraction, message)`` is called after each file, if given.
     """
-    
-    break_letters = ["B", "R", "E", "A", "K"]
-    lunch_letters = ["L", "U", "N", "C", "H"]
-
-    for i, d in enumerate(days):
-        html_content += f'<tr><td class="day">{d}</td>'
-        for t in time_slots:
-            html_content += f'<td>{schedule[d][t] or "-"}</td>'
-            if t == "9:20 - 10:10":
-                html_content += f'<td class="break-col">{break_letters[i] if i < len(break_letters) else ""}</td>'
-            if t == "11:10 - 12:00":
-                html_content += f'<td class="break-col">{lunch_letters[i] if i < len(lunch_letters) else ""}</td>'
-        html_content += '</tr>'
-
-    html_content += """
-            </tbody>
-        </table>
-    </body>
-    </html>
+    calendars = calendars or {DEFAULT_CALENDAR_ID: DEFAULT_CALENDAR}
+    jobs = []
+    for (mode, key), group in sorted(group_export_rows(rows, by).items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        stem, title = export_names(mode, key)
+        grid = group_grid(mode, key, group, calendars)
+        schedule = export_schedule(grid)
+        folder = "classes" if mode == "dept" else "staff"
+        for fmt in formats:
+            jobs.append((fmt, f"{folder}/{_safe_filename(stem)}.{fmt}", export_title(title, grid), schedule, grid.calendar))
+
+    failed = []
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+        if len(jobs) < 4 or workers == 1:
+            results = map(_render_export_job, jobs)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            results = pool.map(_render_export_job, jobs, chunksize=max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4)))
+        try:
+            # Results arrive in job order, so each file is written as soon as it is ready
+            for done, (arcname, data) in enumerate(results, start=1):
+                if data is None:
+                    failed.append(arcname)
+                else:
+                    archive.writestr(arcname, data)
+                if progress:
+                    progress(done / len(jobs), f"{done} of {len(jobs)} files")
+        finally:
+            if pool is not None:
+                # Drop the renders not started yet if progress() gave up early
+                pool.shutdown(cancel_futures=True)
+    return failed
+
+def build_combined_pdf(rows, out, by=("dept", "staff"), calendars=None, progress=None):
+    """Every timetable in ``rows`` as one PDF, each starting on a new page, written into ``out``.
+
+    Rendered in a single xhtml2pdf run, so it cannot report progress or be
+    cancelled part way; raises ValueError if xhtml2pdf reports an error.
     """
+    calendars = calendars or {DEFAULT_CALENDAR_ID: DEFAULT_CALENDAR}
+    timetables = []
+    for (mode, key), group in sorted(group_export_rows(rows, by).items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        grid = group_grid(mode, key, group, calendars)
+        timetables.append((export_title(export_names(mode, key)[1], grid), export_schedule(grid), grid.calendar))
+    if progress:
+        progress(0, f"Rendering {len(timetables)} timetables")
+    if not timetables:
+        timetables.append(("Timetable", DEFAULT_CALENDAR.empty_schedule(), DEFAULT_CALENDAR))
+    if not write_pdf(timetables, out):
+        raise ValueError("Error generating PDF")
 
-    # Create PDF
-    pdf = io.BytesIO()
-    pisa_status = pisa.CreatePDF(io.StringIO(html_content), dest=pdf)
+def build_class_workbook(rows, out, calendars=None, progress=None):
+    """One workbook with a sheet per class timetable."""
+    import openpyxl
+    calendars = calendars or {DEFAULT_CALENDAR_ID: DEFAULT_CALENDAR}
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    used = set()
+    groups = sorted(group_export_rows(rows, by=("dept",)).items(), key=lambda item: item[0][1])
+    for done, ((mode, key), group) in enumerate(groups, start=1):
+        dept, yr, sem = key
+        # Sheet titles are limited to 31 characters and must be unique
+        base = _safe_filename(f"{dept} Y{yr} S{sem}")[:31]
+        title, n = base, 1
+        while title.lower() in used:
+            n += 1
+            title = f"{base[:27]} ({n})"
+        used.add(title.lower())
+        grid = group_grid(mode, key, group, calendars)
+        fill_timetable_sheet(wb.create_sheet(title), export_schedule(grid), grid.calendar)
+        if progress:
+            progress(done / len(groups), f"{done} of {len(groups)} classes")
+    if not wb.sheetnames:
+        wb.create_sheet("Timetable")
+    wb.save(out)
 
-    if pisa_status.err:
-        return "Error generating PDF", 500
+@app.route("/export_all")
+def export_all():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    fmt = "pdf" if request.args.get("combined") else request.args.get("format", "both")
+    formats = ("xlsx", "pdf") if fmt == "both" else (fmt,)
+    by = {"class": ("dept",), "staff": ("staff",)}.get(request.args.get("by"), ("dept", "staff"))
+    try:
+        import openpyxl  # noqa: F401
+        if "pdf" in formats:
+            from xhtml2pdf import pisa  # noqa: F401
+    except ImportError as e:
+        flash(f"Error: '{e.name}' library is missing. Please install it using 'pip install {e.name}'.")
+        return redirect(url_for('dashboard'))
+    if any(f not in EXPORT_FORMATS for f in formats):
+        return "Unknown export format", 400
+    if request.args.get("background") == "1":
+        return submit_job("export_all", {"formats": list(formats), "by": list(by), "workbook": bool(request.args.get("workbook")),
+                                         "combined": bool(request.args.get("combined"))})
 
-    response = make_response(pdf.getvalue())
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
+    db = get_db()
+    rows = db.execute("SELECT * FROM timetable").fetchall()
+    calendars = calendar_registry.sync(db).by_id
+    # Spill to disk past a few MB so a large export does not sit in memory
+    out = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    started = perf_counter()
+    if request.args.get("workbook"):
+        build_class_workbook(rows, out, calendars)
+        download_name, mimetype = "all_classes_timetable.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    elif request.args.get("combined"):
+        try:
+            build_combined_pdf(rows, out, by=by, calendars=calendars)
+        except ValueError:
+            return "Error generating PDF", 500
+        download_name, mimetype = "timetables.pdf", "application/pdf"
+    else:
+        build_export_zip(rows, out, formats=formats, by=by, calendars=calendars)
+        download_name, mimetype = "timetables.zip", "application/zip"
+    if app.config["METRICS"]:
+        kind = "workbook" if request.args.get("workbook") else "combined_pdf" if request.args.get("combined") else "zip"
+        metrics.observe("timetable_export_seconds", perf_counter() - started, format=kind)
+    out.seek(0)
+    return send_file(out, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+@app.cli.command("export-all")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["xlsx", "pdf", "both"]), default="both")
+@click.option("--workbook", is_flag=True, help="Write one workbook with a sheet per class instead of a ZIP.")
+@click.option("--combined", is_flag=True, help="Write one PDF with a page per timetable instead of a ZIP.")
+@click.option("--workers", type=int, default=None, help="Render processes (default: CPU count).")
+def export_all_command(path, fmt, workbook, combined, workers):
+    """Export every class and staff timetable into one file."""
+    init_db()
+    started = perf_counter()
+    db = get_db()
+    rows = db.execute("SELECT * FROM timetable").fetchall()
+    calendars = calendar_registry.sync(db).by_id
+    with open(path, "wb") as out:
+        if workbook:
+            build_class_workbook(rows, out, calendars)
+        elif combined:
+            try:
+                build_combined_pdf(rows, out, calendars=calendars)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        else:
+            failed = build_export_zip(rows, out, formats=("xlsx", "pdf") if fmt == "both" else (fmt,), workers=workers, calendars=calendars)
+            for name in failed:
+                click.echo(f"Failed to render {name}", err=True)
+    click.echo(f"Wrote {path} in {perf_counter() - started:.2f}s.")
+
+# Background jobs: slow work (exports, imports, optimizer runs) is queued in
+# the jobs table and run by worker threads in a separate `flask run-jobs`
+# process, or, with JOB_WORKERS set, in each web process as well. An identical job
+# that is still queued or running is shared instead of queued again; results
+# are kept on disk until JOB_RESULT_TTL after the job finished.
+JOB_DIR = os.path.join(DB_DIR, "jobs")
+JOB_POLL_SECONDS = 1.0      # idle workers look for jobs queued by other processes this often
+JOB_PURGE_SECONDS = 60      # and delete expired results this often
+JOB_STALE_SECONDS = 600     # a running job with no progress for this long is failed
+JOB_PROGRESS_SECONDS = 0.25 # progress() writes to the database at most this often
+
+class JobCancelled(Exception):
+    """Raised by JobContext.progress() once the job has been cancelled."""
+
+class JobContext:
+    """What a job handler runs with: its parameters, a database connection, a result file and progress reporting."""
+
+    def __init__(self, queue, job_id, params, db, status_db):
+        self.id = job_id
+        self.params = params
+        self.db = db
+        self.result_path = queue.result_path(job_id)
+        self._status_db = status_db
+        self._reported = 0.0
+
+    def progress(self, fraction, message=""):
+        """Record how far the job is (0..1) and check for cancellation; raises JobCancelled."""
+        now = unix_time()
+        if fraction < 1 and now - self._reported < JOB_PROGRESS_SECONDS:
+            return
+        self._reported = now
+        # A separate connection, so recording progress never commits half of the
+        # handler's work; handlers report between writes, not while one is pending
+        rows = self._status_db.execute(
+            "UPDATE jobs SET progress=?, message=?, heartbeat_at=? WHERE id=? RETURNING cancel_requested",
+            (min(max(fraction, 0), 1), message, now, self.id)
+        ).fetchall()
+        self._status_db.commit()
+        if not rows or rows[0][0]:
+            raise JobCancelled()
+
+class JobQueue:
+    """SQLite-backed job queue and the pool of worker threads that drains it."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def result_path(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def submit(self, db, kind, params, owner=""):
+        """Queue a job; returns (job id, True), or (id, False) of an identical job that is still queued or running."""
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        encoded = json.dumps(params, sort_keys=True)
+        dedup_key = hashlib.sha1(f"{kind}\n{encoded}".encode()).hexdigest()
+        while True:
+            existing = db.execute("SELECT id FROM jobs WHERE dedup_key=? AND status IN ('queued', 'running')", (dedup_key,)).fetchone()
+            if existing:
+                return existing["id"], False
+            job_id = secrets.token_hex(8)
+            try:
+                db.execute("INSERT INTO jobs (id, kind, params, dedup_key, owner, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                           (job_id, kind, encoded, dedup_key, owner, unix_time()))
+                db.commit()
+            except sqlite3.IntegrityError:
+                # Another request queued the same job in between; share that one
+                db.rollback()
+                continue
+            self.ensure_workers()
+            self._wake.set()
+            return job_id, True
+
+    def get(self, db, job_id):
+        """The job's row, or None if it is unknown or has expired."""
+        return db.execute("SELECT * FROM jobs WHERE id=? AND (expires_at IS NULL OR expires_at >= ?)", (job_id, unix_time())).fetchone()
+
+    def cancel(self, db, job_id):
+        """Cancel a queued job, or ask a running one to stop at its next progress report; returns the job's row."""
+        now = unix_time()
+        db.execute("UPDATE jobs SET status='cancelled', message='Cancelled.', finished_at=?, expires_at=? WHERE id=? AND status='queued'",
+                   (now, now + app.config["JOB_RESULT_TTL"], job_id))
+        db.execute("UPDATE jobs SET cancel_requested=1, message='Cancelling...' WHERE id=? AND status='running'", (job_id,))
+        db.commit()
+        return self.get(db, job_id)
+
+    def claim(self, db, worker):
+        """Mark the oldest queued job as running by ``worker``; returns its row, or None if nothing is queued."""
+        now = unix_time()
+        # One statement, so two workers can never claim the same job
+        rows = db.execute("""
+            UPDATE jobs SET status='running', worker=?, started_at=?, heartbeat_at=?
+            WHERE id = (SELECT id FROM jobs WHERE status='queued' ORDER BY created_at LIMIT 1)
+            RETURNING id, kind, params
+        """, (worker, now, now)).fetchall()
+        db.commit()
+        return rows[0] if rows else None
+
+    def run_next(self, db, status_db, worker=""):
+        """Claim and run one job; returns False if there was none.
+
+        ``db`` is handed to the job, ``status_db`` (a second connection to
+        the same database) records the job's state.
+        """
+        job = self.claim(status_db, worker)
+        if job is None:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        context = JobContext(self, job["id"], json.loads(job["params"]), db, status_db)
+        started = perf_counter()
+        result = download = None
+        try:
+            message, result, download = JOB_HANDLERS[job["kind"]](context)
+            status = "done"
+        except JobCancelled:
+            status, message = "cancelled", "Cancelled."
+        except ImportError as e:
+            status, message = "failed", f"Error: '{e.name}' library is missing. Please install it using 'pip install {e.name}'."
+        except ValueError as e:
+            status, message = "failed", f"⚠️ {e}"
+        except Exception as e:
+            app.logger.exception("Job %s (%s) failed", job["id"], job["kind"])
+            status, message = "failed", f"Error: {type(e).__name__}: {e}"
+        if status != "done":
+            if db.in_transaction:
+                db.rollback()
+            download = None
+            try:
+                os.remove(context.result_path)
+            except OSError:
+                pass
+        now = unix_time()
+        status_db.execute("""
+            UPDATE jobs SET status=?, message=?, progress=CASE WHEN ?='done' THEN 1 ELSE progress END, result=?,
+                            download_name=?, mimetype=?, finished_at=?, expires_at=?
+            WHERE id=?
+        """, (status, message, status, None if result is None else json.dumps(result),
+              download and download[0], download and download[1], now, now + app.config["JOB_RESULT_TTL"], job["id"]))
+        status_db.commit()
+        if app.config["METRICS"]:
+            metrics.observe("timetable_job_seconds", perf_counter() - started, kind=job["kind"], status=status)
+        return True
+
+    def purge(self, db):
+        """Delete expired jobs and their files, and fail running jobs whose worker has gone quiet."""
+        now = unix_time()
+        ttl = app.config["JOB_RESULT_TTL"]
+        db.execute("UPDATE jobs SET status='failed', message='The worker running this job stopped.', finished_at=?, expires_at=? "
+                   "WHERE status='running' AND heartbeat_at < ?", (now, now + ttl, now - JOB_STALE_SECONDS))
+        expired = [row[0] for row in db.execute("DELETE FROM jobs WHERE expires_at < ? RETURNING id", (now,)).fetchall()]
+        db.commit()
+        try:
+            # Uploads are normally deleted by their job, unless it was cancelled before it ran
+            uploads = [name for name in os.listdir(self.directory) if name.startswith(("upload-", "incoming-"))
+                       and os.stat(os.path.join(self.directory, name)).st_mtime < now - ttl]
+        except OSError:
+            uploads = []
+        for name in expired + uploads:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _work(self, path, name):
+        db, status_db = connect_db(path), connect_db(path)
+        worker = f"{os.getpid()}/{name}"
+        purged = 0.0
+        try:
+            while not self._stop.is_set():
+                if unix_time() - purged > JOB_PURGE_SECONDS:
+                    self.purge(status_db)
+                    purged = unix_time()
+                try:
+                    ran = self.run_next(db, status_db, worker)
+                except sqlite3.OperationalError as e:
+                    # Database busy for longer than busy_timeout; try again on the next round
+                    app.logger.warning("Job worker %s: %s", worker, e)
+                    ran = False
+                if not ran:
+                    self._wake.wait(JOB_POLL_SECONDS)
+                    self._wake.clear()
+        finally:
+            db.close()
+            status_db.close()
+
+    def start(self, workers, path=None):
+        """Start ``workers`` worker threads on the database at ``path``."""
+        path = path or app.config["DATABASE"]
+        self._stop.clear()
+        self._pid = os.getpid()
+        for n in range(workers):
+            thread = threading.Thread(target=self._work, args=(path, f"job-worker-{n + 1}"), name=f"job-worker-{n + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def ensure_workers(self):
+        """Start this process's JOB_WORKERS worker threads, unless they are already running."""
+        with self._lock:
+            # Threads do not survive a fork, so a forked server worker starts its own
+            if app.config["JOB_WORKERS"] > 0 and self._pid != os.getpid():
+                self._threads = []
+                self.start(app.config["JOB_WORKERS"])
+
+    def join(self):
+        while any(thread.is_alive() for thread in self._threads):
+            for thread in self._threads:
+                thread.join(1)
+
+    def stop(self):
+        """Stop the worker threads once they finish their current job."""
+        self._stop.set()
+        self._wake.set()
+        self.join()
+        self._threads = []
+        self._pid = None
+
+job_queue = JobQueue(JOB_DIR)
+
+EXPORT_MIMETYPES = {"xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "pdf": "application/pdf"}
+
+def run_export_job(job, fmt):
+    mode, key = job.params["mode"], job.params["key"]
+    key = tuple(key) if mode == "dept" else key
+    stem, title = export_names(mode, key)
+    job.progress(0, "Rendering")
+    grid = get_grid(job.db, mode, key)
+    data, _ = cached_export(job.db, mode, key, fmt, lambda: EXPORT_FORMATS[fmt](export_title(title, grid), export_schedule(grid), grid.calendar))
+    if data is None:
+        raise ValueError(f"Error generating {fmt.upper()}")
+    with open(job.result_path, "wb") as out:
+        out.write(data)
+    return f"✅ {stem}.{fmt} is ready.", None, (f"{stem}.{fmt}", EXPORT_MIMETYPES[fmt])
+
+def run_export_all_job(job):
+    rows = job.db.execute("SELECT * FROM timetable").fetchall()
+    calendars = calendar_registry.sync(job.db).by_id
+    job.progress(0, f"{len(rows)} entries read")
+    with open(job.result_path, "wb") as out:
+        if job.params["workbook"]:
+            build_class_workbook(rows, out, calendars, progress=job.progress)
+            return "✅ Workbook is ready.", None, ("all_classes_timetable.xlsx", EXPORT_MIMETYPES["xlsx"])
+        if job.params.get("combined"):
+            build_combined_pdf(rows, out, by=job.params["by"], calendars=calendars, progress=job.progress)
+            return "✅ PDF is ready.", None, ("timetables.pdf", EXPORT_MIMETYPES["pdf"])
+        failed = build_export_zip(rows, out, formats=job.params["formats"], by=job.params["by"], calendars=calendars, progress=job.progress)
+    message = "✅ Export is ready." + (f" {len(failed)} files failed to render." if failed else "")
+    return message, {"failed": failed}, ("timetables.zip", "application/zip")
+
+def run_import_job(job):
+    upload = os.path.join(job_queue.directory, job.params["upload"])
+    try:
+        job.progress(0, "Reading file")
+        with open(upload, "rb") as stream:
+            rows = list(read_import_rows(stream, job.params["filename"]))
+        job.progress(0.5, f"Checking {len(rows)} rows")
+        try:
+            result = import_timetable(job.db, rows)
+        except sqlite3.IntegrityError:
+            raise ValueError("Conflict detected! The timetable changed during the import. Nothing was imported, please try again.")
+    finally:
+        try:
+            os.remove(upload)
+        except OSError:
+            pass
+    report = save_import_report(result["rejected"])
+    message = f"✅ Imported {result['imported']} entries, rejected {len(result['rejected'])}."
+    return message, {"imported": result["imported"], "rejected": len(result["rejected"]), "report": report}, None
+
+def run_optimize_job(job):
+    params = job.params
+    job.progress(0, "Solving")
+    result = score_solution(job.db, solve_on_calendars(job.db, params["requirements"], rooms=params["rooms"], time_budget=params["time_budget"]))
+    # Last chance to cancel before anything is saved
+    job.progress(0.99, "Saving" if params["apply"] else "Solved")
+    saved = False
+    if params["apply"] and result["assignments"]:
+        try:
+            save_assignments(job.db, result["assignments"])
+            saved = True
+        except ValueError as e:
+            app.logger.warning("Optimizer result not saved: %s", e)
+    return optimize_summary(result, params["apply"], saved), dict(result, saved=saved), None
+
+# kind: handler(JobContext) -> (message, JSON result or None, (download name, mimetype) or None)
+JOB_HANDLERS = {
+    "export_xlsx": lambda job: run_export_job(job, "xlsx"),
+    "export_pdf": lambda job: run_export_job(job, "pdf"),
+    "export_all": run_export_all_job,
+    "import": run_import_job,
+    "optimize": run_optimize_job,
+}
+
+def wants_json():
+    return request.is_json or request.accept_mimetypes.best == "application/json"
+
+def submit_job(kind, params):
+    """Queue a job for the current user: 202 with its status URL for API clients, otherwise its progress page."""
+    db = get_db()
+    job_id, created = job_queue.submit(db, kind, params, owner=session.get("username", ""))
+    status_url = url_for("job_status", job_id=job_id)
+    if wants_json():
+        return {"id": job_id, "created": created, "status_url": status_url}, 202, {"Location": status_url}
+    if not created:
+        flash("⏳ The same job is already running; showing its progress.")
+    elif app.config["JOB_WORKERS"] > 0:
+        flash("⏳ Started in the background.")
+    else:
+        flash("⏳ Queued; it starts as soon as a job worker (flask run-jobs) picks it up.")
+    return redirect(url_for("job_page", job_id=job_id))
+
+def job_json(job):
+    data = {column: job[column] for column in ("id", "kind", "status", "progress", "message", "created_at", "started_at", "finished_at", "expires_at")}
+    data["result"] = json.loads(job["result"]) if job["result"] else None
+    data["download_url"] = url_for("job_download", job_id=job["id"]) if job["status"] == "done" and job["download_name"] else None
+    return data
+
+@app.route("/jobs/<job_id>")
+def job_page(job_id):
+    if "username" not in session:
+        return redirect(url_for("login"))
+    job_queue.ensure_workers()
+    job = job_queue.get(get_db(), job_id)
+    if job is None:
+        return "Job not found or expired", 404
+    return render_template("Job.html", job=job_json(job))
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    if "username" not in session:
+        return redirect(url_for("login"))
+    job_queue.ensure_workers()
+    job = job_queue.get(get_db(), job_id)
+    if job is None:
+        return {"error": "Job not found or expired"}, 404
+    return job_json(job)
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    if "username" not in session:
+        return redirect(url_for("login"))
+    job = job_queue.cancel(get_db(), job_id)
+    if job is None:
+        return ({"error": "Job not found or expired"}, 404) if wants_json() else ("Job not found or expired", 404)
+    if wants_json():
+        return job_json(job)
+    flash("Job cancelled." if job["status"] == "cancelled" else "Cancelling...")
+    return redirect(url_for("job_page", job_id=job_id))
+
+@app.route("/jobs/<job_id>/download")
+def job_download(job_id):
+    if "username" not in session:
+        return redirect(url_for("login"))
+    job = job_queue.get(get_db(), job_id)
+    if job is None or job["status"] != "done" or not job["download_name"]:
+        return "Job result not found or expired", 404
+    return send_from_directory(job_queue.directory, job_id, as_attachment=True, download_name=job["download_name"], mimetype=job["mimetype"])
+
+@app.cli.command("run-jobs")
+@click.option("--workers", type=int, default=2, help="Worker threads.")
+def run_jobs_command(workers):
+    """Run background jobs until interrupted; start one next to the web server."""
+    init_db()
+    job_queue.start(workers)
+    click.echo(f"Running jobs with {workers} workers on {app.config['DATABASE']}; press Ctrl+C to stop.")
+    try:
+        job_queue.join()
+    except KeyboardInterrupt:
+        click.echo("Stopping after the current jobs...")
+        job_queue.stop()
 
 # Check slots route
 @app.route("/check_slots", methods=["GET", "POST"])
@@ -482,56 +4624,27 @@ def check_slots():
         semester = request.form.get("semester", "")
         auto_assign = request.form.get("auto_assign")
         subject = request.form.get("subject")
+        duration = parse_duration(request.form.get("duration")) or 1
         db = get_db()
-        if mode == 'dept':
-            used = db.execute(
-                "SELECT day, time, staff_name, subject, year, semester, id FROM timetable WHERE department=? AND year=? AND semester=?",
-                (department, year, semester)
-            ).fetchall()
-        else:
-            used = db.execute(
-                "SELECT day, time, staff_name, subject, year, semester, id FROM timetable WHERE staff_name=?",
-                (staff_name,)
-            ).fetchall()
-        used_slots = {(row["day"], row["time"]): row for row in used}
+        grid_key = (department, year, semester) if mode == 'dept' else staff_name
         # Auto-assign logic
         if auto_assign and subject:
-            assigned = False
-            for t in time_slots:
-                for d in days:
-                    if (d, t) not in used_slots:
-                        db.execute(
-                            "INSERT INTO timetable (staff_name, department, year, semester, subject, day, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            (staff_name, department, year, semester, subject, d, t)
-                        )
-                        db.commit()
-                        message = f"Auto-assigned {subject} to {d} {t}."
-                        assigned = True
-                        break
-                if assigned:
-                    break
-            if not assigned:
-                message = "No free slot available for auto-assign."
-            # Refresh used_slots after auto-assign
-            if mode == 'dept':
-                used = db.execute(
-                    "SELECT day, time, staff_name, subject, year, semester, id FROM timetable WHERE department=? AND year=? AND semester=?",
-                    (department, year, semester)
-                ).fetchall()
+            placed = auto_assign_session(db, staff_name, department, year, semester, subject, duration, request.form.get("room_type", "").strip())
+            if placed:
+                message = (f"Auto-assigned {subject} to {placed['day']} {placed['time']}" + (f" for {duration} periods" if duration > 1 else "")
+                           + (f" in {placed['room']}." if placed["room"] else "."))
             else:
-                used = db.execute(
-                    "SELECT day, time, staff_name, subject, year, semester, id FROM timetable WHERE staff_name=?",
-                    (staff_name,)
-                ).fetchall()
-            used_slots = {(row["day"], row["time"]): row for row in used}
+                message = "No free slot available for auto-assign."
+        change_seq = change_feed.bounds(db)[1]
+        grid = get_grid(db, 'dept' if mode == 'dept' else 'staff', grid_key)
+        live_url = change_stream_url(change_seq, 'dept' if mode == 'dept' else 'staff', grid_key)
         # Build a grid: rows=time_slots, columns=days
         timetable_grid = []
-        for t in time_slots:
+        for ti, t in enumerate(grid.calendar.time_slots):
             row = []
-            for d in days:
-                key = (d, t)
-                if key in used_slots:
-                    entry = used_slots[key]
+            for di in range(len(grid.calendar.day_labels)):
+                entry = grid.at(di, ti)
+                if entry:
                     # Display format: Subject (Y: 1 S: 2)
                     display_text = f"{entry['subject']} (Y:{entry['year']} S:{entry['semester']})"
                     row.append({"subject": display_text, "entry_id": entry['id']})
@@ -539,17 +4652,235 @@ def check_slots():
                     row.append({"subject": "Free", "entry_id": None})
             timetable_grid.append({"time": t, "slots": row})
         slots = timetable_grid
-    return render_template("check_slots.html", slots=slots, staff_name=staff_name, department=department, days=days, message=message, mode=mode)
+        day_labels = grid.calendar.day_labels
+    else:
+        day_labels = DEFAULT_CALENDAR.day_labels
+        live_url = None
+    return render_template("check_slots.html", live_url=live_url, slots=slots, staff_name=staff_name, department=department, days=day_labels, message=message, mode=mode,
+                           max_duration=calendar_registry.longest_day(get_db()))
 
 # Delete slot route (for check_slots page)
 @app.route("/delete_slot/<int:entry_id>", methods=["POST"])
 def delete_slot(entry_id):
     db = get_db()
+    entry = db.execute("SELECT * FROM timetable WHERE id=?", (entry_id,)).fetchone()
     db.execute("DELETE FROM timetable WHERE id=?", (entry_id,))
-    db.commit()
+    commit_timetable(db, removed=[entry] if entry else [])
     flash("🗑️ Slot deleted successfully!")
     return redirect(url_for("check_slots"))
 
+# Read-only JSON API: class and staff grids and free slots, for portals and
+# apps that poll. Bodies are serialized once and cached with an ETag made from
+# the revisions of the timetables they were built from, so an unchanged poll
+# gets a 304 and a changed one costs a single rebuild. The table revision is
+# read at most every API_REVISION_CHECK_SECONDS, and until it moves cached
+# bodies are served without touching the database; writes in this process
+# show up at once, writes by other processes within that interval.
+API_REVISION_CHECK_SECONDS = 1.0
+# Bump when a response body changes shape, so clients' ETags stop matching
+API_VERSION = 2
+
+def read_entity_revisions(db, entities):
+    """{entity name: (revision, unix time of its last change)}; (0, 0) for a timetable never written."""
+    found = dict.fromkeys(entities, (0, 0))
+    if entities:
+        rows = db.execute(f"SELECT entity, revision, changed_at FROM timetable_revisions WHERE entity IN ({', '.join('?' * len(entities))})", list(entities))
+        found.update((entity, (revision, changed_at)) for entity, revision, changed_at in rows)
+    return found
+
+class ApiCache:
+    """LRU of pre-serialized API responses, each tagged with the revisions it was built from."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._state = None   # (table revision, calendar revision) as last read
+        self._checked = 0.0
+
+    def invalidate(self):
+        """Re-read the revisions on the next request (called after this process writes)."""
+        self._state = None
+
+    def _current_state(self):
+        state = self._state
+        if state is None or perf_counter() - self._checked >= API_REVISION_CHECK_SECONDS:
+            state = tuple(get_db().execute(
+                "SELECT (SELECT value FROM timetable_meta WHERE key = 'revision'), (SELECT value FROM timetable_meta WHERE key = 'calendars')"
+            ).fetchone())
+            self._state, self._checked = state, perf_counter()
+        return state
+
+    def get(self, key, entities, build):
+        """Cached {"body", "etag", "last_modified"} for ``key``.
+
+        ``entities`` are the revision names (see entity_name()) the response
+        depends on and build(db) returns its JSON-ready value. An entry seen
+        since the last table change is served as is; otherwise the revisions
+        of its own entities decide whether it is rebuilt.
+        """
+        state = self._current_state()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+        if hit is not None and hit["state"] == state:
+            return hit
+        db = get_db()
+        revisions = read_entity_revisions(db, entities)
+        # Tag with the revisions read before building: a write that lands
+        # while building only causes one extra rebuild, never a stale hit
+        tag = (key, tuple(revisions[e][0] for e in entities), state[1], API_VERSION)
+        if hit is not None and hit["tag"] == tag:
+            hit["state"] = state
+            return hit
+        entry = {
+            "state": state,
+            "tag": tag,
+            "body": json.dumps(build(db)).encode(),
+            "etag": ExportCache.digest(tag),
+            "last_modified": max((changed_at for _, changed_at in revisions.values()), default=0) or None,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+api_cache = ApiCache()
+
+def api_reader_allowed():
+    return "username" in session or app.config["PUBLIC_API"]
+
+def api_response(entry):
+    """A cached API body as a response, or 304 if the client's copy (ETag / Last-Modified) is current."""
+    response = Response(entry["body"], mimetype="application/json")
+    response.set_etag(entry["etag"])
+    if entry["last_modified"]:
+        response.last_modified = entry["last_modified"]
+    # Clients and shared caches may keep it, but must revalidate every time
+    response.headers["Cache-Control"] = ("public" if app.config["PUBLIC_API"] else "private") + ", no-cache"
+    return response.make_conditional(request)
+
+def grid_body(db, mode, key):
+    """JSON-ready class or staff timetable: a days x time_slots grid of entries (None when free)."""
+    grid = get_grid(db, mode, key)
+    calendar = grid.calendar
+    body = {"department": key[0], "year": key[1], "semester": key[2]} if mode == "dept" else {"staff_name": key}
+    body.update({
+        "calendar": calendar.name,
+        "days": calendar.day_labels,
+        "time_slots": calendar.time_slots,
+        "breaks": calendar.pause_labels,
+        "grid": [[grid.at(di, ti) for ti in range(calendar.slots_per_day)] for di in range(calendar.cycle_days)],
+        # Entries on another calendar's days, which have no cell here
+        "hidden": grid.hidden,
+    })
+    return body
+
+@app.route("/api/timetable/class")
+def class_timetable_api():
+    if not api_reader_allowed():
+        return redirect(url_for("login"))
+    department, semester = request.args.get("department"), request.args.get("semester")
+    if not department or not semester:
+        return {"error": "department and semester are required (year too, if the class has one)"}, 400
+    key = class_key(department, request.args.get("year", ""), semester)
+    return api_response(api_cache.get(("dept", key), [entity_name("dept", key)], lambda db: grid_body(db, "dept", key)))
+
+@app.route("/api/timetable/staff")
+def staff_timetable_api():
+    if not api_reader_allowed():
+        return redirect(url_for("login"))
+    staff_name = request.args.get("staff_name")
+    if not staff_name:
+        return {"error": "staff_name is required"}, 400
+    return api_response(api_cache.get(("staff", staff_name), [entity_name("staff", staff_name)], lambda db: grid_body(db, "staff", staff_name)))
+
+def free_slots_body(db, staff_name, cls, room, duration):
+    # Slots are read on the class's calendar, else on the staff member's or room's
+    if cls:
+        calendar = calendar_registry.for_class(db, cls)
+    else:
+        calendar = calendar_registry.for_entity(db, "staff" if staff_name else "room", staff_name or room)
+    free = calendar.block_starts(occupancy_index.free_mask(db, staff_name, cls, room, calendar), duration)
+    spd = calendar.slots_per_day
+    return {
+        "calendar": calendar.name,
+        "duration": duration,
+        "days": calendar.day_labels,
+        "time_slots": calendar.time_slots,
+        "grid": [[bool(free >> (d * spd + t) & 1) for t in range(spd)] for d in range(calendar.cycle_days)],
+        "free": [dict(zip(("day", "time", "week"), calendar.bit_slot(b))) for b in range(calendar.week_bits) if free >> b & 1],
+    }
+
+# Free slot query: slots where the staff member, class and room are all free;
+# with ?duration=N, the periods a block of N free periods can start in
+@app.route("/api/free_slots")
+def free_slots():
+    if not api_reader_allowed():
+        return redirect(url_for("login"))
+    staff_name = request.args.get("staff_name") or None
+    department = request.args.get("department")
+    cls = class_key(department, request.args.get("year", ""), request.args.get("semester", "")) if department else None
+    room = request.args.get("room") or None
+    duration = parse_duration(request.args.get("duration"))
+    if duration is None:
+        return {"error": "duration must be a number of periods"}, 400
+    entities = [entity_name(mode, key) for mode, key in (("staff", staff_name), ("dept", cls), ("room", room)) if key]
+    return api_response(api_cache.get(("free", staff_name, cls, room, duration), entities,
+                                      lambda db: free_slots_body(db, staff_name, cls, room, duration)))
+
+# Request instrumentation hooks and the /metrics endpoint (see Metrics)
+@app.before_request
+def start_request_metrics():
+    if app.config["METRICS"]:
+        g.request_started = perf_counter()
+    if app.config["PROFILER"] and request.args.get("profile") and "username" in session:
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+@app.after_request
+def finish_request_metrics(response):
+    g.response_status = response.status_code
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        return Response(profiler.report(), mimetype="text/plain")
+    return response
+
+@app.teardown_request
+def record_request_metrics(exception):
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = g.get("response_status", 500)
+    metrics.observe("timetable_request_duration_seconds", perf_counter() - started, route=route, method=request.method, status=status)
+    db = g.get("db")
+    if isinstance(db, InstrumentedConnection):
+        statements, seconds = g.get("sql_baseline", (0, 0.0))
+        metrics.observe("timetable_request_sql_statements", db.statements - statements, route=route)
+        metrics.observe("timetable_request_sql_seconds", db.sql_seconds - seconds, route=route)
+
+def _start_render(sender, template, context, **extra):
+    if app.config["METRICS"]:
+        g.render_started = perf_counter()
+
+def _finish_render(sender, template, context, **extra):
+    started = g.pop("render_started", None)
+    if started is not None:
+        metrics.observe("timetable_render_seconds", perf_counter() - started, template=template.name or "string")
+
+before_render_template.connect(_start_render, app)
+template_rendered.connect(_finish_render, app)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not app.config["METRICS"]:
+        return "Metrics are disabled; set TIMETABLE_METRICS=true to enable them.", 404
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Login/logout routes
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -571,9 +4902,51 @@ def logout():
     flash("Logged out successfully.")
     return redirect(url_for("login"))
 
+# ``app`` is a module-level singleton that every route above is registered
+# on. Before it serves, the database is migrated and the occupancy index
+# warmed once per process and database: eagerly by configure_app(), which
+# wsgi.py calls with the production settings, and otherwise on the first
+# request, so ``flask --app App run`` and ``python App.py`` get the same setup.
+_setup_lock = threading.Lock()
+_setup_databases = set()
+
+def setup_database():
+    """Run the schema migrations and load the occupancy index for app.config["DATABASE"], once."""
+    path = app.config["DATABASE"]
+    if path in _setup_databases:
+        return
+    with _setup_lock:
+        if path not in _setup_databases:
+            init_db(path)
+            with app.app_context():
+                occupancy_index.sync(get_db())
+            _setup_databases.add(path)
+
+@app.before_request
+def setup_before_first_request():
+    setup_database()
+
+def configure_app(config=None):
+    """One-time production configuration of the ``app`` singleton; returns it.
+
+    Switches on per-thread connection reuse and WAL mode, applies ``config``
+    on top and sets up the database before workers take requests. This does
+    not build a new Flask instance: call it once per process, before serving
+    (gunicorn -w 4 -b 0.0.0.0:5001 wsgi:app, see wsgi.py).
+    """
+    app.config.update(DB_POOL=True, DB_WAL=True)
+    if config:
+        app.config.update(config)
+    setup_database()
+    return app
+
 # Main
 if __name__ == "__main__":
-    init_db()
+    # The development server is the only process, so it runs jobs itself
+    # unless TIMETABLE_JOB_WORKERS says otherwise
+    if "TIMETABLE_JOB_WORKERS" not in os.environ:
+        app.config["JOB_WORKERS"] = 2
+    setup_database()
     port = int(os.environ.get("PORT", 5001))
     # Default to debug=True for local, but allow turning it off via env var
     debug_mode = os.environ.get("FLASK_DEBUG", "True").lower() == "true"
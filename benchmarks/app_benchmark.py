@@ -0,0 +1,243 @@
+"""End-to-end benchmarks of the Flask app on synthetic institutions.
+
+For each size a fresh institution is generated with generate_institution.py
+into a temporary database. The real app is then driven through Flask's test
+client: the /add conflict check and a successful add, the dashboard with
+and without filters, check-slots, auto-assign, and both exporters (cold and
+cached). Every size runs in its own process, so caches and peak memory
+start from scratch.
+
+    python benchmarks/app_benchmark.py [--sizes 1000,100000,1000000] [--requests 100]
+                                       [--out results.json] [--compare baseline.json]
+
+The results (throughput, p50 / p99 latency and peak RSS per scenario and
+size) are printed and saved as JSON. --compare prints how a run differs
+from an earlier results file, so two versions can be benchmarked and compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Read-only scenarios first: the writes at the end invalidate the caches the
+# earlier ones are allowed to warm
+SCENARIOS = [
+    "dashboard", "dashboard_class", "dashboard_staff", "check_slots",
+    "export_excel", "export_excel_cached", "export_pdf",
+    "add_conflict", "add", "auto_assign",
+]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def build_scenarios(client, db, rng):
+    """{name: request(i)} over classes, staff and bookings sampled from the database."""
+    classes = db.execute("SELECT department, year, semester FROM classes WHERE department != '' ORDER BY id").fetchall()
+    staff = [r[0] for r in db.execute("SELECT name FROM staff WHERE name != '' ORDER BY id")]
+    bookings = db.execute("SELECT staff_name, department, year, semester, day, time FROM timetable "
+                          "WHERE id IN (SELECT id FROM sessions ORDER BY random() LIMIT 1000)").fetchall()
+    class_staff = {}
+    for staff_name, department, year, semester in db.execute(
+            "SELECT staff_name, department, year, semester FROM timetable WHERE id IN (SELECT MIN(id) FROM sessions GROUP BY class_id)"):
+        class_staff[(department, year, semester)] = staff_name
+
+    def cls(i):
+        return dict(zip(("department", "year", "semester"), classes[i % len(classes)]))
+
+    def add_conflict(i):
+        staff_name, department, year, semester, day, t = rng.choice(bookings)
+        return client.post("/add", data={"staff_name": "Bench Staff", "department": department, "year": year,
+                                         "semester": semester, "subject": "Bench", "room": "", "day": day, "time": t})
+
+    def add(i):
+        # A new class every time, so the add always goes through
+        return client.post("/add", data={"staff_name": f"Bench Staff {i}", "department": "BENCH", "year": "1",
+                                         "semester": str(i), "subject": "Bench", "room": "", "day": "Monday",
+                                         "time": "8:30 - 9:20"})
+
+    def auto_assign(i):
+        target = cls(rng.randrange(len(classes)))
+        staff_name = class_staff.get(tuple(target.values()), staff[0])
+        return client.post("/auto_assign", data=dict(target, staff_name=staff_name, subject="Bench Extra"))
+
+    return {
+        "dashboard": lambda i: client.get("/dashboard"),
+        "dashboard_class": lambda i: client.get("/dashboard", query_string=dict(cls(rng.randrange(len(classes))), mode="dept")),
+        "dashboard_staff": lambda i: client.get("/dashboard", query_string={"mode": "staff", "staff_name": rng.choice(staff)}),
+        "check_slots": lambda i: client.post("/check_slots", data=dict(cls(rng.randrange(len(classes))), mode="dept")),
+        # Cold exports walk through the classes so each one is a cache miss
+        # (as long as there are more classes than requests)
+        "export_excel": lambda i: client.get("/export_excel", query_string=dict(cls(i), mode="dept")),
+        "export_excel_cached": lambda i: client.get("/export_excel", query_string=dict(cls(0), mode="dept")),
+        "export_pdf": lambda i: client.get("/export_pdf", query_string=dict(cls(len(classes) // 2 + i), mode="dept")),
+        "add_conflict": add_conflict,
+        "add": add,
+        "auto_assign": auto_assign,
+    }
+
+
+def case_insensitive_templates(app):
+    """Find templates whatever their case, as on Windows where Templates/ was written."""
+    import jinja2
+
+    folder = os.path.join(ROOT, "Templates")
+    names = {name.lower(): name for name in os.listdir(folder)}
+
+    def load(name):
+        path = os.path.join(folder, names.get(name.lower(), name))
+        with open(path, encoding="utf-8") as f:
+            return f.read(), path, lambda: True
+    app.jinja_env.loader = jinja2.FunctionLoader(load)
+
+
+def run_size(db_path, requests, warmup, seed):
+    """Benchmark one prepared database in this process; returns a list of result dicts."""
+    os.environ["TIMETABLE_DB"] = db_path
+    sys.path.insert(0, ROOT)
+    import App
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_export_cache_")
+    App.export_cache.directory = cache_dir
+    App.app.config.update(TESTING=True, DATABASE=db_path)
+    App.init_db(db_path)
+    if not os.path.isdir(os.path.join(ROOT, "templates")):
+        case_insensitive_templates(App.app)
+    client = App.app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = "bench"
+    db = App.connect_db(db_path)
+    rows = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    scenarios = build_scenarios(client, db, random.Random(seed))
+    db.close()
+
+    results = []
+    for name in SCENARIOS:
+        request = scenarios[name]
+        # Warm-up requests use their own indices so they do not pre-fill the cold export cache
+        for i in range(warmup):
+            request(10 ** 6 + i)
+        samples, errors = [], 0
+        started = time.perf_counter()
+        for i in range(requests):
+            t0 = time.perf_counter()
+            response = request(i)
+            samples.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                errors += 1
+            response.close()
+        total = time.perf_counter() - started
+        samples.sort()
+        results.append({
+            "rows": rows,
+            "scenario": name,
+            "requests": requests,
+            "errors": errors,
+            "throughput": round(requests / total, 2),
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+            "peak_rss_mb": peak_rss_mb(),
+        })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results):
+    print(f"{'rows':>9} {'scenario':<20} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8} {'errors':>6}")
+    for r in results:
+        print(f"{r['rows']:>9} {r['scenario']:<20} {r['throughput']:>9.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+              f"{r['peak_rss_mb'] or 0:>8.1f} {r['errors']:>6}")
+
+
+def print_comparison(results, baseline):
+    before = {(r["rows"], r["scenario"]): r for r in baseline["results"]}
+    print(f"\nAgainst {baseline['commit']} ({baseline['started']}): ratio new / old, below 1 is faster")
+    print(f"{'rows':>9} {'scenario':<20} {'p50':>7} {'p99':>7} {'req/s':>7}")
+    for r in results:
+        old = before.get((r["rows"], r["scenario"]))
+        if old:
+            print(f"{r['rows']:>9} {r['scenario']:<20} {r['p50_ms'] / old['p50_ms']:>7.2f} "
+                  f"{r['p99_ms'] / old['p99_ms']:>7.2f} {r['throughput'] / old['throughput']:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="JSON results file (default benchmark-<commit>.json)")
+    parser.add_argument("--compare", help="earlier JSON results file to compare against")
+    parser.add_argument("--run-db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_db:
+        # Child process: benchmark one database and hand the results back on stdout
+        json.dump(run_size(args.run_db, args.requests, args.warmup, args.seed), sys.stdout)
+        return
+
+    report = {
+        "commit": git_commit(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "requests": args.requests,
+        "generate": [],
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(s) for s in args.sizes.split(",")):
+            db_path = os.path.join(tmp, f"bench_{size}.db")
+            started = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(HERE, "generate_institution.py"), "--rows", str(size),
+                            "--db", db_path, "--seed", str(args.seed)], check=True, stdout=subprocess.DEVNULL)
+            report["generate"].append({"rows": size, "seconds": round(time.perf_counter() - started, 2),
+                                       "db_mb": round(os.path.getsize(db_path) / 2 ** 20, 1)})
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-db", db_path,
+                                    "--requests", str(args.requests), "--warmup", str(args.warmup), "--seed", str(args.seed)],
+                                   check=True, stdout=subprocess.PIPE, text=True)
+            results = json.loads(child.stdout)
+            print_results(results)
+            report["results"] += results
+
+    out = args.out or f"benchmark-{report['commit']}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(report["results"], json.load(f))
+
+
+if __name__ == "__main__":
+    main()
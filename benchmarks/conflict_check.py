@@ -0,0 +1,95 @@
+"""Conflict-check latency against table size.
+
+Builds synthetic timetables of increasing size in a temporary database and
+times the same conflict probe that /add runs, once on the bare table and once
+on the fully migrated schema (indexed, normalized storage behind the view).
+
+    python benchmarks/conflict_check.py [--sizes 1000,10000,100000] [--probes 500]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from App import SCHEMA_MIGRATIONS, days, time_slots  # noqa: E402
+
+# One branch per kind of clash, so each can use its own index (an OR across
+# the joined tables of the timetable view cannot)
+CONFLICT_SQL = """SELECT id FROM timetable WHERE staff_name=? AND day=? AND time=?
+   UNION ALL SELECT id FROM timetable WHERE department=? AND year=? AND semester=? AND day=? AND time=?
+   UNION ALL SELECT id FROM timetable WHERE room != '' AND room=? AND day=? AND time=?"""
+
+# The first three migrations only build the table; later ones add the indexes
+# and the normalized storage
+BASE_MIGRATIONS = 3
+
+
+def synthetic_rows(count, seed=1):
+    """Yield conflict-free rows: each class fills every slot of the week."""
+    rng = random.Random(seed)
+    per_class = len(days) * len(time_slots)
+    for n in range(count):
+        class_no, slot_no = divmod(n, per_class)
+        day = days[slot_no // len(time_slots)]
+        t = time_slots[slot_no % len(time_slots)]
+        department = f"D{class_no // 32}"
+        year = str(class_no // 8 % 4 + 1)
+        semester = str(class_no % 8 + 1)
+        # Staff and rooms are striped across classes so they never collide
+        staff = f"S{class_no}-{slot_no % 5}"
+        room = f"R{class_no}-{slot_no % 3}"
+        yield (staff, department, year, semester, f"Sub{rng.randrange(20)}", room, day, t)
+
+
+def build_db(path, count, indexed):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    migrations = SCHEMA_MIGRATIONS if indexed else SCHEMA_MIGRATIONS[:BASE_MIGRATIONS]
+    for migration in migrations:
+        migration(cursor)
+    cursor.executemany(
+        "INSERT INTO timetable (staff_name, department, year, semester, subject, room, day, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        synthetic_rows(count)
+    )
+    conn.commit()
+    return conn
+
+
+def time_probes(conn, count, probes, seed=2):
+    rng = random.Random(seed)
+    rows = list(synthetic_rows(count))
+    samples = []
+    for _ in range(probes):
+        staff, department, year, semester, _, room, day, t = rng.choice(rows)
+        start = time.perf_counter()
+        conn.execute(CONFLICT_SQL, (staff, day, t, department, year, semester, day, t, room, day, t)).fetchone()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,300000")
+    parser.add_argument("--probes", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'schema':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(s) for s in args.sizes.split(",")):
+            for indexed in (False, True):
+                path = os.path.join(tmp, f"bench_{size}_{int(indexed)}.db")
+                conn = build_db(path, size, indexed)
+                p50, p99 = time_probes(conn, size, args.probes)
+                conn.close()
+                label = "indexed" if indexed else "bare"
+                print(f"{size:>9} {label:>8} {p50 * 1000:>9.3f} {p99 * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
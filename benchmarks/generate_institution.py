@@ -0,0 +1,158 @@
+"""Synthetic institution generator.
+
+Builds a realistic institution straight into a timetable database, through
+the app's own migrations and bulk insert path. Each department has four
+years of two semesters, its own staff, and a pool of lecture rooms and labs.
+Each class gets a strength and a conflict-free week of lectures and
+three-period lab blocks. The generated data is the same for the same
+--rows and --seed.
+
+    python benchmarks/generate_institution.py --rows 100000 [--db path] [--fresh] [--seed 1]
+
+Without --db the app's own database (TIMETABLE_DB or Timetable.db/timetable.db)
+is used; it is only written to if its timetable is empty, unless --fresh
+deletes the file first.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from App import DB_PATH, DEFAULT_CALENDAR, change_feed, connect_db, init_db, insert_sessions, save_room_catalogue  # noqa: E402
+
+YEARS = 4
+SEMESTERS_PER_YEAR = 2
+LECTURES = 6           # subjects per class, taught as single periods
+LECTURE_HOURS = 4      # periods per week of each subject
+LABS = 2               # lab blocks per class per week
+LAB_DURATION = 3
+STAFF_LOAD = 18        # teaching periods per staff member per week
+ROWS_PER_CLASS = LECTURES * LECTURE_HOURS + LABS
+BATCH_ROWS = 50000
+
+
+def department_sessions(dept_no, classes, rng, calendar=DEFAULT_CALENDAR):
+    """Place one department's classes; returns (rows, rooms, strengths).
+
+    Sessions go into a random start that is free for the class, the staff
+    member and a room of the right type, found with the same block masks
+    the app's allocator uses. A session with no such start is dropped.
+    """
+    department = f"DEPT{dept_no:04d}"
+    periods = classes * (LECTURES * LECTURE_HOURS + LABS * LAB_DURATION)
+    staff = [f"{department} Staff {n + 1}" for n in range(math.ceil(periods / STAFF_LOAD))]
+    # Enough rooms for about 80% utilization of lecture periods and 60% of the
+    # lab block starts, which clash more with the class and staff timetables
+    lab_starts_per_week = bin(calendar.run_starts(LAB_DURATION)).count("1")
+    lecture_rooms = [f"{department} Room {n + 1}" for n in range(math.ceil(classes * LECTURES * LECTURE_HOURS / (0.8 * calendar.week_bits)))]
+    labs = [f"{department} Lab {n + 1}" for n in range(math.ceil(classes * LABS / (0.6 * lab_starts_per_week)))]
+    rooms = [(name, rng.choice((60, 72, 80)), "lecture") for name in lecture_rooms]
+    rooms += [(name, 70, "lab") for name in labs]
+
+    staff_occ = dict.fromkeys(staff, 0)
+    room_occ = dict.fromkeys(lecture_rooms + labs, 0)
+    load = dict.fromkeys(staff, 0)
+    rows, strengths = [], []
+    for class_no in range(classes):
+        year = class_no // SEMESTERS_PER_YEAR + 1
+        semester = class_no + 1
+        strengths.append((department, str(year), str(semester), rng.randrange(40, 71)))
+        class_occ = 0
+        sessions = [(f"Lab {n + 1}", LAB_DURATION, labs) for n in range(LABS)]
+        for n in range(LECTURES):
+            sessions += [(f"Subject {year}{semester}{n + 1}", 1, lecture_rooms)] * LECTURE_HOURS
+        teachers = {}
+        for subject, duration, pool in sessions:
+            if subject not in teachers:
+                teachers[subject] = min(staff, key=lambda s: (load[s], rng.random()))
+            teacher = teachers[subject]
+            run = (1 << duration) - 1
+            starts = calendar.block_starts(calendar.full_week & ~(class_occ | staff_occ[teacher]), duration)
+            bits = [b for b in range(calendar.week_bits) if starts >> b & 1]
+            rng.shuffle(bits)
+            for bit in bits:
+                flag = run << bit
+                room = next((r for r in pool if not room_occ[r] & flag), None)
+                if room is None:
+                    continue
+                class_occ |= flag
+                staff_occ[teacher] |= flag
+                room_occ[room] |= flag
+                load[teacher] += duration
+                day, time_label, week = calendar.bit_slot(bit)
+                rows.append({
+                    "staff_name": teacher, "department": department, "year": str(year), "semester": str(semester),
+                    "subject": subject, "room": room, "day": day, "time": time_label, "week": week, "duration": duration,
+                })
+                break
+    return rows, rooms, strengths
+
+
+def generate(db, rows, seed=1):
+    """Generate ``rows`` timetable rows into ``db``; returns counts and timings.
+
+    Departments are added until enough sessions have been placed, and the
+    last one is cut off at ``rows``.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    written = departments = classes = staff = rooms_total = 0
+    batch = []
+    while written + len(batch) < rows:
+        departments += 1
+        # Only as many classes as are needed, so small institutions stay small
+        wanted = math.ceil((rows - written - len(batch)) / ROWS_PER_CLASS)
+        count = min(YEARS * SEMESTERS_PER_YEAR, wanted)
+        dept_rows, rooms, strengths = department_sessions(departments, count, rng)
+        save_room_catalogue(db, rooms, strengths)
+        batch += dept_rows[:rows - written - len(batch)]
+        classes += count
+        staff += len({r["staff_name"] for r in dept_rows})
+        rooms_total += len(rooms)
+        if len(batch) >= BATCH_ROWS:
+            insert_sessions(db, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        insert_sessions(db, batch)
+        written += len(batch)
+    # Nobody is following the change log of a new database; keep only its tail,
+    # as the app does, so the first write benchmarked does not trim the lot
+    change_feed.trim(db)
+    db.commit()
+    return {
+        "rows": written,
+        "departments": departments,
+        "classes": classes,
+        "staff": staff,
+        "rooms": rooms_total,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fresh", action="store_true", help="delete the database file first")
+    args = parser.parse_args()
+
+    if args.fresh and os.path.exists(args.db):
+        os.remove(args.db)
+    init_db(args.db)
+    db = connect_db(args.db)
+    if db.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+        sys.exit(f"{args.db} already has a timetable; use --fresh to replace it.")
+    stats = generate(db, args.rows, args.seed)
+    db.close()
+    print(f"{stats['rows']} rows for {stats['classes']} classes in {stats['departments']} departments "
+          f"({stats['staff']} staff, {stats['rooms']} rooms) in {stats['seconds']:.1f}s -> {args.db}")
+
+
+if __name__ == "__main__":
+    main()
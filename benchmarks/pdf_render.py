@@ -0,0 +1,79 @@
+"""PDF rendering time per timetable, one document each versus many per document.
+
+Generates a small synthetic institution (see generate_institution.py) into a
+temporary database and renders its class timetables with the app's PDF
+template: once as one xhtml2pdf run per timetable, as the single-timetable
+export does, and then in batches of several timetables per run, as the
+combined export does.
+
+    python benchmarks/pdf_render.py [--timetables 40] [--batches 1,10,40] [--repeat 3]
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from App import TimetableGrid, calendar_registry, connect_db, export_names, export_schedule, fetch_grid_rows, init_db, write_pdf  # noqa: E402
+from generate_institution import ROWS_PER_CLASS, generate  # noqa: E402
+
+
+def class_timetables(db, count):
+    """(title, schedule, calendar) of the first ``count`` class timetables."""
+    timetables = []
+    for key in db.execute("SELECT department, year, semester FROM classes WHERE id > 0 ORDER BY id LIMIT ?", (count,)):
+        key = tuple(key)
+        grid = TimetableGrid("dept", key, fetch_grid_rows(db, "dept", key), calendar_registry.for_class(db, key))
+        timetables.append((export_names("dept", key)[1], export_schedule(grid), grid.calendar))
+    return timetables
+
+
+def time_batches(timetables, batch, repeat):
+    """Best-of-``repeat`` seconds to render every timetable, ``batch`` of them per document."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for i in range(0, len(timetables), batch):
+            if not write_pdf(timetables[i:i + batch], io.BytesIO()):
+                sys.exit("xhtml2pdf reported an error")
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--timetables", type=int, default=40)
+    parser.add_argument("--batches", default="1,10,40", help="timetables per document")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    # xhtml2pdf warns about every CSS property it skips, once per document
+    logging.getLogger("xhtml2pdf").setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pdf_bench.db")
+        init_db(path)
+        db = connect_db(path)
+        generate(db, args.timetables * ROWS_PER_CLASS)
+        timetables = class_timetables(db, args.timetables)
+        db.close()
+
+    write_pdf(timetables[:1], io.BytesIO())  # warm up fonts and imports
+    print(f"{len(timetables)} class timetables")
+    print(f"{'per document':>12} {'total s':>9} {'ms each':>9} {'vs 1':>6}")
+    single = None
+    for batch in (int(b) for b in args.batches.split(",")):
+        total = time_batches(timetables, batch, args.repeat)
+        single = single or (total if batch == 1 else None)
+        ratio = f"{total / single:>6.2f}" if single else f"{'':>6}"
+        print(f"{batch:>12} {total:>9.2f} {total / len(timetables) * 1000:>9.1f} {ratio}")
+
+
+if __name__ == "__main__":
+    main()
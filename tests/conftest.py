@@ -0,0 +1,81 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import App  # noqa: E402
+
+BASELINE_DB = os.path.join(ROOT, "Timetable.db", "timetable.db")
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app on a fresh, fully migrated database, with empty process-wide caches."""
+    monkeypatch.setitem(App.app.config, "DATABASE", str(tmp_path / "timetable.db"))
+    monkeypatch.setitem(App.app.config, "TESTING", True)
+    monkeypatch.setitem(App.app.config, "JOB_WORKERS", 0)
+    monkeypatch.setattr(App, "occupancy_index", App.OccupancyIndex())
+    monkeypatch.setattr(App, "calendar_registry", App.CalendarRegistry())
+    # Cache keys are revision counters, which start again on every fresh database
+    monkeypatch.setattr(App, "grid_cache", App.GridCache())
+    monkeypatch.setattr(App, "api_cache", App.ApiCache())
+    monkeypatch.setattr(App, "export_cache", App.ExportCache(str(tmp_path / "export_cache")))
+    monkeypatch.setattr(App, "_revision_cache", {})
+    App.setup_database()
+    return App.app
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """A copy of the database shipped with the repository, before any migration."""
+    path = str(tmp_path / "baseline.db")
+    shutil.copy(BASELINE_DB, path)
+    return path
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = "admin"
+    return client
+
+
+@pytest.fixture
+def db(app):
+    conn = App.connect_db()
+    yield conn
+    conn.close()
+
+
+def flashes(client):
+    """Messages flashed since the last call."""
+    with client.session_transaction() as session:
+        return [message for _, message in session.pop("_flashes", [])]
+
+
+def add(client, **fields):
+    """POST an entry to /add; returns the flashed messages."""
+    form = {"staff_name": "Alice", "department": "CSE", "year": "1", "semester": "1", "subject": "Maths",
+            "room": "", "day": "Monday", "time": "8:30 - 9:20", "duration": "1"}
+    form.update(fields)
+    client.post("/add", data=form)
+    return flashes(client)
+
+
+def insert(db, **fields):
+    """Insert an entry straight into the table, bypassing the app's own conflict checks."""
+    row = {"staff_name": "Alice", "department": "CSE", "year": "1", "semester": "1", "subject": "Maths",
+           "room": "", "day": "Monday", "time": "8:30 - 9:20", "week": 0, "duration": 1}
+    row.update(fields)
+    db.execute(f"INSERT INTO timetable ({', '.join(row)}) VALUES ({', '.join(':' + c for c in row)})", row)
+    db.commit()
+
+
+def count(db):
+    return db.execute("SELECT COUNT(*) FROM timetable").fetchone()[0]
+
@@ -0,0 +1,103 @@
+import sqlite3
+
+import pytest
+
+from conftest import App, add, count, insert
+
+
+CONFLICT = "⚠️ Conflict detected! Staff, Class, or Room is already booked at this time."
+
+
+@pytest.fixture
+def rotation(app, db):
+    """MECH 1 1 on a calendar with odd / even weeks."""
+    App.save_calendar(db, {"name": "Rotation", "days": ["Monday", "Tuesday"],
+                           "slots": ["8:30 - 9:20", "9:20 - 10:10", "10:20 - 11:10"],
+                           "weeks": ["Odd", "Even"], "classes": [["MECH", "1", "1"]]})
+    db.commit()
+
+
+def entry_id(db, subject):
+    return db.execute("SELECT id FROM timetable WHERE subject = ?", (subject,)).fetchone()[0]
+
+
+def test_add_rejects_staff_class_and_room_double_bookings(client, db):
+    assert add(client, room="R1") == ["✅ Entry added successfully!"]
+    assert add(client, department="EEE") == [CONFLICT]
+    assert add(client, staff_name="Bob") == [CONFLICT]
+    assert add(client, staff_name="Bob", department="EEE", room="R1") == [CONFLICT]
+    assert add(client, staff_name="Bob", department="EEE", room="R2") == ["✅ Entry added successfully!"]
+    assert count(db) == 2
+
+
+def test_add_rejects_clash_with_any_period_of_a_block(client, db):
+    assert add(client, subject="Lab", duration="2") == ["✅ Entry added successfully!"]
+    assert add(client, department="EEE", time="9:20 - 10:10") == [CONFLICT]
+    # A block starting earlier that runs into the booked one clashes too
+    assert add(client, staff_name="Bob", department="EEE", subject="Lab", time="10:20 - 11:10", duration="2") == ["✅ Entry added successfully!"]
+    assert add(client, staff_name="Bob", department="MECH", time="9:20 - 10:10", duration="2") != ["✅ Entry added successfully!"]
+    assert count(db) == 2
+
+
+def test_database_rejects_overlapping_blocks(db):
+    insert(db, subject="Lab", room="R1", duration=2)
+    for clash in ({"department": "EEE", "time": "9:20 - 10:10"},
+                  {"staff_name": "Bob", "time": "9:20 - 10:10"},
+                  {"staff_name": "Bob", "department": "EEE", "room": "R1", "time": "9:20 - 10:10"}):
+        with pytest.raises(sqlite3.IntegrityError):
+            insert(db, **clash)
+        db.rollback()
+    insert(db, department="EEE", time="10:20 - 11:10")
+    assert count(db) == 2
+
+
+def test_database_rejects_block_moved_onto_another(db):
+    insert(db, subject="Lab", duration=2)
+    insert(db, subject="Talk", department="EEE", time="10:20 - 11:10")
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("UPDATE timetable SET time = '9:20 - 10:10' WHERE subject = 'Talk'")
+    db.rollback()
+
+
+def test_rotation_weeks(rotation, client, db):
+    assert add(client, department="MECH", subject="Odd") == ["✅ Entry added successfully!"]
+    App.edit_entries(db, [{"op": "update", "id": entry_id(db, "Odd"), "week": "Odd"}])
+    # The even week of the same period is free; a weekly session is not
+    insert(db, department="MECH", subject="Even", week=2)
+    with pytest.raises(sqlite3.IntegrityError):
+        insert(db, department="MECH", staff_name="Bob", subject="Weekly", week=0)
+    db.rollback()
+    with pytest.raises(ValueError, match="already booked"):
+        App.edit_entries(db, [{"op": "update", "id": entry_id(db, "Even"), "week": ""}])
+    assert add(client, department="MECH", staff_name="Bob", subject="Weekly") == [CONFLICT]
+    assert sorted(row[0] for row in db.execute("SELECT week FROM timetable")) == [1, 2]
+
+
+def test_rotation_week_block_clashes_with_weekly_session(rotation, db):
+    insert(db, department="MECH", subject="Weekly", time="9:20 - 10:10")
+    with pytest.raises(sqlite3.IntegrityError):
+        insert(db, department="MECH", staff_name="Bob", subject="Lab", week=1, duration=2)
+    db.rollback()
+
+
+def test_stale_version_edit_is_rejected(client, db):
+    add(client)
+    entry = entry_id(db, "Maths")
+    App.edit_entries(db, [{"op": "update", "id": entry, "version": 1, "subject": "Algebra"}])
+    assert db.execute("SELECT version FROM timetable WHERE id = ?", (entry,)).fetchone()[0] == 2
+
+    with pytest.raises(ValueError, match="changed by someone else"):
+        App.edit_entries(db, [{"op": "update", "id": entry, "version": 1, "subject": "Geometry"}])
+    response = client.post("/api/entries/batch", json={"operations": [{"op": "update", "id": entry, "version": 1, "day": "Friday"}]})
+    assert response.status_code == 409
+    assert tuple(db.execute("SELECT subject, day, version FROM timetable WHERE id = ?", (entry,)).fetchone()) == ("Algebra", "Monday", 2)
+
+
+def test_blocks_longer_than_eight_periods_fit_a_long_day(client, db):
+    slots = [f"{h}:00 - {h}:50" for h in range(7, 19)]
+    App.save_calendar(db, {"name": "Long", "days": ["Monday"], "slots": slots, "classes": [["MECH", "1", "1"]]})
+    db.commit()
+    assert App.calendar_registry.longest_day(db) == 12
+
+    assert add(client, department="MECH", time="7:00 - 7:50", duration="10") == ["✅ Entry added successfully!"]
+    assert db.execute("SELECT duration FROM timetable WHERE department = 'MECH'").fetchone()[0] == 10
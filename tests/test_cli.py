@@ -0,0 +1,17 @@
+import sqlite3
+import zipfile
+
+from conftest import App
+
+
+def test_export_all_migrates_the_database_first(app, baseline_db, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, "DATABASE", baseline_db)
+    out = str(tmp_path / "timetables.zip")
+    result = app.test_cli_runner().invoke(args=["export-all", out, "--format", "xlsx", "--workers", "1"])
+    assert result.exit_code == 0, result.output
+
+    conn = sqlite3.connect(baseline_db)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(App.SCHEMA_MIGRATIONS)
+    conn.close()
+    with zipfile.ZipFile(out) as archive:
+        assert archive.namelist()
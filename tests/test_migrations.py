@@ -0,0 +1,73 @@
+import sqlite3
+
+from conftest import App
+
+
+def user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_baseline_database_migrates_to_latest_version(baseline_db):
+    before = sqlite3.connect(baseline_db)
+    rows = before.execute("SELECT id, staff_name, department, year, semester, subject, day, time FROM timetable ORDER BY id").fetchall()
+    before.close()
+    assert user_version(baseline_db) == 0
+
+    App.init_db(baseline_db)
+
+    assert user_version(baseline_db) == len(App.SCHEMA_MIGRATIONS) == 17
+    conn = sqlite3.connect(baseline_db)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(timetable)")}
+    assert {"room", "week", "duration", "version", "calendar_id"} <= columns
+    # Every baseline row is either a session or set aside as unscheduled, never lost
+    migrated = conn.execute("SELECT id, staff_name, department, year, semester, subject, day, time FROM timetable").fetchall()
+    unscheduled = conn.execute("SELECT id FROM timetable_unscheduled").fetchall()
+    assert len(migrated) + len(unscheduled) == len(rows)
+    assert set(migrated) <= set(rows)
+    assert conn.execute("SELECT COUNT(*) FROM sessions WHERE week != 0 OR duration != 1 OR version != 1").fetchone()[0] == 0
+    conn.close()
+
+
+def test_migrations_run_once(baseline_db):
+    App.init_db(baseline_db)
+    conn = sqlite3.connect(baseline_db)
+    schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    conn.close()
+
+    App.init_db(baseline_db)
+
+    conn = sqlite3.connect(baseline_db)
+    assert conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    conn.close()
+    assert user_version(baseline_db) == len(App.SCHEMA_MIGRATIONS)
+
+
+def test_new_database_has_overlap_checks(tmp_path):
+    path = str(tmp_path / "new.db")
+    App.init_db(path)
+    conn = sqlite3.connect(path)
+    triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    conn.close()
+    for kind in App.SESSION_OVERLAP_CHECKS:
+        assert f"trg_sessions_{kind}_overlap_insert" in triggers
+        assert f"trg_sessions_{kind}_overlap_update" in triggers
+
+
+def test_recreated_database_does_not_reuse_export_keys(tmp_path):
+    # Both databases start their revision counters from the same values, so
+    # only the database id tells their exports apart
+    keys = []
+    for name in ("first.db", "second.db"):
+        path = str(tmp_path / name)
+        App.init_db(path)
+        conn = sqlite3.connect(path)
+        keys.append((App.read_database_id(conn), App.read_revision(conn)))
+        App.init_db(path)
+        assert App.read_database_id(conn) == keys[-1][0]
+        conn.close()
+    assert keys[0][1] == keys[1][1]
+    assert keys[0][0] != keys[1][0]
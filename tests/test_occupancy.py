@@ -0,0 +1,64 @@
+from conftest import App, add, insert
+
+
+def assert_index_matches_table(db):
+    """The live index holds exactly the masks a fresh load of the table gives."""
+    index = App.occupancy_index.sync(db)
+    fresh = App.OccupancyIndex().sync(db)
+    assert index.revision == fresh.revision
+    assert index.staff == fresh.staff
+    assert index.classes == fresh.classes
+    assert index.rooms == fresh.rooms
+
+
+def test_index_stays_consistent_through_add_edit_and_delete(client, db):
+    add(client, room="R1")
+    add(client, staff_name="Bob", department="EEE", subject="Lab", room="R2", time="10:20 - 11:10", duration="2")
+    index = App.occupancy_index.sync(db)
+    # Folded in by commit_timetable(), not reloaded
+    assert index.revision is not None
+    assert_index_matches_table(db)
+    assert index.conflicts(db, "Bob", ("MECH", "1", "1"), "", "Monday", "11:10 - 12:00") == ["staff"]
+
+    lab = db.execute("SELECT id FROM timetable WHERE subject = 'Lab'").fetchone()[0]
+    App.edit_entries(db, [{"op": "update", "id": lab, "day": "Tuesday", "room": "R1"}])
+    assert_index_matches_table(db)
+    assert index.conflicts(db, "Bob", ("MECH", "1", "1"), "", "Monday", "11:10 - 12:00") == []
+    assert index.conflicts(db, "Carol", ("MECH", "1", "1"), "R1", "Tuesday", "11:10 - 12:00") == ["room"]
+
+    maths = db.execute("SELECT id FROM timetable WHERE subject = 'Maths'").fetchone()[0]
+    App.edit_entries(db, [{"op": "swap", "ids": [maths, lab]}])
+    assert_index_matches_table(db)
+
+    client.post(f"/delete/{lab}")
+    assert_index_matches_table(db)
+    assert "Bob" not in App.occupancy_index.staff
+
+
+def test_index_reloads_after_a_write_it_did_not_see(client, db):
+    add(client)
+    App.occupancy_index.sync(db)
+    insert(db, staff_name="Bob", department="EEE", time="9:20 - 10:10")
+    assert App.occupancy_index.conflicts(db, "Bob", ("MECH", "1", "1"), "", "Monday", "9:20 - 10:10") == ["staff"]
+    assert_index_matches_table(db)
+
+
+def test_sessions_on_other_calendars_are_compared_by_clock_time(client, db):
+    App.save_calendar(db, {"name": "North", "days": ["Tuesday", "Wednesday"],
+                           "slots": ["9:00 - 9:50", "10:00 - 10:50", "11:00 - 11:50"],
+                           "classes": [["MECH", "1", "1"]]})
+    db.commit()
+    add(client, time="1:30 - 2:20")
+    assert App.occupancy_index.conflicts(db, "Alice", ("MECH", "1", "1"), "", "Tuesday", "10:00 - 10:50") == []
+
+    add(client, day="Tuesday", time="10:20 - 11:10")
+    assert App.occupancy_index.conflicts(db, "Alice", ("MECH", "1", "1"), "", "Tuesday", "10:00 - 10:50") == ["staff"]
+    assert App.occupancy_index.conflicts(db, "Alice", ("MECH", "1", "1"), "", "Tuesday", "9:00 - 9:50") == []
+    assert_index_matches_table(db)
+
+    # The staff grid shows the North session in the periods it overlaps
+    add(client, department="MECH", day="Wednesday", time="9:00 - 9:50")
+    grid = App.get_grid(db, "staff", "Alice")
+    assert grid.calendar.name == "Default"
+    assert grid.schedule()["Wednesday"]["8:30 - 9:20"]["department"] == "MECH"
+    assert grid.hidden == []
@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import App, count, insert
+
+
+@pytest.fixture
+def shared_staff(app, db):
+    """Alice teaches CSE 1 1 (Default calendar) and MECH 1 1 (North), and only Monday 8:30 - 9:20 is free in both."""
+    App.save_calendar(db, {"name": "North", "days": ["Monday"], "slots": ["8:30 - 9:20"], "classes": [["MECH", "1", "1"]]})
+    db.commit()
+    calendar = App.calendar_registry.for_class(db, ("CSE", "1", "1"))
+    for day in calendar.days:
+        for time in calendar.time_slots:
+            if (day, time) != ("Monday", "8:30 - 9:20"):
+                insert(db, staff_name=f"{day} {time}", day=day, time=time)
+    return [
+        {"subject": "Maths", "staff_name": "Alice", "department": "CSE", "year": "1", "semester": "1", "hours": 1},
+        {"subject": "Mechanics", "staff_name": "Alice", "department": "MECH", "year": "1", "semester": "1", "hours": 1},
+    ]
+
+
+def test_staff_shared_between_calendars_is_not_double_booked(shared_staff, db):
+    result = App.solve_on_calendars(db, shared_staff, time_budget=0.2)
+    assert len(result["assignments"]) == 1
+    assert len(result["unplaced"]) == 1
+
+
+def test_clashing_solver_output_is_not_saved(shared_staff, db):
+    before = count(db)
+    assignments = [dict(req, day="Monday", time="8:30 - 9:20", week=0, duration=1, room="") for req in shared_staff]
+    # Different calendars, so only the clock-time check can see this clash
+    with pytest.raises(ValueError, match="staff already booked"):
+        App.save_assignments(db, assignments)
+    assert count(db) == before
+    App.save_assignments(db, assignments[:1])
+    assert count(db) == before + 1
+
+
+def test_optimize_applies_a_conflict_free_solution(shared_staff, client, db):
+    before = count(db)
+    response = client.post("/optimize", json={"requirements": shared_staff, "time_budget": 0.2, "apply": True})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["saved"] and len(body["assignments"]) == 1
+    assert count(db) == before + 1
@@ -0,0 +1,17 @@
+import sys
+import threading
+
+from conftest import App
+
+
+def test_overlapping_profiles_restore_the_switch_interval():
+    original = sys.getswitchinterval()
+    first = App.SamplingProfiler(threading.get_ident(), interval=0.002).start()
+    second = App.SamplingProfiler(threading.get_ident(), interval=0.001).start()
+    assert sys.getswitchinterval() == 0.0005
+
+    # Stopped out of order: the second profiler is still sampling
+    first.stop()
+    assert sys.getswitchinterval() == 0.0005
+    second.stop()
+    assert sys.getswitchinterval() == original
@@ -0,0 +1,5 @@
+# Production entry point, e.g.
+#   gunicorn -w 4 --threads 4 -b 0.0.0.0:5001 wsgi:app
+from App import configure_app
+
+app = configure_app()